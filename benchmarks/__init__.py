@@ -0,0 +1,172 @@
+"""Benchmarks of the XCAP server hot paths
+
+The benchmarks run in-process and do not need a running server. All of them
+are run with
+
+    python3 -m benchmarks
+
+and each module can also be run on its own, e.g.
+
+    python3 -m benchmarks.element
+
+Importing this package configures the server to use a SQLite database in a
+temporary directory, so it must be imported before any xcap module.
+"""
+
+import argparse
+import asyncio
+import atexit
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import timeit
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+from application.process import process
+
+__all__ = ['main', 'measure', 'measure_async', 'result', 'print_results', 'setup_database', 'loop',
+           'xcap_root', 'username', 'password', 'realm',
+           'resource_lists_document', 'rls_services_document', 'pres_rules_document']
+
+
+xcap_root = 'http://xcap.example.com/xcap-root'
+username = 'alice'
+password = 'secret'
+realm = 'example.com'
+
+source_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+directory = tempfile.mkdtemp(prefix='openxcap-benchmarks-')
+database = os.path.join(directory, 'xcap.db')
+atexit.register(shutil.rmtree, directory, True)
+
+configuration = """\
+[Server]
+root = %(root)s
+backend = Database
+
+[Authentication]
+type = basic
+cleartext_passwords = yes
+default_realm = %(realm)s
+
+[Database]
+authentication_db_uri = sqlite:///%(database)s
+storage_db_uri = sqlite:///%(database)s
+
+[Logging]
+directory = %(directory)s
+"""
+
+with open(os.path.join(directory, 'config.ini'), 'w') as config_file:
+    config_file.write(configuration % dict(root=xcap_root, realm=realm, database=database, directory=directory))
+
+process.configuration.user_directory = None
+process.configuration.local_directory = directory
+process.runtime.directory = directory
+
+# the event loop used by all the asynchronous benchmarks, as the database
+# connections are bound to the loop they were created in
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
+
+
+def measure(function: Callable[[], Any], repeat: int = 5, min_time: float = 0.2) -> Dict[str, Any]:
+    """Time function, calling it enough times for every run to take at least
+    min_time seconds, and return the best and mean time per call in seconds"""
+    timer = timeit.Timer(function)
+    number = 1
+    while timer.timeit(number) < min_time and number < 1000000:
+        number *= 10
+    times = [elapsed / number for elapsed in timer.repeat(repeat, number)]
+    return {'best': min(times), 'mean': sum(times) / len(times), 'calls': number * repeat}
+
+
+def measure_async(function: Callable[[], Awaitable[Any]], repeat: int = 5, min_time: float = 0.2) -> Dict[str, Any]:
+    """Like measure, for a coroutine function which is run in the benchmarks loop"""
+    return measure(lambda: loop.run_until_complete(function()), repeat, min_time)
+
+
+def result(benchmark: str, timing: Dict[str, Any], **params: Any) -> Dict[str, Any]:
+    """Return the result of a benchmark as it is written to the JSON output"""
+    return dict(benchmark=benchmark, params=params, **timing)
+
+
+def _key(result: Dict[str, Any]):
+    return result['benchmark'], tuple(sorted(result['params'].items()))
+
+
+def print_results(results: Iterable[Dict[str, Any]], baseline: Optional[Iterable[Dict[str, Any]]] = None) -> None:
+    """Print results as a table, along with the ratio to the best time of the
+    same benchmark in baseline, if given"""
+    previous = dict((_key(result), result) for result in baseline or [])
+    print('%-32s %-40s %12s %12s %8s' % ('benchmark', 'params', 'best (ms)', 'mean (ms)', 'ratio'))
+    for result in results:
+        params = ' '.join('%s=%s' % item for item in sorted(result['params'].items()))
+        ratio = ''
+        if _key(result) in previous:
+            ratio = '%.2f' % (result['best'] / previous[_key(result)]['best'])
+        print('%-32s %-40s %12.3f %12.3f %8s' % (result['benchmark'], params, result['best'] * 1000, result['mean'] * 1000, ratio))
+
+
+def main(run: Callable[[Iterable[int]], List[Dict[str, Any]]], description: str) -> None:
+    """Run the benchmarks of a single module from the command line"""
+    parser = argparse.ArgumentParser(description=description.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 10000], help='number of entries of the documents (default: %(default)s)')
+    args = parser.parse_args()
+    print_results(run(args.sizes))
+
+
+_database_ready = False
+
+
+def setup_database() -> None:
+    """Create the database schema and the user the benchmarks authenticate as"""
+    global _database_ready
+    if _database_ready:
+        return
+    from xcap.db.initialize import init_db
+    # the alembic configuration and migrations are looked up in the current directory
+    cwd = os.getcwd()
+    os.chdir(source_directory)
+    try:
+        init_db()
+    finally:
+        os.chdir(cwd)
+    ha1 = hashlib.md5(('%s:%s:%s' % (username, realm, password)).encode()).hexdigest()
+    with sqlite3.connect(database) as connection:
+        connection.execute('DELETE FROM subscriber WHERE username = ? AND domain = ?', (username, realm))
+        connection.execute('INSERT INTO subscriber (username, domain, password, ha1) VALUES (?, ?, ?, ?)', (username, realm, password, ha1))
+    _database_ready = True
+
+
+def resource_lists_document(entries: int) -> bytes:
+    """Return a resource-lists document with a single list of the given number of entries"""
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<resource-lists xmlns="urn:ietf:params:xml:ns:resource-lists">',
+             '  <list name="friends">']
+    lines.extend('    <entry uri="sip:user%d@example.com"><display-name>User %d</display-name></entry>' % (i, i) for i in range(entries))
+    lines.extend(['  </list>', '</resource-lists>', ''])
+    return '\n'.join(lines).encode()
+
+
+def rls_services_document(services: int) -> bytes:
+    """Return a rls-services document with the given number of services"""
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<rls-services xmlns="urn:ietf:params:xml:ns:rls-services" xmlns:rl="urn:ietf:params:xml:ns:resource-lists">']
+    lines.extend('  <service uri="sip:service%d@example.com"><list name="list%d"><rl:entry uri="sip:user%d@example.com"/></list>'
+                 '<packages><package>presence</package></packages></service>' % (i, i, i) for i in range(services))
+    lines.extend(['</rls-services>', ''])
+    return '\n'.join(lines).encode()
+
+
+def pres_rules_document(rules: int) -> bytes:
+    """Return a pres-rules document with the given number of rules"""
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<cr:ruleset xmlns="urn:ietf:params:xml:ns:pres-rules" xmlns:cr="urn:ietf:params:xml:ns:common-policy">']
+    lines.extend('  <cr:rule id="rule%d"><cr:conditions><cr:identity><cr:one id="sip:user%d@example.com"/></cr:identity></cr:conditions>'
+                 '<cr:actions><sub-handling>allow</sub-handling></cr:actions><cr:transformations/></cr:rule>' % (i, i) for i in range(rules))
+    lines.extend(['</cr:ruleset>', ''])
+    return '\n'.join(lines).encode()
+
@@ -0,0 +1,66 @@
+"""Run the XCAP server benchmarks and write the results as JSON"""
+
+import argparse
+import importlib
+import json
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+from benchmarks import print_results, source_directory
+
+modules = ['element', 'uri', 'validation', 'xcapdiff', 'auth', 'server']
+
+
+def revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=source_directory, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python3 -m benchmarks', description=__doc__)
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK', help='the benchmarks to run, from %s (default: all)' % ', '.join(modules))
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 10000], help='number of entries of the documents (default: %(default)s)')
+    parser.add_argument('--output', '-o', metavar='FILE', help='write the results as JSON to FILE, - for the standard output')
+    parser.add_argument('--compare', '-c', metavar='FILE', help='compare the results with those in FILE, written by a previous run')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in modules:
+            parser.error('unknown benchmark %r' % name)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+
+    from lxml import etree
+    from xcap import __version__
+
+    results = []
+    for name in args.benchmarks or modules:
+        module = importlib.import_module('benchmarks.%s' % name)
+        results.extend(module.run(args.sizes))
+
+    report = {'version': __version__,
+              'revision': revision(),
+              'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+              'python': platform.python_version(),
+              'lxml': '.'.join(str(part) for part in etree.LXML_VERSION),
+              'sizes': args.sizes,
+              'results': results}
+
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_results(results, baseline)
+        if args.output:
+            with open(args.output, 'w') as output_file:
+                json.dump(report, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Authenticate requests
+
+Run the Digest authentication of a request, which is challenged first and then
+authorized with the nonce of the challenge, of a request which reuses the nonce
+of a previous one, and the Basic authentication of a request. The credentials
+are checked against the SQLite database.
+"""
+
+import base64
+import hashlib
+
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from xcap.authentication.auth import AuthenticationManager
+
+from benchmarks import (loop, main, measure_async, password, realm, result,
+                        setup_database, username)
+
+path = '/xcap-root/resource-lists/users/sip:alice@example.com/index'
+
+
+def request(authorization=None):
+    headers = [(b'authorization', authorization.encode())] if authorization else []
+    return Request({'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'headers': headers})
+
+
+def digest_authorization(challenge, nc=1):
+    fields = dict(field.split('=', 1) for field in challenge[7:].split(', '))
+    nonce = fields['nonce'].strip('"')
+    ha1 = hashlib.md5(('%s:%s:%s' % (username, realm, password)).encode()).hexdigest()
+    ha2 = hashlib.md5(('GET:%s' % path).encode()).hexdigest()
+    response = hashlib.md5(('%s:%s:%08x:0a4f113b:auth:%s' % (ha1, nonce, nc, ha2)).encode()).hexdigest()
+    return ('Digest username="%s", realm="%s", nonce="%s", uri="%s", qop=auth, nc=%08x, cnonce="0a4f113b", response="%s"'
+            % (username, realm, nonce, path, nc, response))
+
+
+def run(sizes):
+    setup_database()
+    manager = AuthenticationManager()
+
+    async def get_challenge():
+        try:
+            await manager.digest_auth(request(), realm)
+        except HTTPException as e:
+            return e.headers['WWW-Authenticate']
+        raise RuntimeError('Digest authentication was not challenged')
+
+    async def digest():
+        challenge = await get_challenge()
+        return await manager.digest_auth(request(digest_authorization(challenge)), realm)
+
+    challenge = loop.run_until_complete(get_challenge())
+    nonce_count = 0
+
+    async def digest_reuse():
+        nonlocal nonce_count
+        nonce_count += 1
+        return await manager.digest_auth(request(digest_authorization(challenge, nonce_count)), realm)
+
+    basic_authorization = 'Basic ' + base64.b64encode(('%s:%s' % (username, password)).encode()).decode()
+
+    async def basic():
+        return await manager.basic_auth(request(basic_authorization), realm)
+
+    return [result('auth.digest', measure_async(digest)),
+            result('auth.digest_reuse', measure_async(digest_reuse)),
+            result('auth.basic', measure_async(basic))]
+
+
+if __name__ == '__main__':
+    main(run, __doc__)
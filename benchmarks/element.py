@@ -0,0 +1,48 @@
+"""Compare the SAX (xcap.element) and lxml (xcap.lxmlelement) element engines
+
+GET, replace, insert and DELETE an entry in the middle of resource-lists
+documents of increasing size, with each engine.
+"""
+
+from xcap import element, lxmlelement
+from xcap.xpath import parse_node_selector
+
+from benchmarks import main, measure, result, resource_lists_document
+
+engines = {'sax': element, 'lxml': lxmlelement}
+
+namespace = 'urn:ietf:params:xml:ns:resource-lists'
+
+
+def selector(expression):
+    return parse_node_selector(expression, namespace, {})[0]
+
+
+def operations(entries):
+    """Return the operations to time on a document with the given number of entries"""
+    document = resource_lists_document(entries)
+    existing = selector('/resource-lists/list[@name="friends"]/entry[@uri="sip:user%d@example.com"]' % (entries // 2))
+    missing = selector('/resource-lists/list[@name="friends"]/entry[@uri="sip:new@example.com"]')
+    return {
+        'get': lambda engine: engine.get(document, existing),
+        'replace': lambda engine: engine.put(document, existing, b'<entry uri="sip:user%d@example.com"/>' % (entries // 2)),
+        'insert': lambda engine: engine.put(document, missing, b'<entry uri="sip:new@example.com"/>'),
+        'delete': lambda engine: engine.delete(document, existing),
+    }
+
+
+def run(sizes):
+    results = []
+    for entries in sizes:
+        for operation, function in operations(entries).items():
+            expected = function(element)
+            for name, engine in engines.items():
+                if function(engine) != expected:
+                    raise RuntimeError('The %s engine returned a different result for %s on %d entries' % (name, operation, entries))
+                results.append(result('element.%s' % operation, measure(lambda: function(engine)), engine=name, entries=entries))
+    return results
+
+
+
+if __name__ == '__main__':
+    main(run, __doc__)
@@ -0,0 +1,84 @@
+"""Full request round trips
+
+Send requests to the FastAPI application through its ASGI interface, without
+a network connection, with the documents stored in the SQLite database: PUT,
+GET and DELETE a resource-lists document of increasing size, and GET, replace,
+insert and delete an entry of the stored document.
+"""
+
+import base64
+from itertools import cycle
+
+from benchmarks import (loop, main, measure_async, password, result,
+                        resource_lists_document, setup_database, username,
+                        xcap_root)
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+document = '/xcap-root/resource-lists/users/sip:alice@example.com/index'
+entry = document + '/~~/resource-lists/list%%5b@name=%%22friends%%22%%5d/entry%%5b@uri=%%22sip:%s@example.com%%22%%5d'
+
+
+def run(sizes):
+    if httpx is None:
+        print('Skipping the server benchmarks, httpx is not installed')
+        return []
+
+    from xcap.server import XCAPApp
+
+    setup_database()
+    authorization = 'Basic ' + base64.b64encode(('%s:%s' % (username, password)).encode()).decode()
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=XCAPApp()), base_url=xcap_root.rsplit('/', 1)[0],
+                               headers={'Authorization': authorization})
+    element_headers = {'Content-Type': 'application/xcap-el+xml'}
+
+    async def request(method, url, expected, **kwargs):
+        response = await client.request(method, url, **kwargs)
+        if response.status_code != expected:
+            raise RuntimeError('%s %s returned %d instead of %d: %s' % (method, url, response.status_code, expected, response.text))
+        return response
+
+    results = []
+    for entries in sizes:
+        content = resource_lists_document(entries)
+        existing = entry % ('user%d' % (entries // 2))
+        missing = entry % 'new'
+        # storing the document or element that is already stored changes nothing, every PUT alternates between two versions
+        contents = cycle([content.replace(b'<list name="friends">', b'<list name="friends"><display-name>Friends</display-name>'), content])
+        elements = cycle([b'<entry uri="sip:user%d@example.com"/>' % (entries // 2),
+                          b'<entry uri="sip:user%d@example.com"><display-name>User %d</display-name></entry>' % (entries // 2, entries // 2)])
+
+        async def put_document():
+            await request('PUT', document, 200, content=next(contents))
+
+        async def put_delete_document():
+            await request('DELETE', document, 200)
+            await request('PUT', document, 201, content=content)
+
+        async def get_document():
+            await request('GET', document, 200)
+
+        async def get_element():
+            await request('GET', existing, 200)
+
+        async def replace_element():
+            await request('PUT', existing, 200, content=next(elements), headers=element_headers)
+
+        async def insert_delete_element():
+            await request('PUT', missing, 201, content=b'<entry uri="sip:new@example.com"/>', headers=element_headers)
+            await request('DELETE', missing, 200)
+
+        # the document may not exist yet, or may be left from the previous size
+        loop.run_until_complete(client.put(document, content=content))
+        for name, function in [('put_document', put_document), ('delete_put_document', put_delete_document),
+                               ('get_document', get_document), ('get_element', get_element),
+                               ('replace_element', replace_element), ('insert_delete_element', insert_delete_element)]:
+            results.append(result('server.%s' % name, measure_async(function), entries=entries))
+    return results
+
+
+if __name__ == '__main__':
+    main(run, __doc__)
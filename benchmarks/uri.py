@@ -0,0 +1,37 @@
+"""Parse XCAP URIs
+
+Parse the resource selector of a document, of an element, with the parsed node
+selector cached or not, and of an attribute. The size of the documents does
+not matter here, so these benchmarks only run once.
+"""
+
+from xcap.appusage import namespaces
+from xcap.uri import XCAPUri, node_selectors
+
+from benchmarks import main, measure, result, xcap_root
+
+document = '/resource-lists/users/sip:alice@example.com/index'
+
+selectors = {
+    'document': document,
+    'element': document + '/~~/resource-lists/list%5b@name=%22friends%22%5d/entry%5b@uri=%22sip:bob@example.com%22%5d',
+    'attribute': document + '/~~/resource-lists/list%5b@name=%22friends%22%5d/entry%5b@uri=%22sip:bob@example.com%22%5d/@uri',
+}
+
+
+def parse_uncached(resource_selector):
+    node_selectors.clear()
+    return XCAPUri(xcap_root, resource_selector, namespaces)
+
+
+def run(sizes):
+    results = []
+    for name, resource_selector in selectors.items():
+        results.append(result('uri.%s' % name, measure(lambda: XCAPUri(xcap_root, resource_selector, namespaces))))
+        if name != 'document':
+            results.append(result('uri.%s_uncached' % name, measure(lambda: parse_uncached(resource_selector))))
+    return results
+
+
+if __name__ == '__main__':
+    main(run, __doc__)
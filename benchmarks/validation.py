@@ -0,0 +1,40 @@
+"""Validate documents
+
+Run ApplicationUsage.validate_document on resource-lists, rls-services and
+pres-rules documents of increasing size, with and without the constraints
+which depend on the URI of the document, and ResourceListsApplication.check_list
+on its own.
+"""
+
+from xcap.appusage import applications, namespaces
+from xcap.appusage.resourcelists import ResourceListsApplication
+from xcap.uri import XCAPUri
+
+from benchmarks import (main, measure, pres_rules_document, result,
+                        resource_lists_document, rls_services_document,
+                        xcap_root)
+
+documents = {
+    'resource-lists': resource_lists_document,
+    'rls-services': rls_services_document,
+    'pres-rules': pres_rules_document,
+}
+
+
+def run(sizes):
+    results = []
+    for entries in sizes:
+        for application_id, make_document in documents.items():
+            application = applications[application_id]
+            document = make_document(entries)
+            node_uri = XCAPUri(xcap_root, '/%s/users/sip:alice@example.com/index' % application_id, namespaces)
+            results.append(result('validation.validate_document', measure(lambda: application.validate_document(document)), application=application_id, entries=entries))
+            results.append(result('validation.validate_document_uri', measure(lambda: application.validate_document(document, node_uri=node_uri)), application=application_id, entries=entries))
+            if application_id == 'resource-lists':
+                root = application.validate_document(document).getroot()
+                results.append(result('validation.check_list', measure(lambda: ResourceListsApplication.check_list(root, node_uri)), entries=entries))
+    return results
+
+
+if __name__ == '__main__':
+    main(run, __doc__)
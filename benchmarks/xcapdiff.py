@@ -0,0 +1,33 @@
+"""Notify document changes
+
+Run Notifier.on_change for a change in the documents of an increasing number
+of users. The xcap-diff documents are built but not published.
+"""
+
+from xcap.appusage import namespaces
+from xcap.uri import XCAPUri
+from xcap.xcapdiff import Notifier
+
+from benchmarks import main, measure_async, result, xcap_root
+
+
+def publish(user_uri, xcapdiff):
+    pass
+
+
+def run(sizes):
+    results = []
+    notifier = Notifier(xcap_root, publish)
+    for users in sizes:
+        uris = [XCAPUri(xcap_root, '/resource-lists/users/sip:user%d@example.com/index' % i, namespaces) for i in range(users)]
+
+        async def on_change():
+            for uri in uris:
+                await notifier.on_change(uri, '1', '2')
+
+        results.append(result('xcapdiff.on_change', measure_async(on_change), users=users))
+    return results
+
+
+if __name__ == '__main__':
+    main(run, __doc__)
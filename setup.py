@@ -38,7 +38,7 @@ setup(
     packages=find_packages("xcap"),
     package_data={'xcap.appusage': ['xml-schemas/*']},
     data_files=[('/etc/openxcap', ['config.ini.sample']), ('/etc/openxcap/tls', ['tls/README'])],
-    scripts=['openxcap'],
+    scripts=['openxcap', 'openxcap-admin'],
     include_package_data=True,
 )
 
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2007-2025 AG-Projects.
+#
+
+import ipaddress
+import unittest
+import os
+import sys
+from unittest import mock
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from starlette.requests import Request
+
+from xcap.configuration import ServerConfig
+from xcap.configuration.datatypes import NetworkIndex
+from xcap.http_utils import get_client_ip
+
+
+def request(peer, forwarded_for=None):
+    headers = [(b'x-forwarded-for', forwarded_for.encode())] if forwarded_for is not None else []
+    return Request({'type': 'http', 'method': 'GET', 'path': '/', 'headers': headers, 'client': (peer, 12345)})
+
+
+class NetworkIndexTest(unittest.TestCase):
+
+    def test_ipv4(self):
+        index = NetworkIndex('10.0.0.0/8, 192.168.1.1, 192.168.1.2/32')
+        self.assertIn('10.1.2.3', index)
+        self.assertIn(ipaddress.ip_address('10.255.255.255'), index)
+        self.assertIn('192.168.1.1', index)
+        self.assertIn('192.168.1.2', index)
+        self.assertNotIn('11.0.0.0', index)
+        self.assertNotIn('9.255.255.255', index)
+        self.assertNotIn('192.168.1.3', index)
+
+    def test_ipv6(self):
+        index = NetworkIndex('2001:db8::/32, fe80::1')
+        self.assertIn('2001:db8::1', index)
+        self.assertIn('2001:db8:ffff:ffff:ffff:ffff:ffff:ffff', index)
+        self.assertIn('fe80::1', index)
+        self.assertNotIn('2001:db9::1', index)
+        self.assertNotIn('fe80::2', index)
+        self.assertNotIn('::1', index)
+
+    def test_ipv4_mapped(self):
+        index = NetworkIndex('192.0.2.0/24')
+        self.assertIn('::ffff:192.0.2.10', index)
+        self.assertNotIn('::ffff:198.51.100.1', index)
+
+    def test_merged(self):
+        index = NetworkIndex('10.0.0.0/24, 10.0.0.128/25, 10.0.1.0/24, 10.0.3.0/24')
+        self.assertIn('10.0.1.255', index)
+        self.assertNotIn('10.0.2.0', index)
+        self.assertIn('10.0.3.0', index)
+
+    def test_empty(self):
+        for value in (None, '', 'none'):
+            index = NetworkIndex(value)
+            self.assertFalse(index)
+            self.assertNotIn('127.0.0.1', index)
+
+    def test_any(self):
+        index = NetworkIndex('any')
+        self.assertIn('203.0.113.1', index)
+        self.assertIn('2001:db8::1', index)
+
+    def test_invalid(self):
+        index = NetworkIndex('10.0.0.0/8')
+        self.assertNotIn('not an address', index)
+        self.assertNotIn('', index)
+        self.assertRaises(ValueError, NetworkIndex, '10.0.0.0/33, host.invalid')
+
+
+class ClientIPTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(ServerConfig, 'trusted_proxies', NetworkIndex('10.0.0.1, 10.0.0.2, 2001:db8::/64'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_no_forwarded_for(self):
+        self.assertEqual(get_client_ip(request('10.0.0.1')), '10.0.0.1')
+        self.assertEqual(get_client_ip(request('198.51.100.1')), '198.51.100.1')
+
+    def test_untrusted_peer(self):
+        # the header of a client which is not a trusted proxy is ignored
+        self.assertEqual(get_client_ip(request('198.51.100.1', '203.0.113.1')), '198.51.100.1')
+        self.assertEqual(get_client_ip(request('198.51.100.1', '10.0.0.2, 203.0.113.1')), '198.51.100.1')
+
+    def test_trusted_proxy(self):
+        self.assertEqual(get_client_ip(request('10.0.0.1', '203.0.113.1')), '203.0.113.1')
+
+    def test_trusted_proxy_chain(self):
+        self.assertEqual(get_client_ip(request('10.0.0.1', '203.0.113.1, 10.0.0.2')), '203.0.113.1')
+        # the addresses before the first untrusted one are set by the client and are ignored
+        self.assertEqual(get_client_ip(request('10.0.0.1', '192.0.2.66, 203.0.113.1, 10.0.0.2')), '203.0.113.1')
+        self.assertEqual(get_client_ip(request('10.0.0.1', '10.0.0.2, 203.0.113.1, 10.0.0.2')), '203.0.113.1')
+
+    def test_malformed(self):
+        self.assertEqual(get_client_ip(request('10.0.0.1', 'unknown')), '10.0.0.1')
+        self.assertEqual(get_client_ip(request('10.0.0.1', '203.0.113.1, not-an-address')), '10.0.0.1')
+        self.assertEqual(get_client_ip(request('10.0.0.1', 'not-an-address, 10.0.0.2')), '10.0.0.2')
+        self.assertEqual(get_client_ip(request('10.0.0.1', '')), '10.0.0.1')
+        self.assertEqual(get_client_ip(request('10.0.0.1', ' , ')), '10.0.0.1')
+
+    def test_ipv6(self):
+        self.assertEqual(get_client_ip(request('2001:db8::1', '2001:db8:1::5')), '2001:db8:1::5')
+        self.assertEqual(get_client_ip(request('2001:db8::1', '203.0.113.1, 2001:db8::2')), '203.0.113.1')
+        self.assertEqual(get_client_ip(request('2001:db8:1::1', '203.0.113.1')), '2001:db8:1::1')
+
+    def test_no_trusted_proxies(self):
+        with mock.patch.object(ServerConfig, 'trusted_proxies', NetworkIndex('none')):
+            self.assertEqual(get_client_ip(request('10.0.0.1', '203.0.113.1')), '10.0.0.1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2007-2025 AG-Projects.
+#
+
+import unittest
+import os
+import sys
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from xcap import element, lxmlelement
+from xcap.xpath import NodeSelector
+
+
+namespace = 'urn:ietf:params:xml:ns:resource-lists'
+
+document = '''<?xml version="1.0" encoding="UTF-8"?>
+<resource-lists xmlns="urn:ietf:params:xml:ns:resource-lists" xmlns:x="urn:example:x">
+  <!-- the friends of alice -->
+  <list name="friends">
+    <entry uri="sip:bob@example.com"><display-name>Bøb Ünïcode</display-name></entry>
+    <!-- <entry uri="sip:commented@example.com"/> -->
+    <entry uri="sip:carol@example.com"><display-name><![CDATA[Carol <the> one]]></display-name></entry>
+    <x:note>extension</x:note>
+    <entry uri="sip:dan@example.com"/>
+  </list>
+  <list name="empty"></list>
+  <list name="closed"/>
+</resource-lists>'''.encode('utf-8')
+
+
+def element_selector(selector):
+    return NodeSelector(selector + '?xmlns(x=urn:example:x)', namespace).element_selector
+
+
+class ElementEnginesTest(unittest.TestCase):
+    """Both element engines must give the same result on the same document"""
+
+    def run_engines(self, operation, selector, *args):
+        results = []
+        for engine in (element, lxmlelement):
+            try:
+                results.append(getattr(engine, operation)(document, element_selector(selector), *args))
+            except (element.SelectorError, element.LocatorError) as e:
+                results.append(type(e))
+        self.assertEqual(results[0], results[1], '%s %s' % (operation, selector))
+        return results[0]
+
+    def assertSelected(self, selector, expected):
+        self.assertEqual(self.run_engines('get', selector), expected)
+        start, end = self.run_engines('find', selector)
+        self.assertEqual(document[start:end], expected)
+        self.assertEqual(self.run_engines('delete', selector), document[:start] + document[end:])
+
+    def assertNotSelected(self, selector):
+        self.assertIsNone(self.run_engines('find', selector))
+        self.assertIsNone(self.run_engines('get', selector))
+        self.assertIsNone(self.run_engines('delete', selector))
+
+    def assertInserted(self, selector, element_body, before):
+        new_document, created = self.run_engines('put', selector, element_body)
+        self.assertTrue(created)
+        offset = document.index(before)
+        self.assertEqual(new_document, document[:offset] + element_body + document[offset:])
+
+    def test_select_by_attribute(self):
+        self.assertSelected('/resource-lists/list[@name="friends"]/entry[@uri="sip:carol@example.com"]',
+                            '<entry uri="sip:carol@example.com"><display-name><![CDATA[Carol <the> one]]></display-name></entry>'.encode())
+        self.assertSelected('/resource-lists/list/entry[@uri="sip:bob@example.com"]/display-name',
+                            '<display-name>Bøb Ünïcode</display-name>'.encode())
+
+    def test_select_by_position(self):
+        self.assertSelected('/resource-lists/list[1]/entry[2]',
+                            '<entry uri="sip:carol@example.com"><display-name><![CDATA[Carol <the> one]]></display-name></entry>'.encode())
+        self.assertSelected('/resource-lists/list[1]/*[3]', b'<x:note>extension</x:note>')
+        self.assertSelected('/resource-lists/*[2]', b'<list name="empty"></list>')
+        self.assertNotSelected('/resource-lists/list[1]/entry[4]')
+
+    def test_select_prefixed(self):
+        self.assertSelected('/resource-lists/list[1]/x:note', b'<x:note>extension</x:note>')
+
+    def test_select_empty(self):
+        self.assertSelected('/resource-lists/list[@name="empty"]', b'<list name="empty"></list>')
+        self.assertSelected('/resource-lists/list[@name="closed"]', b'<list name="closed"/>')
+        self.assertSelected('/resource-lists/list[1]/entry[3]', b'<entry uri="sip:dan@example.com"/>')
+
+    def test_select_commented(self):
+        self.assertNotSelected('/resource-lists/list/entry[@uri="sip:commented@example.com"]')
+
+    def test_select_many(self):
+        self.assertEqual(self.run_engines('get', '/resource-lists/list'), element.SelectorError)
+
+    def test_replace(self):
+        new_element = b'<x:note xmlns:x="urn:example:x">changed</x:note>'
+        new_document, created = self.run_engines('put', '/resource-lists/list[@name="friends"]/x:note', new_element)
+        self.assertFalse(created)
+        self.assertEqual(new_document, document.replace(b'<x:note>extension</x:note>', new_element))
+
+    def test_insert_after_siblings(self):
+        self.assertInserted('/resource-lists/list[@name="friends"]/entry[@uri="sip:new@example.com"]',
+                            b'<entry uri="sip:new@example.com"/>', b'\n  </list>\n  <list name="empty">')
+        self.assertInserted('/resource-lists/list[@name="new"]', b'<list name="new"/>', b'\n</resource-lists>')
+
+    def test_insert_by_position(self):
+        self.assertInserted('/resource-lists/list[@name="empty"]/entry[1]',
+                            b'<entry uri="sip:pos@example.com"/>', b'</list>\n  <list name="closed"/>')
+        self.assertInserted('/resource-lists/list[@name="friends"]/entry[4]',
+                            b'<entry uri="sip:pos@example.com"/>', b'\n  </list>\n  <list name="empty">')
+
+    def test_insert_star(self):
+        self.assertInserted('/resource-lists/list[@name="friends"]/*[@uri="sip:star@example.com"]',
+                            b'<entry uri="sip:star@example.com"/>', b'</list>\n  <list name="empty">')
+
+    def test_insert_into_empty(self):
+        self.assertInserted('/resource-lists/list[@name="empty"]/entry', b'<entry uri="sip:new@example.com"/>', b'</list>\n  <list name="closed"/>')
+        self.assertIsNone(self.run_engines('put', '/resource-lists/list[@name="closed"]/entry', b'<entry uri="sip:new@example.com"/>'))
+
+
+if __name__ == '__main__':
+    unittest.main()
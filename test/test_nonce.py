@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2007-2025 AG-Projects.
+#
+
+import base64
+import time
+import unittest
+import os
+import sys
+from unittest import mock
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from xcap.authentication.nonce import NONCE_COUNT_WINDOW, NonceStatus, StatelessNonces, _record_count
+
+
+class RecordCountTest(unittest.TestCase):
+
+    def record(self, *ncs):
+        """Record the nonce counts in order, return the counts after the last one"""
+        counts = None
+        for nc in ncs:
+            counts = _record_count(counts, '%08x' % nc)
+            self.assertIsNotNone(counts, 'nonce count %d was refused' % nc)
+        return counts
+
+    def test_increasing(self):
+        self.assertEqual(self.record(1, 2, 3), [3, 0b111])
+
+    def test_replayed(self):
+        counts = self.record(1, 2, 3)
+        for nc in (1, 2, 3):
+            self.assertIsNone(_record_count(counts, '%08x' % nc))
+
+    def test_out_of_order(self):
+        counts = self.record(5, 3, 1)
+        self.assertEqual(counts, [5, 0b10101])
+        self.assertEqual(_record_count(counts, '00000004'), [5, 0b10111])
+        self.assertIsNone(_record_count(counts, '00000003'))
+
+    def test_out_of_window(self):
+        counts = self.record(NONCE_COUNT_WINDOW + 1)
+        self.assertIsNone(_record_count(counts, '00000001'))
+        self.assertEqual(_record_count(counts, '00000002'), [NONCE_COUNT_WINDOW + 1, 1 | 1 << (NONCE_COUNT_WINDOW - 1)])
+
+    def test_window_shift(self):
+        counts = self.record(1, 2, 3)
+        # a jump within the window keeps the counts seen
+        shifted = _record_count(counts, '%08x' % (3 + NONCE_COUNT_WINDOW - 1))
+        self.assertEqual(shifted, [3 + NONCE_COUNT_WINDOW - 1, 1 | 1 << (NONCE_COUNT_WINDOW - 1)])
+        self.assertIsNone(_record_count(shifted, '00000003'))
+        self.assertIsNone(_record_count(shifted, '00000002'))
+        self.assertIsNotNone(_record_count(shifted, '00000004'))
+        # a jump past the window forgets them, the ones below the window are refused
+        jumped = _record_count(counts, '%08x' % (3 + NONCE_COUNT_WINDOW + 5))
+        self.assertEqual(jumped, [3 + NONCE_COUNT_WINDOW + 5, 1])
+        self.assertIsNone(_record_count(jumped, '00000003'))
+        self.assertIsNone(_record_count(jumped, '00000004'))
+        self.assertIsNotNone(_record_count(jumped, '%08x' % (3 + NONCE_COUNT_WINDOW + 4)))
+
+    def test_invalid(self):
+        self.assertIsNone(_record_count(None, '00000000'))
+        self.assertIsNone(_record_count(None, 'not-hex'))
+
+
+class StatelessNoncesTest(unittest.TestCase):
+
+    realm = 'example.com'
+
+    def setUp(self):
+        self.nonces = StatelessNonces(60, secret='a secret which is used by the tests')
+
+    def test_valid(self):
+        nonce = self.nonces.generate(self.realm)
+        self.assertEqual(self.nonces.check(nonce, self.realm), NonceStatus.valid)
+        self.assertTrue(self.nonces.use(nonce, '00000001'))
+        self.assertFalse(self.nonces.use(nonce, '00000001'))
+        self.assertTrue(self.nonces.use(nonce, '00000002'))
+
+    def test_expired(self):
+        nonce = self.nonces.generate(self.realm)
+        with mock.patch('time.time', return_value=time.time() + 61):
+            self.assertEqual(self.nonces.check(nonce, self.realm), NonceStatus.stale)
+            self.assertLessEqual(self.nonces.remaining(nonce), 0)
+
+    def test_issued_in_the_future(self):
+        with mock.patch('time.time', return_value=time.time() + 10):
+            nonce = self.nonces.generate(self.realm)
+        self.assertEqual(self.nonces.check(nonce, self.realm), NonceStatus.stale)
+
+    def test_other_realm(self):
+        nonce = self.nonces.generate(self.realm)
+        self.assertEqual(self.nonces.check(nonce, 'example.org'), NonceStatus.invalid)
+
+    def test_other_secret(self):
+        nonce = StatelessNonces(60, secret='another secret').generate(self.realm)
+        self.assertEqual(self.nonces.check(nonce, self.realm), NonceStatus.invalid)
+
+    def test_forged(self):
+        nonce = self.nonces.generate(self.realm)
+        value = bytearray(base64.urlsafe_b64decode(nonce + '=' * (-len(nonce) % 4)))
+        # move the time it was issued forward, keeping the signature
+        value[7] ^= 1
+        forged = base64.urlsafe_b64encode(bytes(value)).decode().rstrip('=')
+        self.assertEqual(self.nonces.check(forged, self.realm), NonceStatus.invalid)
+        for forged in ('', 'not a nonce', nonce[:-4], nonce + 'AAAA'):
+            self.assertEqual(self.nonces.check(forged, self.realm), NonceStatus.invalid)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,336 @@
+"""Bulk export and import of XCAP documents, used by openxcap-admin
+
+The documents are exchanged as an archive with one JSON object per line:
+
+    {"username": "alice", "domain": "example.com", "application": "pres-rules",
+     "path": "index.xml", "etag": "...", "document": "<?xml ..."}
+
+Documents which are not valid UTF-8 are base64 encoded and have an
+"encoding": "base64" member. Archives whose name ends in .gz are compressed.
+
+The documents are read from and written to the xcap table of the Database and
+OpenSIPS backends, or to the profiles of the SIP accounts of the SIPThor
+backend, in batches. When importing, the documents can be validated by their
+application usage in a pool of processes, while the previous batch is stored.
+The copies of the imported documents cached by the workers of a server
+running on this host with several worker processes are invalidated.
+"""
+
+import asyncio
+import base64
+import gzip
+import io
+import json
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from multiprocessing import get_context
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+from application.process import process
+from sqlalchemy import and_, or_
+from sqlmodel import select
+
+from xcap.configuration import PROCESS_ENVIRONMENT, ServerConfig
+from xcap.db.manager import get_db_session
+from xcap.db.models import XCAP, SipAccount
+from xcap.sharedstate import ChangeLog, SQLiteState, multiprocess
+
+__all__ = ['export_documents', 'import_documents', 'XCAPTableStore', 'ProfileStore']
+
+
+Record = Dict[str, Any]
+
+
+def open_archive(path: str, mode: str) -> TextIO:
+    """Open an archive for reading ('r') or writing ('w'), '-' being the standard input or output"""
+    if path == '-':
+        return sys.stdin if mode == 'r' else sys.stdout
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(path, mode + 'b'), encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def make_record(username: str, domain: str, application: str, path: str, etag: str, document: Any) -> Record:
+    if isinstance(document, str):
+        document = document.encode('utf-8')
+    record = dict(username=username, domain=domain, application=application, path=path, etag=etag)
+    try:
+        record['document'] = document.decode('utf-8')
+    except UnicodeDecodeError:
+        record['document'] = base64.b64encode(document).decode('ascii')
+        record['encoding'] = 'base64'
+    return record
+
+
+def record_document(record: Record) -> bytes:
+    if record.get('encoding') == 'base64':
+        return base64.b64decode(record['document'])
+    return record['document'].encode('utf-8')
+
+
+def read_archive(archive: TextIO) -> Iterator[Record]:
+    for number, line in enumerate(archive, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            for name in ('username', 'domain', 'application', 'path', 'etag', 'document'):
+                if not isinstance(record.get(name), str):
+                    raise ValueError('missing %s' % name)
+        except ValueError as e:
+            raise ValueError('invalid record on line %d: %s' % (number, e))
+        yield record
+
+
+def batches(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Progress(object):
+    """Report the number of documents processed and the throughput on the standard error"""
+
+    interval = 5
+
+    def __init__(self, operation: str, output: TextIO = sys.stderr):
+        self.operation = operation
+        self.output = output
+        self.start = self.last_report = time.monotonic()
+        self.count = 0
+        self.counters: Counter = Counter()
+
+    def update(self, count: int, **counters: int) -> None:
+        self.count += count
+        self.counters.update(counters)
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report()
+
+    def report(self) -> None:
+        elapsed = time.monotonic() - self.start
+        rate = self.count / elapsed if elapsed else 0
+        counters = ''.join(', %d %s' % (value, name.replace('_', ' ')) for name, value in sorted(self.counters.items()) if value)
+        print('%s %d documents in %.1f seconds (%.0f documents/s)%s' % (self.operation, self.count, elapsed, rate, counters), file=self.output)
+
+
+def invalidate_cached(name: str, keys: Iterable[Any]) -> None:
+    """Make the workers of a server running on this host read the given keys
+    of one of their coherent caches again from the database"""
+    if not multiprocess() or not os.path.exists(process.runtime.file(SQLiteState.filename)):
+        return
+    change_log = ChangeLog()
+    for key in keys:
+        change_log.remove(name, key)
+
+
+def validate_records(records: List[Record]) -> List[Optional[str]]:
+    """Return the reason each document is not valid for its application, None for the valid ones"""
+    from xcap.appusage import applications
+    from xcap.errors import XCAPError
+
+    results: List[Optional[str]] = []
+    for record in records:
+        application = applications.get(record['application'])
+        if application is None:
+            results.append('unknown application')
+            continue
+        try:
+            application.validate_document(record_document(record))
+        except XCAPError as e:
+            results.append(e.tag + (': %s' % e.phrase if e.phrase else ''))
+        except Exception as e:
+            results.append(str(e) or e.__class__.__name__)
+        else:
+            results.append(None)
+    return results
+
+
+class XCAPTableStore(object):
+    """The documents of the Database and OpenSIPS backends, in the xcap table"""
+
+    def __init__(self):
+        from xcap.backend.database import DatabaseStorage
+        self.doc_types = DatabaseStorage.app_mapping
+        self.applications = dict((doc_type, application) for application, doc_type in self.doc_types.items())
+
+    async def export(self, batch_size: int, domain: Optional[str] = None, application: Optional[str] = None) -> AsyncIterator[Record]:
+        conditions = []
+        if domain is not None:
+            conditions.append(XCAP.domain == domain)
+        if application is not None:
+            conditions.append(XCAP.doc_type == self.doc_types[application])
+        last_id = 0
+        while True:
+            async with get_db_session() as db_session:
+                result = await db_session.execute(select(XCAP.id, XCAP.username, XCAP.domain, XCAP.doc_type, XCAP.doc_uri, XCAP.etag, XCAP.doc)
+                                                  .where(XCAP.id > last_id, *conditions).order_by(XCAP.id).limit(batch_size))
+                rows = result.all()
+            if not rows:
+                return
+            for id, username, domain, doc_type, doc_uri, etag, doc in rows:
+                if doc_type in self.applications:
+                    yield make_record(username, domain, self.applications[doc_type], doc_uri, etag, doc)
+            last_id = rows[-1][0]
+
+    def _insert_statement(self, dialect: str, replace: bool):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+            statement = insert(XCAP.__table__)
+            key = ['username', 'domain', 'doc_type', 'doc_uri']
+            if replace:
+                return statement.on_conflict_do_update(index_elements=key, set_=dict(doc=statement.excluded.doc, etag=statement.excluded.etag))
+            return statement.on_conflict_do_nothing(index_elements=key)
+        elif dialect == 'mysql':
+            from sqlalchemy.dialects.mysql import insert
+            statement = insert(XCAP.__table__)
+            if replace:
+                return statement.on_duplicate_key_update(doc=statement.inserted.doc, etag=statement.inserted.etag)
+            return statement.prefix_with('IGNORE')
+        raise ValueError('Unsupported database: %s' % dialect)
+
+    async def store(self, records: List[Record], replace: bool = True) -> Dict[str, int]:
+        rows = []
+        unknown = 0
+        for record in records:
+            doc_type = self.doc_types.get(record['application'])
+            if doc_type is None:
+                unknown += 1
+                continue
+            rows.append(dict(username=record['username'], domain=record['domain'], doc_type=doc_type, doc_uri=record['path'],
+                             etag=record['etag'], doc=record_document(record), source=0, port=0))
+        if rows:
+            async with get_db_session() as db_session:
+                await db_session.execute(self._insert_statement(db_session.get_bind().dialect.name, replace), rows)
+                await db_session.commit()
+            invalidate_cached('documents', ((row['username'], row['domain'], row['doc_type'], row['doc_uri']) for row in rows))
+        return dict(written=len(rows), unknown_application=unknown)
+
+
+class ProfileStore(object):
+    """The documents of the SIPThor backend, in the profiles of the SIP accounts"""
+
+    async def export(self, batch_size: int, domain: Optional[str] = None, application: Optional[str] = None) -> AsyncIterator[Record]:
+        conditions = [SipAccount.domain == domain] if domain is not None else []
+        last_id = 0
+        while True:
+            async with get_db_session() as db_session:
+                result = await db_session.execute(select(SipAccount).where(SipAccount.id > last_id, *conditions).order_by(SipAccount.id).limit(batch_size))
+                accounts = result.scalars().unique().all()
+            if not accounts:
+                return
+            for account in accounts:
+                for application_id, documents in ((account.profile or {}).get('xcap') or {}).items():
+                    if application is not None and application_id != application:
+                        continue
+                    for path, (document, etag) in documents.items():
+                        yield make_record(account.username, account.domain, application_id, path, etag, document)
+            last_id = accounts[-1].id
+
+    async def store(self, records: List[Record], replace: bool = True) -> Dict[str, int]:
+        documents: Dict[Tuple[str, str], List[Record]] = defaultdict(list)
+        for record in records:
+            documents[record['username'], record['domain']].append(record)
+        stored = existing = 0
+        stored_accounts = []
+        async with get_db_session() as db_session:
+            result = await db_session.execute(select(SipAccount).where(or_(*(and_(SipAccount.username == username, SipAccount.domain == domain) for username, domain in documents))))
+            for account in result.scalars().unique().all():
+                profile = dict(account.profile or {})
+                xcap_documents = profile.setdefault('xcap', {})
+                for record in documents.pop((account.username, account.domain), []):
+                    application_documents = xcap_documents.setdefault(record['application'], {})
+                    if not replace and record['path'] in application_documents:
+                        existing += 1
+                        continue
+                    application_documents[record['path']] = (record_document(record).decode('utf-8'), record['etag'])
+                    stored += 1
+                account.set_profile(profile)
+                stored_accounts.append((account.username, account.domain))
+            await db_session.commit()
+        invalidate_cached('profiles', stored_accounts)
+        return dict(stored=stored, existing=existing, unknown_account=sum(len(records) for records in documents.values()))
+
+
+def document_store():
+    return ProfileStore() if ServerConfig.backend == 'SIPThor' else XCAPTableStore()
+
+
+async def export_documents(path: str, batch_size: int = 1000, domain: Optional[str] = None, application: Optional[str] = None) -> int:
+    store = document_store()
+    progress = Progress('Exported')
+    archive = open_archive(path, 'w')
+    try:
+        async for record in store.export(batch_size, domain, application):
+            archive.write(json.dumps(record, separators=(',', ':')) + '\n')
+            progress.update(1)
+    finally:
+        if archive is not sys.stdout:
+            archive.close()
+        else:
+            archive.flush()
+    progress.report()
+    return progress.count
+
+
+async def import_documents(path: str, batch_size: int = 1000, replace: bool = True, validate: bool = False, jobs: Optional[int] = None) -> int:
+    store = document_store()
+    progress = Progress('Imported')
+    loop = asyncio.get_running_loop()
+
+    pool = None
+    workers = jobs or os.cpu_count() or 1
+    if validate:
+        # the workers find the configuration the same way as the server workers
+        os.environ[PROCESS_ENVIRONMENT] = json.dumps({'system': process.configuration.system_directory,
+                                                      'user': process.configuration.user_directory,
+                                                      'local': process.configuration.local_directory,
+                                                      'runtime': process.runtime.directory})
+        pool = ProcessPoolExecutor(workers, mp_context=get_context('spawn'))
+
+    async def validated(records: List[Record]) -> List[Record]:
+        if pool is None:
+            return records
+        chunk_size = max(len(records) // workers, 1)
+        chunks = list(batches(records, chunk_size))
+        results = await asyncio.gather(*(loop.run_in_executor(pool, validate_records, chunk) for chunk in chunks))
+        valid = []
+        for chunk, reasons in zip(chunks, results):
+            for record, reason in zip(chunk, reasons):
+                if reason is None:
+                    valid.append(record)
+                else:
+                    print('Invalid %s document %s of %s@%s: %s' % (record['application'], record['path'], record['username'], record['domain'], reason), file=sys.stderr)
+        return valid
+
+    async def store_batch(records: List[Record], validation: 'asyncio.Future[List[Record]]') -> None:
+        valid = await validation
+        counters = await store.store(valid, replace)
+        progress.update(len(records), invalid=len(records) - len(valid), **counters)
+
+    archive = open_archive(path, 'r')
+    try:
+        # the next batch is validated while the previous one is stored
+        pending = None
+        for records in batches(read_archive(archive), batch_size):
+            validation = asyncio.ensure_future(validated(records))
+            if pending is not None:
+                await store_batch(*pending)
+            pending = records, validation
+        if pending is not None:
+            await store_batch(*pending)
+    finally:
+        if archive is not sys.stdin:
+            archive.close()
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    progress.report()
+    return progress.count
@@ -1,25 +1,37 @@
 
 """XCAP application usage module"""
 
+import asyncio
 import os
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from copy import deepcopy
 from io import BytesIO
 
 from application import log
 from application.configuration import ConfigSetting
 from application.configuration.datatypes import StringList
+from fastapi.responses import PlainTextResponse
 from lxml import etree
 
 from xcap import element, errors
-from xcap.backend import StatusResponse
+from xcap.backend import DocumentChanged, StatusResponse
+from xcap.cache import Cache
+from xcap.configuration import CacheConfig
 from xcap.configuration import ServerConfig as XCAPServerConfig
-from xcap.configuration.datatypes import Backend
+from xcap.configuration.datatypes import Backend, ElementEngine
 
 
 class ServerConfig(XCAPServerConfig):
     backend = ConfigSetting(type=Backend, value=None)
     disabled_applications = ConfigSetting(type=StringList, value=[])
     document_validation = True
+    validation_threads = 4
+    validation_offload_size = 65536
+    element_engine = ConfigSetting(type=ElementEngine, value=element)
 
 
 if ServerConfig.backend is None:
@@ -27,28 +39,188 @@ if ServerConfig.backend is None:
     sys.exit(1)
 
 
+# maps the ETag of a stored document to its parsed XML tree. The trees are
+# shared by all requests and must not be modified
+parsed_documents = Cache(CacheConfig.parsed_document_cache_size, CacheConfig.parsed_document_cache_ttl)
+
+
+class ValidationStats(object):
+    """Number of runs and total time spent in each stage of the document validation"""
+
+    stages = ('parse', 'encoding', 'schema', 'constraints')
+
+    def __init__(self):
+        self.counts = dict.fromkeys(self.stages, 0)
+        self.times = dict.fromkeys(self.stages, 0.0)
+        self._lock = threading.Lock()  # documents are also validated in the validation threads
+
+    @contextmanager
+    def stage(self, name, timings):
+        """Time a validation stage, recording its duration in timings"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            timings[name] = elapsed
+            with self._lock:
+                self.counts[name] += 1
+                self.times[name] += elapsed
+
+    @property
+    def stats(self):
+        return dict((name, {'count': self.counts[name], 'time': self.times[name], 'average': self.times[name] / self.counts[name] if self.counts[name] else 0.0}) for name in self.stages)
+
+
+class ValidationExecutor(object):
+    """Validates the documents of at least offload_size bytes in a pool of
+    threads, so that large documents do not block the event loop while they
+    are parsed and validated. lxml releases the GIL for most of this work, so
+    the threads run along with the requests served by the event loop."""
+
+    def __init__(self, threads, offload_size):
+        self.threads = threads
+        self.offload_size = offload_size
+        self._executor = None
+        self.inline = 0
+        self.offloaded = 0
+        self.pending = 0
+        self.max_pending = 0
+        self.queue_time = 0.0
+        self.max_queue_time = 0.0
+
+    def offload(self, size):
+        return self.threads > 0 and size >= self.offload_size
+
+    @staticmethod
+    def _run(started, function, args):
+        started.append(time.perf_counter())
+        return function(*args)
+
+    async def run(self, function, *args):
+        """Run function in one of the validation threads"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix='validation')
+        self.offloaded += 1
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        # the time the function started is recorded by the thread, the statistics are only updated here
+        started = []
+        submitted = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, self._run, started, function, args)
+        finally:
+            self.pending -= 1
+            if started:
+                queue_time = started[0] - submitted
+                self.queue_time += queue_time
+                self.max_queue_time = max(self.max_queue_time, queue_time)
+
+    @property
+    def stats(self):
+        return {'threads': self.threads,
+                'offload_size': self.offload_size,
+                'inline': self.inline,
+                'offloaded': self.offloaded,
+                'pending': self.pending,
+                'queued': max(self.pending - self.threads, 0),
+                'max_pending': self.max_pending,
+                'queue_time': self.queue_time,
+                'max_queue_time': self.max_queue_time,
+                'average_queue_time': self.queue_time / self.offloaded if self.offloaded else 0.0}
+
+
+validation_executor = ValidationExecutor(ServerConfig.validation_threads, ServerConfig.validation_offload_size)
+
+
+class EverythingIsValid(object):
+    def __call__(self, *args, **kw):
+        return True
+
+    def validate(self, *args, **kw):
+        return True
+
+
+everything_is_valid = EverythingIsValid()
+
+
+class SchemaCache(object):
+    """The XML schemas of the application usages, compiled once per schema
+       file when they are first needed, or when warmed up after the server
+       started. A compiled schema keeps the errors of the last validation,
+       so the validation threads compile their own copy."""
+
+    directory = os.path.join(os.path.dirname(__file__), 'xml-schemas')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._documents = {}
+        self._schemas = {}
+        self._thread_schemas = threading.local()
+        self.compiled = 0
+        self.compile_time = 0
+
+    def _compile(self, schema_file):
+        with self._lock:
+            document = self._documents.get(schema_file)
+            if document is None:
+                with open(os.path.join(self.directory, schema_file), 'rb') as f:
+                    document = self._documents[schema_file] = etree.parse(f)
+        start = time.perf_counter()
+        schema = etree.XMLSchema(document)
+        with self._lock:
+            self.compiled += 1
+            self.compile_time += time.perf_counter() - start
+        return schema
+
+    def get(self, schema_file):
+        """Return the compiled schema for the current thread"""
+        if threading.current_thread() is threading.main_thread():
+            schemas = self._schemas
+        else:
+            schemas = getattr(self._thread_schemas, 'schemas', None)
+            if schemas is None:
+                schemas = self._thread_schemas.schemas = {}
+        schema = schemas.get(schema_file)
+        if schema is None:
+            schema = schemas[schema_file] = self._compile(schema_file)
+        return schema
+
+    async def warm_up(self, schema_files):
+        """Compile the schemas which were not used yet, one per iteration of
+           the event loop so the requests are not held up"""
+        for schema_file in sorted(set(schema_files)):
+            self.get(schema_file)
+            await asyncio.sleep(0)
+        log.debug('Compiled %d XML schemas in %.1f ms' % (self.compiled, self.compile_time * 1000))
+
+    @property
+    def stats(self):
+        return {'compiled': self.compiled, 'compile_time': round(self.compile_time, 6)}
+
+
+xml_schemas = SchemaCache()
+
+
 class ApplicationUsage(object):
     """Base class defining an XCAP application"""
     id = None                ## the Application Unique ID (AUID)
     default_ns = None        ## the default XML namespace
     mime_type = None         ## the MIME type
     schema_file = None       ## filename of the schema for the application
+    change_attempts = 3      ## times an element or attribute change is made when the document is modified concurrently
 
     def __init__(self, storage):
-        ## the XML schema that defines valid documents for this application
-        if self.schema_file:
-            xml_schema_doc = etree.parse(open(os.path.join(os.path.dirname(__file__), 'xml-schemas', self.schema_file), 'r'))
-            self.xml_schema = etree.XMLSchema(xml_schema_doc)
-        else:
-            class EverythingIsValid(object):
-                def __call__(self, *args, **kw):
-                    return True
-
-                def validate(self, *args, **kw):
-                    return True
-            self.xml_schema = EverythingIsValid()
         if storage is not None:
             self.storage = storage
+        self.validation_stats = ValidationStats()
+
+    @property
+    def xml_schema(self):
+        """The XML schema that defines valid documents for this application"""
+        if self.schema_file is None:
+            return everything_is_valid
+        return xml_schemas.get(self.schema_file)
 
     ## Validation
 
@@ -59,27 +231,70 @@ class ApplicationUsage(object):
 
     def _check_schema_validation(self, xml_doc):
         """Check if the given XCAP document validates against the application's schema"""
-        if not self.xml_schema(xml_doc):
-            raise errors.SchemaValidationError(comment=self.xml_schema.error_log)
+        xml_schema = self.xml_schema
+        if not xml_schema(xml_doc):
+            raise errors.SchemaValidationError(comment=xml_schema.error_log)
 
     def _check_additional_constraints(self, xml_doc):
         """Check additional validations constraints for this XCAP document. Should be
            overriden in subclasses if specified by the application usage, and raise
            a ConstraintFailureError if needed."""
 
-    def validate_document(self, xcap_doc):
-        """Check if a document is valid for this application."""
-        try:
-            xml_doc = etree.parse(BytesIO(xcap_doc))
-            # XXX do not use TreeBuilder here
-        except etree.XMLSyntaxError as e:
-            raise errors.NotWellFormedError(comment=str(e))
-        except Exception as ex:
-            raise errors.NotWellFormedError()
-        self._check_UTF8_encoding(xml_doc)
+    def _check_uri_constraints(self, xml_doc, node_uri):
+        """Check the constraints of this XCAP document which depend on the URI
+           it is stored at. Should be overriden in subclasses if specified by
+           the application usage, and raise a ConstraintFailureError if needed."""
+
+    def validate_document(self, xcap_doc, xml_doc=None, node_uri=None):
+        """Check if a document is valid for this application and return its
+           parsed XML tree. The document is parsed once and the same tree goes
+           through the encoding check, the schema validation and the
+           constraints checks. If the caller already has the tree of the
+           document it can pass it in xml_doc, in which case the document is
+           not parsed again. The URI dependent constraints are only checked if
+           node_uri is given."""
+        stats = self.validation_stats
+        timings = {}
+        if xml_doc is None:
+            with stats.stage('parse', timings):
+                try:
+                    xml_doc = etree.parse(BytesIO(xcap_doc))
+                    # XXX do not use TreeBuilder here
+                except etree.XMLSyntaxError as e:
+                    raise errors.NotWellFormedError(comment=str(e))
+                except Exception as ex:
+                    raise errors.NotWellFormedError()
+        with stats.stage('encoding', timings):
+            self._check_UTF8_encoding(xml_doc)
         if ServerConfig.document_validation:
-            self._check_schema_validation(xml_doc)
-        self._check_additional_constraints(xml_doc)
+            with stats.stage('schema', timings):
+                self._check_schema_validation(xml_doc)
+        with stats.stage('constraints', timings):
+            self._check_additional_constraints(xml_doc)
+            if node_uri is not None:
+                self._check_uri_constraints(xml_doc, node_uri)
+        if log.get_logger().isEnabledFor(log.level.DEBUG):
+            log.debug('Validated %s document of %d bytes in %.2f ms (%s)' % (self.id, len(xcap_doc), sum(timings.values()) * 1000, ', '.join('%s %.2f ms' % (name, timings[name] * 1000) for name in ValidationStats.stages if name in timings)))
+        return xml_doc
+
+    async def validate(self, xcap_doc, xml_doc=None, node_uri=None):
+        """Validate a document like validate_document, in the validation
+           threads if it is large"""
+        if validation_executor.offload(len(xcap_doc)):
+            return await validation_executor.run(self.validate_document, xcap_doc, xml_doc, node_uri)
+        validation_executor.inline += 1
+        return self.validate_document(xcap_doc, xml_doc, node_uri)
+
+    def _parse_stored_document(self, response):
+        """Return the parsed XML tree of a document retrieved from the storage.
+           The tree is shared through a cache keyed by the ETag of the document
+           and must be copied before being modified."""
+        xml_doc = parsed_documents.get(response.etag) if response.etag else None
+        if xml_doc is None:
+            xml_doc = etree.parse(BytesIO(response.data))
+            if response.etag:
+                parsed_documents.set(response.etag, xml_doc)
+        return xml_doc
 
     ## Authorization policy
 
@@ -108,15 +323,42 @@ class ApplicationUsage(object):
     async def get_document_local(self, uri, check_etag):
         return await self.storage.get_document(uri, check_etag)
 
-    async def put_document(self, uri, document, check_etag):
-        self.validate_document(document)
-        return await self.storage.put_document(uri, document, check_etag)
+    async def put_document(self, uri, document, check_etag, xml_doc=None, base_etag=None):
+        xml_doc = await self.validate(document, xml_doc, uri)
+        return await self._store_document(uri, document, check_etag, xml_doc, base_etag)
+
+    async def _store_document(self, uri, document, check_etag, xml_doc=None, base_etag=None):
+        """Store a validated document. Its parsed XML tree, if given, is cached
+           for the subsequent requests on the new version of the document.
+           base_etag is the ETag of the version the document was made from."""
+        result = await self.storage.put_document(uri, document, check_etag, base_etag=base_etag)
+        if xml_doc is not None and result is not None and result.succeed and result.etag:
+            parsed_documents.set(result.etag, xml_doc)
+        return result
 
     async def delete_document(self, uri, check_etag):
         return await self.storage.delete_document(uri, check_etag)
 
+    async def _change_document(self, uri, check_etag, change, *args):
+        """Apply change to the stored document and store the result. If the
+           document is modified by another request in the meantime, the change
+           is made again on the new version."""
+        for attempt in range(self.change_attempts):
+            response = await self.get_document(uri, check_etag)
+            try:
+                return await change(response, uri, *args, check_etag)
+            except DocumentChanged:
+                pass
+        raise errors.HTTPError(PlainTextResponse('The document was modified by concurrent requests', status_code=409))
+
     ## Element management
 
+    def _element_tree(self, response):
+        """Return the parsed XML tree of a stored document if the element engine can use it"""
+        if ServerConfig.element_engine.tree_based:
+            return self._parse_stored_document(response)
+        return None
+
     async def _cb_put_element(self, response, uri, element_body, check_etag):
         """This is called when the document that relates to the element is retrieved."""
         if response.code == 404:          ### XXX let the storate raise
@@ -125,7 +367,7 @@ class ApplicationUsage(object):
         fixed_element_selector = uri.node_selector.element_selector.fix_star(element_body)
 
         try:
-            result = element.put(response.data, fixed_element_selector, element_body)
+            result = ServerConfig.element_engine.put(response.data, fixed_element_selector, element_body, self._element_tree(response))
         except element.SelectorError as ex:
             raise errors.NoParentError(comment=str(ex))
 
@@ -133,12 +375,12 @@ class ApplicationUsage(object):
             raise errors.NoParentError
 
         new_document, created = result
-        get_result = element.get(new_document, uri.node_selector.element_selector)
+        get_result = ServerConfig.element_engine.get(new_document, uri.node_selector.element_selector)
 
         if get_result != element_body.strip():
             raise errors.CannotInsertError('PUT request failed GET(PUT(x))==x invariant')
 
-        d = await self.put_document(uri, new_document, check_etag)
+        d = await self.put_document(uri, new_document, check_etag, base_etag=response.etag)
 
         def set_201_code(response):
             try:
@@ -160,14 +402,13 @@ class ApplicationUsage(object):
             raise errors.NotXMLFragmentError(comment=str(ex))
         except Exception as ex:
             raise errors.NotXMLFragmentError()
-        d = await self.get_document(uri, check_etag)
-        return await self._cb_put_element(d, uri, element_body, check_etag)
+        return await self._change_document(uri, check_etag, self._cb_put_element, element_body)
 
     def _cb_get_element(self, response, uri):
         """This is called when the document related to the element is retrieved."""
         if response.code == 404:     ## XXX why not let the storage raise?
             raise errors.ResourceNotFound("The requested document %s was not found on this server" % uri.doc_selector)
-        result = element.get(response.data, uri.node_selector.element_selector)
+        result = ServerConfig.element_engine.get(response.data, uri.node_selector.element_selector, self._element_tree(response))
         if not result:
             msg = "The requested element %s was not found in the document %s" % (uri.node_selector, uri.doc_selector)
             raise errors.ResourceNotFound(msg)
@@ -180,25 +421,23 @@ class ApplicationUsage(object):
     async def _cb_delete_element(self, response, uri, check_etag):
         if response.code == 404:
             raise errors.ResourceNotFound("The requested document %s was not found on this server" % uri.doc_selector)
-        new_document = element.delete(response.data, uri.node_selector.element_selector)
+        new_document = ServerConfig.element_engine.delete(response.data, uri.node_selector.element_selector, self._element_tree(response))
         if not new_document:
             raise errors.ResourceNotFound
-        get_result = element.find(new_document, uri.node_selector.element_selector)
+        get_result = ServerConfig.element_engine.find(new_document, uri.node_selector.element_selector)
         if get_result:
             raise errors.CannotDeleteError('DELETE request failed GET(DELETE(x))==404 invariant')
-        return await self.put_document(uri, new_document, check_etag)
+        return await self.put_document(uri, new_document, check_etag, base_etag=response.etag)
 
     async def delete_element(self, uri, check_etag):
-        d = await self.get_document(uri, check_etag)
-        return await self._cb_delete_element(d, uri, check_etag)
+        return await self._change_document(uri, check_etag, self._cb_delete_element)
 
     ## Attribute management
     def _cb_get_attribute(self, response, uri):
         """This is called when the document that relates to the attribute is retrieved."""
         if response.code == 404:
             raise errors.ResourceNotFound
-        document = response.data
-        xml_doc = etree.parse(BytesIO(document))
+        xml_doc = self._parse_stored_document(response)
         application = getApplicationForURI(uri)
         ns_dict = uri.node_selector.get_ns_bindings(application.default_ns)
         try:
@@ -222,8 +461,7 @@ class ApplicationUsage(object):
     async def _cb_delete_attribute(self, response, uri, check_etag):
         if response.code == 404:
             raise errors.ResourceNotFound
-        document = response.data
-        xml_doc = etree.parse(BytesIO(document))
+        xml_doc = deepcopy(self._parse_stored_document(response))
         application = getApplicationForURI(uri)
         ns_dict = uri.node_selector.get_ns_bindings(application.default_ns)
         try:
@@ -241,18 +479,16 @@ class ApplicationUsage(object):
         else:
             raise errors.ResourceNotFound
         new_document = etree.tostring(xml_doc, encoding='UTF-8', xml_declaration=True)
-        return await self.put_document(uri, new_document, check_etag)
+        return await self.put_document(uri, new_document, check_etag, xml_doc, base_etag=response.etag)
 
     async def delete_attribute(self, uri, check_etag):
-        d = await self.get_document(uri, check_etag)
-        return await self._cb_delete_attribute(d, uri, check_etag)
+        return await self._change_document(uri, check_etag, self._cb_delete_attribute)
 
     async def _cb_put_attribute(self, response, uri, attribute, check_etag):
         """This is called when the document that relates to the element is retrieved."""
         if response.code == 404:
             raise errors.NoParentError
-        document = response.data
-        xml_doc = etree.parse(BytesIO(document))
+        xml_doc = deepcopy(self._parse_stored_document(response))
         application = getApplicationForURI(uri)
         ns_dict = uri.node_selector.get_ns_bindings(application.default_ns)
         try:
@@ -267,20 +503,18 @@ class ApplicationUsage(object):
         attr_name = uri.node_selector.terminal_selector.attribute
         elem.set(attr_name, attribute)
         new_document = etree.tostring(xml_doc, encoding='UTF-8', xml_declaration=True)
-        return await self.put_document(uri, new_document, check_etag)
+        return await self.put_document(uri, new_document, check_etag, xml_doc, base_etag=response.etag)
 
     async def put_attribute(self, uri, attribute, check_etag):
         ## TODO verify if the attribute is valid
-        d = await self.get_document(uri, check_etag)
-        return await self._cb_put_attribute(d, uri, attribute, check_etag)
+        return await self._change_document(uri, check_etag, self._cb_put_attribute, attribute)
 
     ## Namespace Bindings
     def _cb_get_ns_bindings(self, response, uri):
         """This is called when the document that relates to the element is retrieved."""
         if response.code == 404:
             raise errors.ResourceNotFound
-        document = response.data
-        xml_doc = etree.parse(BytesIO(document))
+        xml_doc = self._parse_stored_document(response)
         application = getApplicationForURI(uri)
         ns_dict = uri.node_selector.get_ns_bindings(application.default_ns)
         try:
@@ -317,11 +551,14 @@ from xcap.appusage.watchers import WatchersApplication
 
 storage = ServerConfig.backend.Storage()
 
+# the IETF and OMA pres-rules share the same application usage
+presence_rules = PresenceRulesApplication(storage)
+
 applications = {
                 DialogRulesApplication.id:          DialogRulesApplication(storage),
                 PIDFManipulationApplication.id:     PIDFManipulationApplication(storage),
-                PresenceRulesApplication.id:        PresenceRulesApplication(storage),
-                PresenceRulesApplication.oma_id:    PresenceRulesApplication(storage),
+                PresenceRulesApplication.id:        presence_rules,
+                PresenceRulesApplication.oma_id:    presence_rules,
                 PurgeApplication.id:                PurgeApplication(storage),
                 ResourceListsApplication.id:        ResourceListsApplication(storage),
                 RLSServicesApplication.id:          RLSServicesApplication(storage),
@@ -39,6 +39,6 @@ class XCAPCapabilitiesApplication(ApplicationUsage):
     def get_document_local(self, uri, check_etag):
         self._not_implemented('users')
 
-    def put_document(self, uri, document, check_etag):
+    def put_document(self, uri, document, check_etag, xml_doc=None, base_etag=None):
         raise errors.ResourceNotFound("This application does not support PUT method")
 
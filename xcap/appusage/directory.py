@@ -33,7 +33,7 @@ class XCAPDirectoryApplication(ApplicationUsage):
         docs_def.addCallback(self._docs_to_xml, uri)
         return docs_def
 
-    def put_document(self, uri, document, check_etag):
+    def put_document(self, uri, document, check_etag, xml_doc=None, base_etag=None):
         raise errors.ResourceNotFound("This application does not support PUT method")
 
 
@@ -42,8 +42,8 @@ class PresContentApplication(ApplicationUsage):
             if len(data) > self.icon_max_size:
                 raise errors.ConstraintFailureError(phrase="Size limit exceeded, maximum allowed size is %d bytes" % self.icon_max_size)
 
-    def put_document(self, uri, document, check_etag):
+    def put_document(self, uri, document, check_etag, xml_doc=None, base_etag=None):
         if uri.doc_selector.document_path.startswith('oma_status-icon'):
             self._validate_icon(document)
-        return self.storage.put_document(uri, document, check_etag)
+        return self.storage.put_document(uri, document, check_etag, base_etag=base_etag)
 
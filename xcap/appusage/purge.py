@@ -16,7 +16,7 @@ class PurgeApplication(ApplicationUsage):
         d.addCallback(self._purge_cb, uri)
         return d
 
-    def put_document(self, uri, document, check_etag):
+    def put_document(self, uri, document, check_etag, xml_doc=None, base_etag=None):
         raise errors.ResourceNotFound("This application does not support PUT method")
 
     def delete_document(self, uri, document, check_etag):
@@ -1,6 +1,4 @@
 
-from io import BytesIO
-from lxml import etree
 from urllib.parse import unquote
 from urllib.parse import urlparse
 
@@ -125,10 +123,7 @@ class ResourceListsApplication(ApplicationUsage):
                         else:
                             anchor_attrs.add(anchor)
 
-    def put_document(self, uri, document, check_etag):
-        self.validate_document(document)
-        # Check additional constraints (see section 3.4.5 of RFC 4826)
-        xml_doc = etree.parse(BytesIO(document))
-        self.check_list(xml_doc.getroot(), uri)
-        return self.storage.put_document(uri, document, check_etag)
+    def _check_uri_constraints(self, xml_doc, node_uri):
+        """Check additional constraints (see section 3.4.5 of RFC 4826)."""
+        self.check_list(xml_doc.getroot(), node_uri)
 
@@ -29,7 +29,7 @@ class WatchersApplication(ApplicationUsage):
         return self._watchers_to_xml(watchers_def, uri, check_etag)
         # return watchers_def
 
-    def put_document(self, uri, document, check_etag):
+    def put_document(self, uri, document, check_etag, xml_doc=None, base_etag=None):
         raise errors.ResourceNotFound("This application does not support PUT method")
 
 
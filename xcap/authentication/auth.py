@@ -1,33 +1,26 @@
 import base64
 import hashlib
-import socket
-import struct
-import threading
-import time
 from dataclasses import dataclass
-from typing import Optional
-from uuid import uuid4
+from typing import Any, Dict, Optional
 
-from cachetools import TTLCache
+from application.notification import (IObserver, Notification,
+                                      NotificationCenter)
 from fastapi import HTTPException, Request
+from zope.interface import implementer
 
 from xcap import __version__
 from xcap.appusage import ApplicationUsage
 from xcap.appusage import ServerConfig as Backend
 from xcap.appusage import (getApplicationForId, getApplicationForURI,
                            namespaces, public_get_applications)
-from xcap.configuration import AuthenticationConfig, ServerConfig
+from xcap.authentication.nonce import NonceStatus, nonce_manager
+from xcap.cache import Cache
+from xcap.configuration import AuthenticationConfig, CacheConfig, ServerConfig
 from xcap.errors import ResourceNotFound
 from xcap.http_utils import get_client_ip
 from xcap.uri import XCAPUri, XCAPUser
 from xcap.xpath import DocumentSelectorError, NodeParsingError
 
-NONCE_EXPIRATION_TIME = 900  # 15 minutes for nonce expiration
-NONCE_CACHE_MAX = 10000
-
-nonce_cache: TTLCache = TTLCache(maxsize=NONCE_CACHE_MAX, ttl=NONCE_EXPIRATION_TIME)
-nonce_cache_lock = threading.Lock()
-
 WELCOME = ('<html><head><title>Not Found</title></head>'
            '<body><h1>Not Found</h1>XCAP server does not serve anything '
            'directly under XCAP Root URL. You have to be more specific.'
@@ -125,31 +118,96 @@ class Credentials(object):
             return self.checkHash(user.ha1)
 
 
+@dataclass
+class Account:
+    """The credentials of a subscriber, as used for authentication"""
+    username: str
+    domain: str
+    password: Optional[str]
+    ha1: Optional[str]
+
+
+@implementer(IObserver)
+class CredentialCache(object):
+    """The credentials of the subscribers, read from the backend and kept for
+    a limited time, together with the subscribers that were not found.
+
+    The credentials of a subscriber must be invalidated when they change, or
+    looked up again with refresh, which is done when an authentication fails,
+    so that a new password is accepted before the cached entry expires. All the
+    entries are dropped when the backend switches to another database."""
+
+    def __init__(self, size: int, ttl: float, unknown_ttl: float):
+        self.accounts = Cache(size, ttl)
+        self.unknown = Cache(size, unknown_ttl)
+        NotificationCenter().add_observer(self, name='db_uri')
+
+    def handle_notification(self, notification: Notification) -> None:
+        self.clear()
+
+    async def lookup(self, username: str, realm: str, refresh: bool = False) -> Optional[Account]:
+        key = (username, realm)
+        if not refresh:
+            account = self.accounts.get(key)
+            if account is not None:
+                return account
+            if self.unknown.get(key) is not None:
+                return None
+        result = await Backend.backend.PasswordChecker().query_user(Credentials(username, realm=realm))
+        if not result:
+            self.accounts.invalidate(key)
+            self.unknown.set(key, True)
+            return None
+        user = result[0]
+        account = Account(getattr(user, 'username', username), getattr(user, 'domain', realm),
+                          getattr(user, 'password', None), getattr(user, 'ha1', None))
+        self.unknown.invalidate(key)
+        self.accounts.set(key, account)
+        return account
+
+    def invalidate(self, username: str, realm: str) -> None:
+        self.accounts.invalidate((username, realm))
+        self.unknown.invalidate((username, realm))
+
+    def clear(self) -> None:
+        self.accounts.clear()
+        self.unknown.clear()
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {'accounts': self.accounts.stats, 'unknown': self.unknown.stats}
+
+
+credential_cache = CredentialCache(CacheConfig.credential_cache_size, CacheConfig.credential_cache_ttl, CacheConfig.unknown_user_cache_ttl)
+
+
 class AuthenticationManager:
+    opaque = "eee38d7sacbefv2a3450ciny7QMkPqMAFRtzCUYo5tdS"
+
     def __init__(self):
-        self.nonce_cache = nonce_cache
-        self.nonce_cache_lock = nonce_cache_lock
+        self.nonces = nonce_manager
         self.trusted_peers = AuthenticationConfig.trusted_peers
 
     # Helper function to generate a nonce
-    def generate_nonce(self) -> str:
-        """Generate a new nonce (typically a random string with a timestamp)."""
-        timestamp = int(time.time())
-        unique_nonce = f"{timestamp}-{uuid4()}"
-        return base64.b64encode(unique_nonce.encode()).decode("utf-8")
+    def generate_nonce(self, realm: str) -> str:
+        """Generate a new nonce for realm."""
+        return self.nonces.generate(realm)
 
-    # Helper function to create the Digest response hash
-    async def create_digest_response(self, username: str, nonce: str, uri: str, method: str, realm: str, cnonce: str, nc: str, qop: str) -> str:
-        credentials = Credentials(username.split('@', 1)[0], realm=realm)
-        user = await Backend.backend.PasswordChecker().query_user(credentials)
+    async def digest_ha1(self, username: str, realm: str, refresh: bool = False) -> str:
+        """Return HA1, MD5(username:realm:password), for the Digest responses of username"""
+        username = username.split('@', 1)[0]
+        account = await credential_cache.lookup(username, realm, refresh)
 
-        if user is None:
+        if account is None:
             raise HTTPException(status_code=401, detail="Invalid credentials")
 
-        ha1 = user[0].ha1
         if AuthenticationConfig.cleartext_passwords:
-            credentials.password = user[0].password
-            ha1 = credentials.hash
+            return Credentials(username, account.password, realm).hash
+        return account.ha1
+
+    # Helper function to create the Digest response hash
+    async def create_digest_response(self, username: str, nonce: str, uri: str, method: str, realm: str, cnonce: str, nc: str, qop: str, refresh: bool = False) -> str:
+        ha1 = await self.digest_ha1(username, realm, refresh)
 
         # Compute the ha2 hash (method:uri)
         ha2 = hashlib.md5(f"{method}:{uri}".encode()).hexdigest()
@@ -159,31 +217,26 @@ class AuthenticationManager:
 
         return response
 
-    # Function to validate and clean up expired nonces
-    def validate_nonce(self, nonce: str) -> bool:
-        """Check if the nonce is valid and not expired."""
-        with self.nonce_cache_lock:
-            return nonce in self.nonce_cache
+    def challenge(self, realm: str, detail: str, stale: bool = False) -> HTTPException:
+        """Return the 401 response asking the client to authenticate with a new nonce"""
+        nonce = self.generate_nonce(realm)
+        www_authenticate_header = (
+            f'Digest realm="{realm}", nonce="{nonce}", opaque={self.opaque}, algorithm=MD5, qop=auth'
+        )
+        if stale:
+            www_authenticate_header += ', stale=true'
+        return HTTPException(
+            status_code=401,
+            detail=detail,
+            headers={"WWW-Authenticate": www_authenticate_header},
+        )
 
     # Digest Authentication Dependency
     async def digest_auth(self, request: Request, realm: str) -> str:
         auth_header = request.headers.get("Authorization")
 
         if not auth_header or not auth_header.startswith("Digest "):
-            nonce = self.generate_nonce()
-            opaque = "eee38d7sacbefv2a3450ciny7QMkPqMAFRtzCUYo5tdS"
-
-            with self.nonce_cache_lock:
-                self.nonce_cache[nonce] = opaque
-
-            www_authenticate_header = (
-                f'Digest realm="{realm}", nonce="{nonce}", opaque={opaque}, algorithm=MD5, qop=auth'
-            )
-            raise HTTPException(
-                status_code=401,
-                detail="Digest authentication required",
-                headers={"WWW-Authenticate": www_authenticate_header},
-            )
+            raise self.challenge(realm, "Digest authentication required")
 
         # Parse the Digest fields from the header
         try:
@@ -205,22 +258,35 @@ class AuthenticationManager:
         nc = auth_fields['nc']
         qop = auth_fields['qop']
 
-        # Use the database session to check for user
-        if not self.validate_nonce(nonce):
-            raise HTTPException(status_code=401, detail="Invalid or expired nonce")
+        status = self.nonces.check(nonce, realm)
+        if status is NonceStatus.stale:
+            raise self.challenge(realm, "Expired nonce", stale=True)
+        elif status is not NonceStatus.valid:
+            raise self.challenge(realm, "Invalid nonce")
 
         # Validate the Digest response
         expected_response = await self.create_digest_response(username, nonce, uri, method, realm, cnonce, nc, qop)
         # expected_response = self.create_digest_response(username, nonce, uri, method, db, realm)
 
         if response != expected_response:
-            raise HTTPException(status_code=401, detail="Invalid credentials or response")
-
-        with self.nonce_cache_lock:
-            try:
-                del self.nonce_cache[nonce]
-            except KeyError:
-                pass
+            # the cached credentials may be out of date
+            expected_response = await self.create_digest_response(username, nonce, uri, method, realm, cnonce, nc, qop, refresh=True)
+            if response != expected_response:
+                raise HTTPException(status_code=401, detail="Invalid credentials or response")
+
+        if not self.nonces.use(nonce, nc):
+            # a replayed request
+            raise self.challenge(realm, "Nonce already used", stale=True)
+
+        # The response authenticates the server to the client, and gives it the
+        # nonce to use for its next requests when the current one expires soon
+        rspauth = await self.create_digest_response(username, nonce, uri, '', realm, cnonce, nc, qop)
+        authentication_info = f'qop={qop}, rspauth="{rspauth}", cnonce="{cnonce}", nc={nc}'
+        if self.nonces.remaining(nonce) < self.nonces.lifetime / 4:
+            authentication_info = f'nextnonce="{self.generate_nonce(realm)}", ' + authentication_info
+        response_headers = getattr(request.state, 'response_headers', {})
+        response_headers['Authentication-Info'] = authentication_info
+        request.state.response_headers = response_headers
 
         return f'{username}@{realm}'
 
@@ -238,33 +304,22 @@ class AuthenticationManager:
         username, password = decoded_value.split(":")
         credentials = Credentials(username, password, realm)
 
-        user = await Backend.backend.PasswordChecker().query_user(credentials)
+        account = await credential_cache.lookup(username, realm)
+        if account is not None and not credentials.is_valid(account):
+            # the cached credentials may be out of date
+            account = await credential_cache.lookup(username, realm, refresh=True)
 
-        if user is None or not credentials.is_valid(user[0]):
+        if account is None or not credentials.is_valid(account):
             raise HTTPException(
                 status_code=401,
                 detail="Invalid credentials"
             )
 
-        return f'{user[0].username}@{user[0].domain}'
+        return f'{account.username}@{account.domain}'
 
-    # Function to check if the client IP is in the trusted peers list
     def is_ip_trusted(self, client_ip: Optional[str]) -> bool:
         """Check if the client IP is in the trusted peers list."""
-        if not self.trusted_peers or client_ip is None:
-            return False
-
-        # Iterate through each network range in the trusted_parties list
-        for range in self.trusted_peers:
-            # Convert the IP address to a 32-bit integer
-            ip_int = struct.unpack('!L', socket.inet_aton(client_ip))[0]
-
-            # Perform the bitwise comparison (IP address & network mask == base address)
-            if ip_int & range[1] == range[0]:
-                return True
-
-        # If the IP address does not match any range, return False
-        return False
+        return client_ip is not None and client_ip in self.trusted_peers
 
     async def authenticate_xcap_request(self, request: Request) -> AuthData:
         """Authenticate a request by checking IP and applying Digest or Basic authentication as needed."""
@@ -304,6 +359,24 @@ class AuthenticationManager:
 
         return AuthData(xcap_uri, application)
 
+    async def authenticate_user_request(self, request: Request, user: str) -> Optional[str]:
+        """Authenticate a request made on the documents of user, e.g. a batch of
+        operations. Return the authenticated user, None if the request comes
+        from a trusted peer, which is authorized for all the documents."""
+        if self.is_ip_trusted(get_client_ip(request)):
+            return None
+
+        realm = XCAPUser.parse(user, AuthenticationConfig.default_realm).domain
+        if not realm:
+            raise ResourceNotFound('Unknown domain (the domain part of "username@domain" is required because this server has no default domain)')
+
+        if AuthenticationConfig.type == 'digest':
+            return await self.digest_auth(request, realm)
+        elif AuthenticationConfig.type == 'basic':
+            return await self.basic_auth(request, realm)
+        else:
+            raise ValueError('Invalid authentication type: %r. Please check the configuration.' % AuthenticationConfig.type)
+
     async def authenticate_api_request(self, request: Request, document, user) -> XCAPUri:
         """Authenticate a request by checking IP and applying Digest or Basic authentication as needed."""
         client_ip = get_client_ip(request)
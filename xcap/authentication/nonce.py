@@ -0,0 +1,211 @@
+"""Digest authentication nonces
+
+A nonce can be used for several requests until it expires, as described in
+RFC 7616, with the client incrementing the nonce count for every request. The
+highest nonce count seen for a nonce and a bitmap of the counts below it are
+kept, so that requests sent in parallel on several connections can arrive out
+of order while replayed requests are refused.
+
+Stored nonces are random strings kept in a shared table until they expire.
+Stateless nonces carry the time they were issued and an HMAC of it made with
+a server secret, so any worker, and the server after a restart, can verify
+them, and only their nonce counts are kept. When the nonce counts of a nonce
+are evicted to make room for others, the nonces issued until then which have
+no nonce counts are refused, as their counts may have been forgotten.
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+import struct
+import time
+from enum import Enum
+from typing import Hashable, Optional
+from uuid import uuid4
+
+from application import log
+from application.process import process
+
+from xcap.configuration import AuthenticationConfig
+from xcap.sharedstate import SharedTable, shared_table
+
+__all__ = ['NonceStatus', 'StoredNonces', 'StatelessNonces', 'nonce_manager']
+
+
+class NonceStatus(Enum):
+    valid = 'valid'
+    stale = 'stale'        # issued by this server, but expired
+    invalid = 'invalid'
+
+
+# how far below the highest nonce count seen the nonce count of a request may be
+NONCE_COUNT_WINDOW = 32
+
+
+def _record_count(counts: Optional[list], nc: str) -> Optional[list]:
+    """Return counts, the highest nonce count seen and the bitmap of the ones
+    below it, updated with nc, or None if nc was already seen"""
+    try:
+        count = int(nc, 16)
+    except ValueError:
+        return None
+    highest, seen = counts if counts is not None else (0, 0)
+    if count < 1:
+        return None
+    elif count > highest:
+        if count - highest < NONCE_COUNT_WINDOW:
+            seen = ((seen << (count - highest)) | 1) & ((1 << NONCE_COUNT_WINDOW) - 1)
+        else:
+            seen = 1
+        highest = count
+    elif highest - count < NONCE_COUNT_WINDOW and not seen & (1 << (highest - count)):
+        seen |= 1 << (highest - count)
+    else:
+        return None
+    return [highest, seen]
+
+
+class StoredNonces(object):
+    """Random nonces, kept in a shared table together with their nonce counts until they expire"""
+
+    size = 10000
+
+    def __init__(self, lifetime: float):
+        self.lifetime = lifetime
+        self.table: SharedTable = shared_table('nonces', self.size, lifetime)
+
+    def generate(self, realm: str) -> str:
+        unique_nonce = f"{int(time.time())}-{uuid4()}"
+        nonce = base64.b64encode(unique_nonce.encode()).decode("utf-8")
+        self.table[nonce] = {'realm': realm, 'issued': time.time(), 'counts': None}
+        return nonce
+
+    def check(self, nonce: str, realm: str) -> NonceStatus:
+        entry = self.table.get(nonce)
+        return NonceStatus.valid if entry is not None and entry['realm'] == realm else NonceStatus.invalid
+
+    def use(self, nonce: str, nc: str) -> bool:
+        """Record the nonce count of a request authenticated with nonce, return
+        False if it was already used"""
+        accepted = False
+
+        def record(entry):
+            nonlocal accepted
+            if entry is not None:
+                counts = _record_count(entry['counts'], nc)
+                if counts is not None:
+                    accepted = True
+                    entry = dict(entry, counts=counts)
+            return entry
+
+        self.table.update(nonce, record)
+        return accepted
+
+    def remaining(self, nonce: str) -> float:
+        """Return the number of seconds until nonce expires"""
+        entry = self.table.get(nonce)
+        return entry['issued'] + self.lifetime - time.time() if entry is not None else 0
+
+
+class StatelessNonces(object):
+    """Nonces signed with a server secret, which can be verified without
+    keeping them. Only their nonce counts are kept."""
+
+    size = 100000
+    secret_file = 'nonce-secret'
+
+    def __init__(self, lifetime: float, secret: Optional[str] = None):
+        self.lifetime = lifetime
+        self.secret = secret.encode() if secret else self._load_secret()
+        self.counts: SharedTable = shared_table('nonce-counts', self.size, lifetime, on_evict=self._evicted)
+        # the latest time a nonce whose nonce counts were evicted was issued
+        self.evictions: SharedTable = shared_table('nonce-evictions', 1, lifetime)
+
+    def _load_secret(self) -> bytes:
+        """Return the secret shared by all the workers, which is generated the
+        first time and kept in the runtime directory"""
+        process.runtime.create_directory()
+        path = process.runtime.file(self.secret_file)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            with open(path, 'rb') as secret_file:
+                secret = secret_file.read()
+            if len(secret) >= 32:
+                return secret
+            log.warning('The nonce secret in %s is too short, generating a new one' % path)
+            os.unlink(path)
+            return self._load_secret()
+        secret = os.urandom(32)
+        with os.fdopen(fd, 'wb') as secret_file:
+            secret_file.write(secret)
+        return secret
+
+    def _sign(self, data: bytes, realm: str) -> bytes:
+        return hmac.new(self.secret, data + realm.encode(), hashlib.sha256).digest()[:16]
+
+    def _issued(self, nonce: str, realm: Optional[str] = None) -> Optional[int]:
+        """Return the time nonce was issued, None if it is not a nonce issued
+        by this server, for realm if given"""
+        try:
+            value = base64.urlsafe_b64decode(nonce + '=' * (-len(nonce) % 4))
+        except (ValueError, TypeError):
+            return None
+        if len(value) != 32:
+            return None
+        data, signature = value[:16], value[16:]
+        if realm is not None and not hmac.compare_digest(signature, self._sign(data, realm)):
+            return None
+        return struct.unpack('!Q', data[:8])[0]
+
+    def generate(self, realm: str) -> str:
+        data = struct.pack('!Q', int(time.time())) + os.urandom(8)
+        return base64.urlsafe_b64encode(data + self._sign(data, realm)).decode().rstrip('=')
+
+    def check(self, nonce: str, realm: str) -> NonceStatus:
+        issued = self._issued(nonce, realm)
+        if issued is None:
+            return NonceStatus.invalid
+        if not time.time() - self.lifetime < issued <= time.time() + 1:
+            return NonceStatus.stale
+        return NonceStatus.valid
+
+    def _evicted(self, nonce: Hashable) -> None:
+        issued = self._issued(str(nonce))
+        if issued is not None:
+            self.evictions.update('issued', lambda latest: max(latest or 0, issued))
+
+    def use(self, nonce: str, nc: str) -> bool:
+        """Record the nonce count of a request authenticated with nonce, return
+        False if it was already used or may have been"""
+        accepted = False
+        issued = self._issued(nonce)
+        evicted = self.evictions.get('issued')
+
+        def record(counts):
+            nonlocal accepted
+            if counts is None and evicted is not None and issued is not None and issued <= evicted:
+                return None
+            new_counts = _record_count(counts, nc)
+            if new_counts is None:
+                return counts
+            accepted = True
+            return new_counts
+
+        self.counts.update(nonce, record)
+        return accepted
+
+    def remaining(self, nonce: str) -> float:
+        """Return the number of seconds until nonce expires"""
+        issued = self._issued(nonce)
+        return issued + self.lifetime - time.time() if issued is not None else 0
+
+
+def _nonce_manager():
+    if AuthenticationConfig.stateless_nonces:
+        return StatelessNonces(AuthenticationConfig.nonce_lifetime, AuthenticationConfig.nonce_secret)
+    return StoredNonces(AuthenticationConfig.nonce_lifetime)
+
+
+nonce_manager = _nonce_manager()
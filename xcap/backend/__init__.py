@@ -1,5 +1,7 @@
 from abc import ABC, abstractmethod
-from typing import Callable, Optional, Union
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Callable, Iterator, List, Optional, Union
 
 from pydantic import BaseModel
 from starlette.background import BackgroundTask, BackgroundTasks
@@ -42,6 +44,28 @@ class StatusResponse(CustomBaseModel):
         arbitrary_types_allowed = True
 
 
+class DocumentChanged(Exception):
+    """The stored document is no longer the version a change was made to"""
+
+
+_stored_reads: ContextVar[bool] = ContextVar('stored_reads', default=False)
+
+
+@contextmanager
+def stored_reads() -> Iterator[None]:
+    """Make the documents read in the block come from the storage, not from
+    the caches of the backend, e.g. when they are read in order to be changed"""
+    token = _stored_reads.set(True)
+    try:
+        yield
+    finally:
+        _stored_reads.reset(token)
+
+
+def reading_stored() -> bool:
+    return _stored_reads.get()
+
+
 class BackendInterface(ABC):
 
     def _normalize_document_path(self, uri):
@@ -58,8 +82,10 @@ class BackendInterface(ABC):
         pass
 
     @abstractmethod
-    async def put_document(self, uri: XCAPUri, document: bytes, check_etag: Callable) -> Optional[StatusResponse]:
-        """Retrieve data for a specific resource."""
+    async def put_document(self, uri: XCAPUri, document: bytes, check_etag: Callable, base_etag: Optional[str] = None) -> Optional[StatusResponse]:
+        """Store data for a specific resource. If base_etag is given, the
+        document is a modification of that version and DocumentChanged is
+        raised if the stored version is another one."""
         pass
 
     @abstractmethod
@@ -67,6 +93,14 @@ class BackendInterface(ABC):
         """Retrieve data for a specific resource."""
         pass
 
+    @asynccontextmanager
+    async def batch(self) -> AsyncIterator[List[BackgroundTask]]:
+        """Group the document changes made in the block. Backends which can
+        store them in a single transaction when the block ends override this,
+        the others store every change when it is made. The list yielded
+        receives the tasks to run once the changes of the block are stored."""
+        yield []
+
     @abstractmethod
     def stop(self):
         pass
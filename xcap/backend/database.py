@@ -1,12 +1,20 @@
-from typing import Any, Callable, Optional
-
-from sqlalchemy.exc import SQLAlchemyError
-from sqlmodel import select
-
-from xcap.backend import BackendInterface, StatusResponse
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from fastapi.responses import PlainTextResponse
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlmodel import delete, insert, select, update
+from starlette.background import BackgroundTask
+
+from xcap.backend import BackendInterface, DocumentChanged, StatusResponse, reading_stored
+from xcap.cache import Cache, CoherentCache
+from xcap.configuration import CacheConfig
 from xcap.db.manager import get_auth_db_session, get_db_session, shutdown_db
 from xcap.db.models import XCAP, Subscriber, Watcher
 from xcap.dbutil import make_random_etag
+from xcap.errors import HTTPError
+from xcap.sharedstate import multiprocess
 from xcap.uri import XCAPUri
 
 
@@ -30,6 +38,23 @@ class DeleteFailed(Error):
     msg = 'DELETE request failed'
 
 
+class DocumentBatch(object):
+    """The documents changed by a batch of operations, which are stored
+    together in one transaction when the batch ends"""
+
+    def __init__(self):
+        # maps the document key to [stored etag, (document, etag) or None]
+        self.documents: Dict[tuple, list] = {}
+        # maps the document key to the URI of the document
+        self.uris: Dict[tuple, XCAPUri] = {}
+        # the tasks to run once the changes are stored
+        self.tasks: List[BackgroundTask] = []
+
+
+# the batch the operations of the current task are part of
+_current_batch: ContextVar[Optional[DocumentBatch]] = ContextVar('current_batch', default=None)
+
+
 class PasswordChecker(object):
     async def query_user(self, credentials) -> Any:
         async with get_auth_db_session() as db_session:
@@ -48,11 +73,23 @@ class DatabaseStorage(BackendInterface):
                    "org.openxcap.dialog-rules"              : 1 << 7,
                    "test-app"                               : 0}
 
-    async def fetch_document(self, uri):
-        username, domain = uri.user.username, uri.user.domain
+    # the number of times a PUT is retried when the document is modified concurrently
+    put_attempts = 3
+
+    def __init__(self):
+        # maps (username, domain, doc_type, document_path) to (document, etag)
+        size, ttl = CacheConfig.document_cache_size, CacheConfig.document_cache_ttl
+        if multiprocess():
+            self.document_cache = CoherentCache(size, ttl, 'documents', version=lambda value: value[1])
+        else:
+            self.document_cache = Cache(size, ttl)
+
+    def _document_key(self, uri):
         self._normalize_document_path(uri)
-        doc_type = self.app_mapping[uri.application_id]
-        document_path = uri.doc_selector.document_path
+        return uri.user.username, uri.user.domain, self.app_mapping[uri.application_id], uri.doc_selector.document_path
+
+    async def fetch_document(self, uri):
+        username, domain, doc_type, document_path = self._document_key(uri)
 
         async with get_db_session() as db_session:
             result = await db_session.execute(select(XCAP).where(
@@ -67,7 +104,45 @@ class DatabaseStorage(BackendInterface):
                                             "document_path": document_path})
             return results
 
+    def _where(self, key):
+        username, domain, doc_type, document_path = key
+        return XCAP.username == username, XCAP.domain == domain, XCAP.doc_type == doc_type, XCAP.doc_uri == document_path
+
+    async def _select_document(self, db_session, key):
+        """Return the stored version of a document as (document, etag), None if it does not exist"""
+        result = await db_session.execute(select(XCAP.doc, XCAP.etag).where(*self._where(key)))
+        results = result.all()
+        if len(results) > 1:
+            username, domain, doc_type, document_path = key
+            raise MultipleResultsError({"username": username,
+                                        "domain": domain,
+                                        "doc_type": doc_type,
+                                        "document_path": document_path})
+        if not results:
+            return None
+        doc, etag = results[0]
+        if isinstance(doc, str):
+            doc = doc.encode('utf-8')
+        return doc, etag
+
     async def get_document(self, uri: XCAPUri, check_etag: Callable) -> Optional[StatusResponse]:
+        key = self._document_key(uri)
+        batch = _current_batch.get()
+        if batch is not None:
+            current = (await self._batch_document(batch, key))[1]
+            if current is None:
+                return StatusResponse(404)
+            doc, etag = current
+            check_etag(etag)
+            return StatusResponse(200, etag, doc)
+        cached = self.document_cache.get(key) if not reading_stored() else None
+        if cached is not None:
+            doc, etag = cached
+            check_etag(etag)
+            return StatusResponse(200, etag, doc)
+
+        # a version stored by a PUT while the document is read is not replaced with the one read
+        token = self.document_cache.reserve(key)
         results = await self.fetch_document(uri)
         if results:
             doc = results[0][0].doc
@@ -75,68 +150,75 @@ class DatabaseStorage(BackendInterface):
 
             if isinstance(doc, str):
                 doc = doc.encode('utf-8')
+            self.document_cache.fill(key, (doc, etag), token)
             check_etag(etag)
 
             return StatusResponse(200, etag, doc)
 
         return StatusResponse(404)
 
-    async def put_document(self, uri: XCAPUri, document: bytes, check_etag: Callable) -> Optional[StatusResponse]:
-        results = await self.fetch_document(uri)
-        if results:
-            existing_doc = results[0][0]
-            old_etag = existing_doc.etag
-            doc = existing_doc.doc
-
-            if isinstance(doc, str):
-                doc = doc.encode('utf-8')
-
-            if doc == document:
-                return StatusResponse(200, old_etag, doc)
-
-            check_etag(old_etag)  # Check if etag matches
-            etag = make_random_etag(uri)  # Generate a new etag
-            old_data = existing_doc
-
-            # Update fields
-            params = {
-                "doc": document,
-                "etag": etag
-            }
-            for key, value in params.items():
-                setattr(old_data, key, value)
-
-            async with get_db_session() as db_session:
-                db_session.add(old_data)
-                await db_session.commit()
-                await db_session.refresh(old_data)
-
-            return StatusResponse(200, etag, old_etag=old_etag)
-
-        # If no document exists, create a new one
-        username, domain = uri.user.username, uri.user.domain
-        doc_type = self.app_mapping[uri.application_id]
-        document_path = uri.doc_selector.document_path
-
-        check_etag(None, False)
-        etag = make_random_etag(uri)  # Generate a new etag for the new document
-        params = {
-            "username": username,
-            "domain": domain,
-            "doc_type": doc_type,
-            "etag": etag,
-            "doc": document,
-            "doc_uri": document_path
-        }
-        new_doc = XCAP(**params)
+    async def put_document(self, uri: XCAPUri, document: bytes, check_etag: Callable, base_etag: Optional[str] = None) -> Optional[StatusResponse]:
+        # The document is replaced with a conditional UPDATE, which only
+        # succeeds if the ETag in the table is still the one that was checked.
+        # If another request modified or created the document in the meantime
+        # the current version is read again and the checks are repeated,
+        # unless the document was made from the version with base_etag.
+        key = self._document_key(uri)
+        batch = _current_batch.get()
+        if batch is not None:
+            return await self._put_batch_document(batch, uri, key, document, check_etag, base_etag)
+        username, domain, doc_type, document_path = key
+        where = self._where(key)
+
+        # the checks are made against the stored version, not the cached one,
+        # which may be out of date after a change made by another server
         async with get_db_session() as db_session:
-            db_session.add(new_doc)
-            await db_session.commit()
-            await db_session.refresh(new_doc)
+            for attempt in range(self.put_attempts):
+                token = self.document_cache.reserve(key)
+                current = await self._select_document(db_session, key)
+
+                if base_etag is not None and (current is None or current[1] != base_etag):
+                    self.document_cache.invalidate(key)
+                    raise DocumentChanged
+
+                if current is None:
+                    self.document_cache.invalidate(key)
+                    check_etag(None, False)
+                    etag = make_random_etag(uri)
+                    db_session.add(XCAP(username=username, domain=domain, doc_type=doc_type, etag=etag, doc=document, doc_uri=document_path))
+                    try:
+                        await db_session.commit()
+                    except IntegrityError:
+                        # created by another request
+                        await db_session.rollback()
+                        continue
+                    self.document_cache.store(key, (document, etag), None)
+                    return StatusResponse(201, etag)
+
+                self.document_cache.fill(key, current, token)
+                doc, old_etag = current
+                if doc == document:
+                    return StatusResponse(200, old_etag, doc)
+
+                check_etag(old_etag)
+                etag = make_random_etag(uri)
+                result = await db_session.execute(update(XCAP).where(*where, XCAP.etag == old_etag).values(doc=document, etag=etag))
+                if result.rowcount == 1:
+                    await db_session.commit()
+                    self.document_cache.store(key, (document, etag), old_etag)
+                    return StatusResponse(200, etag, old_etag=old_etag)
 
-        return StatusResponse(201, etag)
+                # modified or deleted by another request
+                await db_session.rollback()
+                self.document_cache.invalidate(key)
+
+        raise HTTPError(PlainTextResponse('The document was modified by concurrent requests', status_code=409))
 
     async def delete_document(self, uri: XCAPUri, check_etag: Callable) -> Optional[StatusResponse]:
+        batch = _current_batch.get()
+        if batch is not None:
+            return await self._delete_batch_document(batch, uri, self._document_key(uri), check_etag)
+
         results = await self.fetch_document(uri)
 
         if results:
@@ -148,10 +230,121 @@ class DatabaseStorage(BackendInterface):
                     await db_session.commit()
                 except SQLAlchemyError:
                     raise DeleteFailed
+                finally:
+                    self.document_cache.invalidate(self._document_key(uri))
 
             return StatusResponse(200, old_etag=etag)
         return StatusResponse(404)
 
+    @asynccontextmanager
+    async def batch(self) -> AsyncIterator[List[BackgroundTask]]:
+        # The changes are kept in the batch, where the following operations
+        # find them, and are written when it ends with conditional statements
+        # on the etags the documents had when the batch first read them. If a
+        # document was modified by another request in the meantime nothing is
+        # stored. Batches started inside a batch are part of it.
+        current_batch = _current_batch.get()
+        if current_batch is not None:
+            yield current_batch.tasks
+            return
+        batch = DocumentBatch()
+        token = _current_batch.set(batch)
+        try:
+            yield batch.tasks
+        finally:
+            _current_batch.reset(token)
+        await self._store_batch(batch)
+
+    @property
+    def in_batch(self) -> bool:
+        """True if the changes made by the current task are stored when its batch ends"""
+        return _current_batch.get() is not None
+
+    async def _batch_document(self, batch, key):
+        """Return the entry of a document in batch, reading its stored version the first time"""
+        entry = batch.documents.get(key)
+        if entry is None:
+            async with get_db_session() as db_session:
+                current = await self._select_document(db_session, key)
+            entry = batch.documents[key] = [current[1] if current else None, current]
+        return entry
+
+    async def _put_batch_document(self, batch, uri, key, document, check_etag, base_etag):
+        entry = await self._batch_document(batch, key)
+        batch.uris[key] = uri
+        if base_etag is not None and (entry[1] is None or entry[1][1] != base_etag):
+            raise DocumentChanged
+        if entry[1] is None:
+            check_etag(None, False)
+            etag = make_random_etag(uri)
+            entry[1] = (document, etag)
+            return StatusResponse(201, etag)
+        doc, old_etag = entry[1]
+        if doc == document:
+            return StatusResponse(200, old_etag, doc)
+        check_etag(old_etag)
+        etag = make_random_etag(uri)
+        entry[1] = (document, etag)
+        return StatusResponse(200, etag, old_etag=old_etag)
+
+    async def _delete_batch_document(self, batch, uri, key, check_etag):
+        entry = await self._batch_document(batch, key)
+        batch.uris[key] = uri
+        if entry[1] is None:
+            return StatusResponse(404)
+        old_etag = entry[1][1]
+        check_etag(old_etag)
+        entry[1] = None
+        return StatusResponse(200, old_etag=old_etag)
+
+    async def _write_changes(self, db_session, changes):
+        """Write the changes of a batch, return False if a document was modified by another request"""
+        for key, stored_etag, current in changes:
+            if stored_etag is None:
+                username, domain, doc_type, document_path = key
+                doc, etag = current
+                await db_session.execute(insert(XCAP).values(username=username, domain=domain, doc_type=doc_type, etag=etag, doc=doc, doc_uri=document_path))
+                continue
+            where = (*self._where(key), XCAP.etag == stored_etag)
+            if current is None:
+                result = await db_session.execute(delete(XCAP).where(*where))
+            else:
+                doc, etag = current
+                result = await db_session.execute(update(XCAP).where(*where).values(doc=doc, etag=etag))
+            if result.rowcount != 1:
+                return False
+        return True
+
+    async def _store_batch(self, batch):
+        changes = [(key, stored_etag, current) for key, (stored_etag, current) in batch.documents.items()
+                   if (current[1] if current is not None else None) != stored_etag]
+        if not changes:
+            return
+        async with get_db_session() as db_session:
+            try:
+                stored = await self._write_changes(db_session, changes)
+            except IntegrityError:
+                # created by another request
+                stored = False
+            if stored:
+                await db_session.commit()
+            else:
+                await db_session.rollback()
+        if not stored:
+            for key, stored_etag, current in changes:
+                self.document_cache.invalidate(key)
+            raise HTTPError(PlainTextResponse('The documents were modified by concurrent requests', status_code=409))
+        for key, stored_etag, current in changes:
+            if current is not None:
+                self.document_cache.store(key, current, stored_etag)
+            else:
+                self.document_cache.invalidate(key)
+        self._batch_stored(batch, changes)
+
+    def _batch_stored(self, batch, changes):
+        """Called with the changes of a batch once they are stored"""
+        pass
+
     async def get_watchers(self, uri):
         status_mapping = {1: "allow",
                           2: "confirm",
@@ -20,6 +20,7 @@ from xcap.backend import StatusResponse
 from xcap.backend.database import DatabaseStorage, PasswordChecker
 from xcap.configuration import OpensipsConfig as XCAPOpensipsConfig
 from xcap.configuration import ServerConfig
+from xcap.sharedstate import multiprocess
 from xcap.uri import XCAPUri
 from xcap.xcapdiff import Notifier
 
@@ -35,7 +36,7 @@ class SIPNotifier(object, metaclass=Singleton):
         self.engine = Engine()
         self.engine.start(
             ip_address=None if ServerConfig.address == '0.0.0.0' else ServerConfig.address,
-            tcp_port=ServerConfig.tcp_port,
+            tcp_port=0 if multiprocess() else ServerConfig.tcp_port,  # worker processes cannot share the port
             user_agent="OpenXCAP %s" % __version__,
         )
         self.sip_prefix_re = re.compile('^sips?:')
@@ -99,18 +100,25 @@ class NotifyingStorage(DatabaseStorage):
         self._sip_notifier = SIPNotifier()
         self.notifier = Notifier(ServerConfig.root, self._sip_notifier.send_publish)
 
-    async def put_document(self, uri: XCAPUri, document: bytes, check_etag: Callable) -> Optional[StatusResponse]:
-        result = await super(NotifyingStorage, self).put_document(uri, document, check_etag)
-        if result and result.succeed:
+    # the changes made in a batch are notified once it is stored, with one
+    # xcap-diff per document from its stored version to the final one
+
+    async def put_document(self, uri: XCAPUri, document: bytes, check_etag: Callable, base_etag: Optional[str] = None) -> Optional[StatusResponse]:
+        result = await super(NotifyingStorage, self).put_document(uri, document, check_etag, base_etag)
+        if result and result.succeed and not self.in_batch:
             result.background = BackgroundTask(self.notifier.on_change, uri, result.old_etag, result.etag)
         return result
 
     async def delete_document(self, uri: XCAPUri, check_etag: Callable) -> Optional[StatusResponse]:
         result = await super(NotifyingStorage, self).delete_document(uri, check_etag)
-        if result and result.succeed:
+        if result and result.succeed and not self.in_batch:
             result.background = BackgroundTask(self.notifier.on_change, uri, result.old_etag, None)
         return result
 
+    def _batch_stored(self, batch, changes):
+        for key, stored_etag, current in changes:
+            batch.tasks.append(BackgroundTask(self.notifier.on_change, batch.uris[key], stored_etag, current[1] if current is not None else None))
+
 
 PasswordChecker = PasswordChecker
 
@@ -1,9 +1,12 @@
 
 import asyncio
+import hashlib
 import json
 import re
 import signal
-from typing import Any, Callable, Optional
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
 
 import xcap
 from application import log
@@ -13,10 +16,12 @@ from application.process import process
 from application.python import Null
 from application.python.types import Singleton
 from application.system import host
+from fastapi.responses import PlainTextResponse
 from gnutls.interfaces.twisted import TLSContext, X509Credentials
 from sipsimple.core import (SIPURI, Engine, FromHeader, Header, Publication,
                             RouteHeader)
-from sqlmodel import select
+from sqlalchemy import func
+from sqlmodel import select, update
 from starlette.background import BackgroundTask, BackgroundTasks
 from thor.entities import GenericThorEntity as ThorEntity
 from thor.entities import ThorEntitiesRoleMap
@@ -27,13 +32,16 @@ from thor.link import Request
 from thor.link import Response as ThorResponse
 from twisted.internet import defer
 from twisted.internet.defer import Deferred
-from xcap.backend import BackendInterface, StatusResponse
-from xcap.configuration import ServerConfig, ThorNodeConfig
+from xcap.backend import BackendInterface, DocumentChanged, StatusResponse, reading_stored
+from xcap.cache import Cache, CoherentCache
+from xcap.configuration import CacheConfig, ServerConfig, ThorNodeConfig
 from xcap.configuration.datatypes import DatabaseURI
 from xcap.db.manager import get_auth_db_session, get_db_session, shutdown_db
 from xcap.db.models import DataObject, SipAccount
+from xcap.db.models.sipthor_db import SipAccountData
 from xcap.dbutil import make_random_etag
-from xcap.errors import NotFound
+from xcap.errors import HTTPError, NotFound
+from xcap.sharedstate import multiprocess
 from xcap.uri import XCAPUri
 from xcap.xcapdiff import Notifier
 from zope.interface import implementer
@@ -59,6 +67,139 @@ class GetSIPWatchers(Request):
         return instance
 
 
+class ReactorBridge(object):
+    """Calls functions in the thread of the Twisted reactor on behalf of the
+    asyncio code and hands their results back to the event loop"""
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.total_time = 0.0
+
+    @staticmethod
+    def call(function: Callable, *args: Any) -> None:
+        """Call function in the reactor thread without waiting for it"""
+        from twisted.internet import reactor
+        reactor.callFromThread(function, *args)
+
+    async def run(self, function: Callable, *args: Any) -> Any:
+        """Call function in the reactor thread and return the result of the
+        Deferred it returns, waiting for it at most timeout seconds"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        deferreds = []
+
+        def resolve(method: str, value: Any) -> None:
+            if not future.done():
+                getattr(future, method)(value)
+
+        def schedule(method: str, value: Any) -> None:
+            try:
+                loop.call_soon_threadsafe(resolve, method, value)
+            except RuntimeError:  # the event loop is closed
+                pass
+
+        def start() -> None:
+            deferred = defer.maybeDeferred(function, *args)
+            deferred.addCallbacks(lambda result: schedule('set_result', result), lambda failure: schedule('set_exception', failure.value))
+            deferreds.append(deferred)
+
+        def cancel() -> None:
+            for deferred in deferreds:
+                deferred.cancel()
+
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        start_time = time.perf_counter()
+        self.call(start)
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self.call(cancel)
+            raise
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            self.total_time += time.perf_counter() - start_time
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        completed = self.requests - self.in_flight
+        return {'requests': self.requests,
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'failures': self.failures,
+                'timeouts': self.timeouts,
+                'average_time': self.total_time / completed if completed else 0.0}
+
+
+class NotificationCoalescer(object):
+    """Collects the notifications for the SIP proxies in the reactor thread
+    for delay seconds, so that a notification is sent only once for the
+    changes made to an entity in that time. The notifications are then sent
+    grouped by the node they are sent to."""
+
+    def __init__(self, delay: float, lookup: Callable, send: Callable):
+        self.delay = delay
+        self.lookup = lookup
+        self.send = send
+        self.pending: Dict[tuple, None] = {}
+        self.timer = None
+        self.received = 0
+        self.sent = 0
+        self.suppressed = 0
+        self.batches = 0
+
+    def add(self, operation: str, entity_type: str, entity: str) -> None:
+        self.received += 1
+        key = (operation, entity_type, entity)
+        if key in self.pending:
+            self.suppressed += 1
+            return
+        self.pending[key] = None
+        if self.delay <= 0:
+            self.flush()
+        elif self.timer is None:
+            from twisted.internet import reactor
+            self.timer = reactor.callLater(self.delay, self.flush)
+
+    def flush(self) -> None:
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+        pending, self.pending = self.pending, {}
+        nodes: Dict[ThorEntityAddress, list] = {}
+        for operation, entity_type, entity in pending:
+            node = self.lookup(entity)
+            if node is None:
+                continue
+            if node.control_port is None:
+                log.error("Could not send notify because node %s has no control port" % node.ip)
+                continue
+            nodes.setdefault(node, []).append("notify %s %s %s" % (operation, entity_type, entity))
+        for node, commands in nodes.items():
+            for command in commands:
+                self.send(ThorNotification(command), (node.ip, node.control_port))
+            self.sent += len(commands)
+            self.batches += 1
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {'received': self.received,
+                'sent': self.sent,
+                'suppressed': self.suppressed,
+                'batches': self.batches,
+                'pending': len(self.pending)}
+
+
 class XCAPProvisioning(EventServiceClient, metaclass=Singleton):
     topics = ["Thor.Members"]
 
@@ -71,63 +212,68 @@ class XCAPProvisioning(EventServiceClient, metaclass=Singleton):
         credentials.verify_peer = True
         tls_context = TLSContext(credentials)
         self.control = ControlLink(tls_context)
+        self.bridge = ReactorBridge(ThorNodeConfig.request_timeout)
+        # maps the keys to the SIP proxy nodes they are assigned to, until the nodes change
+        self.nodes = Cache(ThorNodeConfig.lookup_cache_size)
+        self.nodes_lock = threading.Lock()
+        self.members: Dict[str, frozenset] = {}
+        self.ring_lookups = 0
+        self.membership_events = 0
+        self.membership_changes = 0
+        self.membership_time = 0.0
+        self.max_membership_time = 0.0
+        self.notifications = NotificationCoalescer(ThorNodeConfig.notification_delay, self.lookup, self.control.send_request)
         EventServiceClient.__init__(self, ThorNodeConfig.domain, tls_context)
 #        process.signals.add_handler(signal.SIGHUP, self._handle_signal)
 #        process.signals.add_handler(signal.SIGINT, self._handle_signal)
 #        process.signals.add_handler(signal.SIGTERM, self._handle_signal)
 
     def _disconnect_all(self, result) -> None:
+        self.notifications.flush()
         self.control.disconnect_all()
         EventServiceClient._disconnect_all(self, result)
 
     def lookup(self, key: str) -> Optional[ThorEntityAddress]:
-        network = self.networks.get("sip_proxy", None)
-        if network is None:
-            return None
-        try:
-            node = network.lookup_node(key)
-        except LookupError:
-            node = None
-        except Exception:
-            log.exception()
-            node = None
-        return node
+        # called from the reactor thread and from the thread of the SIP engine
+        with self.nodes_lock:
+            node = self.nodes.get(key)
+            if node is not None:
+                return node
+            network = self.networks.get("sip_proxy", None)
+            if network is None:
+                return None
+            self.ring_lookups += 1
+            try:
+                node = network.lookup_node(key)
+            except LookupError:
+                node = None
+            except Exception:
+                log.exception()
+                node = None
+            if node is not None:
+                self.nodes.set(key, node)
+            return node
+
+    @property
+    def routing_stats(self) -> Dict[str, Any]:
+        return {'lookups': self.nodes.hits + self.nodes.misses,
+                'ring_lookups': self.ring_lookups,
+                'cached_nodes': self.nodes.stats['entries'],
+                'membership_events': self.membership_events,
+                'membership_changes': self.membership_changes,
+                'membership_time': self.membership_time,
+                'max_membership_time': self.max_membership_time}
 
     def notify(self, operation: str, entity_type: str, entity: str) -> None:
-        node = self.lookup(entity)
-        if node is not None:
-            if node.control_port is None:
-                log.error("Could not send notify because node %s has no control port" % node.ip)
-                return
-            self.control.send_request(ThorNotification("notify %s %s %s" % (operation, entity_type, entity)), (node.ip, node.control_port))
+        self.bridge.call(self.notifications.add, operation, entity_type, entity)
 
     async def get_watchers(self, key: str) -> ThorResponse:
         """
         Fetch watchers asynchronously.
-        This method is called from asyncio code, so it will
-        convert the Deferred returned by Twisted to a Future.
+        The request is sent from the reactor thread and its result is
+        handed back to the event loop of the caller.
         """
-        # Get the Deferred from the Twisted code
-        deferred = self._get_watchers(key)
-
-        # Wrap the Twisted Deferred into an asyncio Future and await it
-        result = await self._deferred_to_future(deferred)
-        return result
-
-    async def _deferred_to_future(self, deferred: Deferred) -> ThorResponse:
-        """
-        Convert a Twisted Deferred into an asyncio Future.
-        This allows us to await the Deferred in an async function.
-        """
-        # Wrap the Deferred into an asyncio Future
-        loop = asyncio.get_event_loop()
-        future = loop.create_future()
-
-        # Add a callback that will set the result on the asyncio Future when the Deferred is done
-        deferred.addCallback(future.set_result)
-        deferred.addErrback(future.set_exception)
-
-        return await future
+        return await self.bridge.run(self._get_watchers, key)
 
     def _get_watchers(self, key: str) -> Deferred:
         node = self.lookup(key)
@@ -152,62 +298,251 @@ class XCAPProvisioning(EventServiceClient, metaclass=Singleton):
         else:
             dburi = None
         NotificationCenter().post_notification('db_uri', self, dburi)
-        all_roles = list(role_map.keys()) + list(networks.keys())
-        for role in all_roles:
-            try:
-                network = networks[role] ## avoid setdefault here because it always evaluates the 2nd argument
-            except KeyError:
-                from thor import network as thor_network
-                if role in ["thor_manager", "thor_monitor", "provisioning_server", "media_relay", "thor_database"]:
+        start = time.perf_counter()
+        self.membership_events += 1
+        changed = False
+        # the lookups wait while the nodes change
+        with self.nodes_lock:
+            all_roles = list(role_map.keys()) + list(networks.keys())
+            for role in all_roles:
+                try:
+                    network = networks[role] ## avoid setdefault here because it always evaluates the 2nd argument
+                except KeyError:
+                    from thor import network as thor_network
+                    if role in ["thor_manager", "thor_monitor", "provisioning_server", "media_relay", "thor_database"]:
+                        continue
+                    else:
+                        network = thor_network.new(ThorNodeConfig.multiply)
+                    networks[role] = network
+                # most events repeat the current members, only the roles whose members changed are updated
+                members = frozenset((node.ip, getattr(node, 'control_port', None), getattr(node, 'version', 'unknown')) for node in role_map.get(role, []))
+                if self.members.get(role) == members:
+                    continue
+                self.members[role] = members
+                new_nodes = set(ThorEntityAddress(*member) for member in members)
+                old_nodes = set(network.nodes)
+                added_nodes = new_nodes - old_nodes
+                removed_nodes = old_nodes - new_nodes
+                if not added_nodes and not removed_nodes:
                     continue
-                else:
-                    network = thor_network.new(ThorNodeConfig.multiply)
-                networks[role] = network
-            new_nodes = set([ThorEntityAddress(node.ip, getattr(node, 'control_port', None), getattr(node, 'version', 'unknown')) for node in role_map.get(role, [])])
-            old_nodes = set(network.nodes)
-            added_nodes = new_nodes - old_nodes
-            removed_nodes = old_nodes - new_nodes
-            if removed_nodes:
-                for node in removed_nodes:
-                    network.remove_node(node)
-                    self.control.discard_link(node)
-                plural = len(removed_nodes) != 1 and 's' or ''
-                log.info("Removed %s node%s: %s" % (role, plural, ', '.join([node.decode() for node in removed_nodes])))
-            if added_nodes:
-                for node in added_nodes:
-                    network.add_node(node)
-                plural = len(added_nodes) != 1 and 's' or ''
-                log.info("Added %s node%s: %s" % (role, plural, ', '.join([node.decode() for node in added_nodes])))
-            # print('Thor %s nodes: %s' % (role, str(network.nodes)))
+                changed = True
+                if removed_nodes:
+                    for node in removed_nodes:
+                        network.remove_node(node)
+                        self.control.discard_link(node)
+                    plural = len(removed_nodes) != 1 and 's' or ''
+                    log.info("Removed %s node%s: %s" % (role, plural, ', '.join([node.decode() for node in removed_nodes])))
+                if added_nodes:
+                    for node in added_nodes:
+                        network.add_node(node)
+                    plural = len(added_nodes) != 1 and 's' or ''
+                    log.info("Added %s node%s: %s" % (role, plural, ', '.join([node.decode() for node in added_nodes])))
+                # print('Thor %s nodes: %s' % (role, str(network.nodes)))
+            if changed:
+                self.nodes.clear()
+        if changed:
+            elapsed = time.perf_counter() - start
+            self.membership_changes += 1
+            self.membership_time += elapsed
+            self.max_membership_time = max(self.max_membership_time, elapsed)
 
 
 class NoDatabase(Exception):
     pass
 
 
+def json_path(*keys: str) -> str:
+    return '$.' + '.'.join('"%s"' % key.replace('\\', '\\\\').replace('"', '\\"') for key in keys)
+
+
+def xcap_version(xcap_docs: Optional[dict]) -> str:
+    """The version of the XCAP documents of an account, made of their ETags"""
+    etags = sorted(etag for documents in (xcap_docs or {}).values() for document, etag in documents.values())
+    return hashlib.sha1(' '.join(etags).encode()).hexdigest()
+
+
+class ProfileDocuments(object):
+    """Changes the XCAP documents in the profile of a SIP account one at a
+    time with the JSON functions of the database, instead of reading the whole
+    profile and writing it back. The change is a JSON merge patch with only
+    the document, applied if the document still has the ETag it was checked
+    with. The methods return None if the account has no profile yet."""
+
+    attempts = 3
+
+    data = SipAccountData.__table__
+    meta = SipAccount.__table__
+
+    def _profile(self):
+        return func.coalesce(self.data.c.profile, '{}')
+
+    def _etag(self, dialect: str, uri: XCAPUri):
+        etag = func.json_extract(self.data.c.profile, json_path('xcap', uri.application_id, uri.doc_selector.document_path) + '[1]')
+        return func.json_unquote(etag) if dialect == 'mysql' else etag
+
+    def _patch(self, dialect: str, patch: dict):
+        merge_patch = func.json_merge_patch if dialect == 'mysql' else func.json_patch
+        return merge_patch(self._profile(), json.dumps(patch))
+
+    async def _select(self, db_session, dialect: str, uri: XCAPUri) -> Optional[tuple]:
+        """Return the id of the profile of the account and the ETag of the document, None if it has no profile"""
+        statement = (select(self.data.c.id, self._etag(dialect, uri))
+                     .join_from(self.data, self.meta, self.data.c.account_id == self.meta.c.id)
+                     .where(self.meta.c.username == uri.user.username, self.meta.c.domain == uri.user.domain)
+                     .order_by(self.data.c.id).limit(1).with_for_update())
+        return (await db_session.execute(statement)).first()
+
+    async def _change(self, uri: XCAPUri, check: Callable, patch: dict) -> Optional[tuple]:
+        async with get_db_session() as db_session:
+            dialect = db_session.get_bind().dialect.name
+            for attempt in range(self.attempts):
+                row = await self._select(db_session, dialect, uri)
+                if row is None:
+                    return None
+                profile_id, etag = row
+                check(etag)
+                etag_expression = self._etag(dialect, uri)
+                condition = etag_expression.is_(None) if etag is None else etag_expression == etag
+                result = await db_session.execute(update(self.data).where(self.data.c.id == profile_id, condition).values(profile=self._patch(dialect, patch)))
+                if result.rowcount == 1:
+                    await db_session.commit()
+                    return (etag,)
+                # modified by another request after it was checked
+                await db_session.rollback()
+        raise HTTPError(PlainTextResponse('The document was modified by concurrent requests', status_code=409))
+
+    async def put(self, uri: XCAPUri, document: str, check_etag: Callable, new_etag: str) -> Optional[tuple]:
+        def check(etag):
+            if etag is None:
+                check_etag(None, False)
+            else:
+                check_etag(etag)
+        patch = {'xcap': {uri.application_id: {uri.doc_selector.document_path: [document, new_etag]}}}
+        result = await self._change(uri, check, patch)
+        if result is None:
+            return None
+        etag, = result
+        return etag is not None, etag, new_etag
+
+    async def delete(self, uri: XCAPUri, check_etag: Callable) -> Optional[tuple]:
+        def check(etag):
+            if etag is None:
+                raise NotFound()
+            check_etag(etag)
+        patch = {'xcap': {uri.application_id: {uri.doc_selector.document_path: None}}}
+        return await self._change(uri, check, patch)
+
+    async def delete_all(self, uri: XCAPUri) -> Optional[tuple]:
+        async with get_db_session() as db_session:
+            account_ids = select(self.meta.c.id).where(self.meta.c.username == uri.user.username, self.meta.c.domain == uri.user.domain)
+            result = await db_session.execute(update(self.data).where(self.data.c.account_id.in_(account_ids))
+                                              .values(profile=func.json_set(self._profile(), '$.xcap', func.json_object())))
+            await db_session.commit()
+            return () if result.rowcount else None
+
+
 class DatabaseConnection(object, metaclass=Singleton):
+    def __init__(self):
+        self.profile_documents = ProfileDocuments() if ThorNodeConfig.json_updates else None
+        # maps (username, domain) to the XCAP documents in the profile of the account and their version
+        size, ttl = CacheConfig.profile_cache_size, CacheConfig.profile_cache_ttl
+        if multiprocess():
+            self.profile_cache = CoherentCache(size, ttl, 'profiles', version=lambda value: value[1])
+        else:
+            self.profile_cache = Cache(size, ttl)
+
     async def put(self, uri: XCAPUri, document: str, check_etag: Callable, new_etag: str) -> tuple:
-        operation = lambda profile: self._put_operation(uri, document, check_etag, new_etag, profile)
-        return await self.retrieve_profile(uri.user.username, uri.user.domain, operation, True)
+        try:
+            if self.profile_documents is not None:
+                result = await self.profile_documents.put(uri, document, check_etag, new_etag)
+                if result is not None:
+                    return result
+            operation = lambda profile: self._put_operation(uri, document, check_etag, new_etag, profile)
+            return await self.retrieve_profile(uri.user.username, uri.user.domain, operation, True)
+        finally:
+            self.profile_cache.invalidate((uri.user.username, uri.user.domain))
 
     async def delete(self, uri: XCAPUri, check_etag: Callable) -> tuple:
-        operation = lambda profile: self._delete_operation(uri, check_etag, profile)
-        return await self.retrieve_profile(uri.user.username, uri.user.domain, operation, True)
+        try:
+            if self.profile_documents is not None:
+                result = await self.profile_documents.delete(uri, check_etag)
+                if result is not None:
+                    return result
+            operation = lambda profile: self._delete_operation(uri, check_etag, profile)
+            return await self.retrieve_profile(uri.user.username, uri.user.domain, operation, True)
+        finally:
+            self.profile_cache.invalidate((uri.user.username, uri.user.domain))
 
     async def delete_all(self, uri: XCAPUri) -> None:
-        operation = lambda profile: self._delete_all_operation(uri, profile)
-        return await self.retrieve_profile(uri.user.username, uri.user.domain, operation, True)
+        try:
+            if self.profile_documents is not None:
+                if await self.profile_documents.delete_all(uri) is not None:
+                    return None
+            operation = lambda profile: self._delete_all_operation(uri, profile)
+            return await self.retrieve_profile(uri.user.username, uri.user.domain, operation, True)
+        finally:
+            self.profile_cache.invalidate((uri.user.username, uri.user.domain))
 
     async def get(self, uri: XCAPUri) -> tuple:
-        operation = lambda profile: self._get_operation(uri, profile)
-        return await self.retrieve_profile(uri.user.username, uri.user.domain, operation, False)
+        if self.profile_cache.enabled:
+            profile = {'xcap': await self._xcap_documents(uri.user.username, uri.user.domain) or {}}
+        elif self.profile_documents is not None:
+            # only the document is read from the profile
+            document = await self.read_profile(uri.user.username, uri.user.domain, 'xcap', uri.application_id, uri.doc_selector.document_path)
+            if document is None:
+                raise NotFound()
+            return tuple(document)
+        else:
+            profile = await self.read_profile(uri.user.username, uri.user.domain)
+        return self._get_operation(uri, profile or {})
 
     async def get_profile(self, username: str, domain: str) -> dict:
         return await self.retrieve_profile(username, domain, lambda profile: profile, False)
 
     async def get_documents_list(self, uri: XCAPUri) -> dict:
-        operation = lambda profile: self._get_documents_list_operation(uri, profile)
-        return await self.retrieve_profile(uri.user.username, uri.user.domain, operation, False)
+        if self.profile_cache.enabled:
+            xcap_docs = await self._xcap_documents(uri.user.username, uri.user.domain)
+        else:
+            xcap_docs = await self.read_profile(uri.user.username, uri.user.domain, 'xcap')
+        if xcap_docs is None:
+            raise NotFound()
+        return xcap_docs
+
+    async def _xcap_documents(self, username: str, domain: str) -> Optional[dict]:
+        key = (username, domain)
+        cached = self.profile_cache.get(key) if not reading_stored() else None
+        if cached is not None:
+            return cached[0]
+        token = self.profile_cache.reserve(key)
+        xcap_docs = await self.read_profile(username, domain, 'xcap')
+        self.profile_cache.fill(key, (xcap_docs, xcap_version(xcap_docs)), token)
+        return xcap_docs
+
+    async def read_profile(self, username: str, domain: str, *keys: str) -> Any:
+        """Return the value found at keys in the profile of an account, None
+        if it is missing, reading only the profile column. With the JSON
+        functions of the database only the value itself is read."""
+        data, meta = SipAccountData.__table__, SipAccount.__table__
+        if self.profile_documents is not None and keys:
+            column = func.json_extract(data.c.profile, json_path(*keys))
+        else:
+            column = data.c.profile
+        statement = (select(meta.c.id, column)
+                     .select_from(meta.outerjoin(data, data.c.account_id == meta.c.id))
+                     .where(meta.c.username == username, meta.c.domain == domain)
+                     .order_by(data.c.id).limit(1))
+        async with get_db_session() as db_session:
+            row = (await db_session.execute(statement)).first()
+        if row is None:
+            raise NotFound()
+        value = row[1]
+        if self.profile_documents is not None and keys:
+            return json.loads(value) if value is not None else None
+        for key in keys:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+        return value
 
     def _put_operation(self, uri: XCAPUri, document: str, check_etag: Callable, new_etag: str, profile: dict) -> tuple:
         xcap_docs = profile.setdefault("xcap", {})
@@ -232,7 +567,7 @@ class DatabaseConnection(object, metaclass=Singleton):
             raise NotFound()
         check_etag(etag)
         del xcap_docs[uri.application_id][uri.doc_selector.document_path]
-        return (etag)
+        return (etag,)
 
     def _delete_all_operation(self, uri: XCAPUri, profile: dict) -> None:
         xcap_docs = profile.setdefault("xcap", {})
@@ -247,13 +582,6 @@ class DatabaseConnection(object, metaclass=Singleton):
             raise NotFound()
         return doc, etag
 
-    def _get_documents_list_operation(self, uri: XCAPUri, profile: dict) -> dict:
-        try:
-            xcap_docs = profile["xcap"]
-        except KeyError:
-            raise NotFound()
-        return xcap_docs
-
     async def retrieve_profile(self, username: Optional[str], domain: Optional[str], operation: Callable, update: bool) -> Any:
         async with get_db_session() as db_session:
             query = await db_session.execute(select(SipAccount).where(
@@ -327,6 +655,7 @@ class SIPNotifier(object, metaclass=Singleton):
 class Storage(BackendInterface):
     def __init__(self):
         self._database = DatabaseConnection()
+        self.profile_cache = self._database.profile_cache
         self._provisioning = XCAPProvisioning()
         self._sip_notifier = SIPNotifier()
         self._notifier = Notifier(ServerConfig.root, self._sip_notifier.send_publish)
@@ -341,23 +670,36 @@ class Storage(BackendInterface):
         check_etag(etag)
         return StatusResponse(200, etag, doc.encode('utf-8'))
 
-    async def put_document(self, uri: XCAPUri, document: bytes, check_etag: Callable) -> Optional[StatusResponse]:
+    async def put_document(self, uri: XCAPUri, document: bytes, check_etag: Callable, base_etag: Optional[str] = None) -> Optional[StatusResponse]:
         decoded_document = document.decode('utf-8')
 
-        try:
-            server_document_response = await self.get_document(uri, check_etag)
-        except NotFound:
-            pass
+        if base_etag is None:
+            try:
+                server_document_response = await self.get_document(uri, check_etag)
+            except NotFound:
+                pass
+            else:
+                server_document = server_document_response.data  # type: ignore[union-attr]
+                if document == server_document:
+                    return server_document_response
         else:
-            server_document = server_document_response.data  # type: ignore[union-attr]
-            if document == server_document:
-                return server_document_response
+            # the version the document was made from is checked when the
+            # profile is changed, not against the cached one
+            check_etag = self._base_etag_check(check_etag, base_etag)
 
         self._normalize_document_path(uri)
         etag = make_random_etag(uri)
         result = await self._database.put(uri, decoded_document, check_etag, etag)
         return self._cb_put(result, uri, "%s@%s" % (uri.user.username, uri.user.domain))
 
+    @staticmethod
+    def _base_etag_check(check_etag: Callable, base_etag: str) -> Callable:
+        def check(etag, exists=True):
+            if etag != base_etag:
+                raise DocumentChanged
+            check_etag(etag, exists)
+        return check
+
     def _cb_put(self, result: tuple, uri: XCAPUri, thor_key: str) -> StatusResponse:
         if result[0]:
             code = 200
@@ -385,12 +727,15 @@ class Storage(BackendInterface):
     def _cb_delete(self, result: tuple, uri: XCAPUri, thor_key: str) -> StatusResponse:
         task = BackgroundTasks()
         task.add_task(BackgroundTask(self._provisioning.notify, "update", "sip_account", thor_key))
-        task.add_task(BackgroundTask(self._notifier.on_change, uri, result[1], None))
+        task.add_task(BackgroundTask(self._notifier.on_change, uri, result[0], None))
         return StatusResponse(200, background=task)
 
     async def get_watchers(self, uri: XCAPUri) -> dict:
         thor_key = "%s@%s" % (uri.user.username, uri.user.domain)
-        result = await self._provisioning.get_watchers(thor_key)
+        try:
+            result = await self._provisioning.get_watchers(thor_key)
+        except asyncio.TimeoutError:
+            raise HTTPError(PlainTextResponse("Timed out waiting for the watchers from the SIP proxy", status_code=504))
         return self._get_watchers_decode(result)
 
     def _get_watchers_decode(self, response: ThorResponse) -> dict:
@@ -418,6 +763,12 @@ class Storage(BackendInterface):
                         docs[k] = [(k2, v2[1])]
         return docs
 
+    @property
+    def thor_stats(self) -> Dict[str, Any]:
+        return {'requests': self._provisioning.bridge.stats,
+                'notifications': self._provisioning.notifications.stats,
+                'routing': self._provisioning.routing_stats}
+
     def stop(self):
         shutdown_db()
 
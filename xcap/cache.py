@@ -0,0 +1,162 @@
+"""In-process caches"""
+
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Hashable, Optional, Tuple
+
+from application import log
+from cachetools import LRUCache, TTLCache
+
+from xcap.sharedstate import ChangeLog
+
+
+class Cache(object):
+    """A bounded LRU cache with an optional per-entry time to live, which keeps
+    track of its hits and misses. A cache with a size of 0 is disabled.
+
+    A value read from the data source while it may be modified, e.g. across an
+    await, is stored with reserve() before reading it and fill() afterwards,
+    which does nothing if the entry was set or invalidated in the meantime,
+    since the value read may be older than the one stored by the writer."""
+
+    # the number of keys being read at the same time whose reservations are kept
+    reservations = 1024
+
+    def __init__(self, size: int, ttl: Optional[float] = None):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        if size <= 0:
+            self._cache: Optional[LRUCache] = None
+        elif ttl is None:
+            self._cache = LRUCache(maxsize=size)
+        else:
+            self._cache = TTLCache(maxsize=size, ttl=ttl)
+        self._reserved: LRUCache = LRUCache(maxsize=self.reservations)
+
+    @property
+    def enabled(self) -> bool:
+        return self._cache is not None
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        if self._cache is None:
+            return default
+        value = self._cache.get(key)
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self._cache is not None:
+            self._reserved.pop(key, None)
+            self._cache[key] = value
+
+    def store(self, key: Hashable, value: Any, previous: Any) -> None:
+        """Store the value of key just written to the data source, replacing
+        the one with version previous, None if it did not exist"""
+        self.set(key, value)
+
+    def invalidate(self, key: Hashable) -> None:
+        if self._cache is not None:
+            self._reserved.pop(key, None)
+            self._cache.pop(key, None)
+
+    def clear(self) -> None:
+        if self._cache is not None:
+            self._reserved.clear()
+            self._cache.clear()
+
+    def reserve(self, key: Hashable) -> object:
+        """Return the token for storing with fill() the value of key about to be read"""
+        token = object()
+        if self._cache is not None:
+            self._reserved[key] = token
+        return token
+
+    def fill(self, key: Hashable, value: Any, token: object) -> None:
+        """Store the value of key read after reserve() returned token, unless
+        the entry was changed since"""
+        if self._cache is not None and self._reserved.get(key) is token:
+            self.set(key, value)
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {'entries': len(self._cache) if self._cache is not None else 0,
+                'size': self.size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+class CoherentCache(Cache):
+    """A cache for data shared by several worker processes. When a worker
+    changes the data it publishes the new version of the entry in the change
+    log, and the entries changed by the other workers are removed when their
+    changes are read from the log, which is done by a thread, so that looking
+    up an entry does not wait for the shared state database. A version is
+    published only if the one it replaces is still the published one, else
+    all the workers remove the entry, so that a worker which was late in
+    publishing its change does not make the others keep an older version.
+    Entries may be used for up to ChangeLog.poll_interval seconds after they
+    were changed by another worker."""
+
+    def __init__(self, size: int, ttl: float, name: str, version: Callable[[Any], Any]):
+        super().__init__(size, ttl)
+        self.name = name
+        self.version = version
+        self.remote_invalidations = 0
+        self._changes: Deque[Tuple[Hashable, Any]] = deque()
+        if self.enabled:
+            self.log = ChangeLog()
+            self.log.subscribe(name, self._changed)
+
+    def _changed(self, key: Hashable, version: Any) -> None:
+        # called from the change log thread
+        self._changes.append((key, version))
+
+    def _apply_changes(self) -> None:
+        changes = self._changes
+        while changes:
+            key, version = changes.popleft()
+            value = self._cache.get(key)
+            if value is None or self.version(value) != version:
+                super().invalidate(key)
+                self.remote_invalidations += 1
+
+    def _publish(self, key: Hashable, previous: Any, version: Any) -> None:
+        # called from the change log writer thread
+        try:
+            published = self.log.publish(self.name, key, previous, version)
+        except Exception as e:
+            log.warning('Cannot publish the version of %s cache entry %r: %s' % (self.name, key, e))
+            published = False
+        if not published and version is not None:
+            self._changes.append((key, None))
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        if self._changes:
+            self._apply_changes()
+        return super().get(key, default)
+
+    def fill(self, key: Hashable, value: Any, token: object) -> None:
+        if self._changes:
+            self._apply_changes()
+        super().fill(key, value, token)
+
+    def store(self, key: Hashable, value: Any, previous: Any) -> None:
+        super().store(key, value, previous)
+        if self.enabled:
+            self.log.executor.submit(self._publish, key, previous, self.version(value))
+
+    def invalidate(self, key: Hashable) -> None:
+        super().invalidate(key)
+        if self.enabled:
+            self.log.executor.submit(self._publish, key, None, None)
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats
+        stats['remote_invalidations'] = self.remote_invalidations
+        return stats
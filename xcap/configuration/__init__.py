@@ -1,10 +1,25 @@
+import json
+import os
+
 from application.configuration import ConfigSection, ConfigSetting
-from application.configuration.datatypes import IPAddress, NetworkRangeList
+from application.configuration.datatypes import IPAddress
+from application.process import process
 
-from xcap.configuration.datatypes import (DatabaseURI, Path, ResponseCodeList,
-                                          XCAPRootURI)
+from xcap.configuration.datatypes import (DatabaseURI, NetworkIndex, Path,
+                                          ResponseCodeList, XCAPRootURI)
 from xcap.tls import Certificate, PrivateKey
 
+# Worker processes are started from scratch. They find the configuration and
+# runtime directories of the main process in the environment.
+PROCESS_ENVIRONMENT = 'OPENXCAP_PROCESS_DIRECTORIES'
+
+if PROCESS_ENVIRONMENT in os.environ:
+    _directories = json.loads(os.environ[PROCESS_ENVIRONMENT])
+    process.configuration.system_directory = _directories['system']
+    process.configuration.user_directory = _directories['user']
+    process.configuration.local_directory = _directories['local']
+    process.runtime.directory = _directories['runtime']
+
 
 class AuthenticationConfig(ConfigSection):
     __cfgfile__ = 'config.ini'
@@ -13,7 +28,10 @@ class AuthenticationConfig(ConfigSection):
     type = 'digest'
     cleartext_passwords = False
     default_realm = ConfigSetting(type=str, value=None)
-    trusted_peers = ConfigSetting(type=NetworkRangeList, value=NetworkRangeList('none'))
+    trusted_peers = ConfigSetting(type=NetworkIndex, value=NetworkIndex('none'))
+    stateless_nonces = True
+    nonce_lifetime = 900
+    nonce_secret = ConfigSetting(type=str, value=None)
 
 
 class ServerConfig(ConfigSection):
@@ -25,7 +43,9 @@ class ServerConfig(ConfigSection):
     root = ConfigSetting(type=XCAPRootURI, value=None)
     backend = ConfigSetting(type=str, value=None)
     allow_external_references = False
+    trusted_proxies = ConfigSetting(type=NetworkIndex, value=NetworkIndex('none'))
     tcp_port = ConfigSetting(type=int, value=35060)
+    workers = 1
 
 
 class TLSConfig(ConfigSection):
@@ -47,9 +67,32 @@ class DatabaseConfig(ConfigSection):
     domain_col = 'domain'
     password_col = 'password'
     ha1_col = 'ha1'
+    pool_size = 5
+    max_overflow = 10
+    pool_timeout = 30.0
+    pool_recycle = 3600
+    pool_pre_ping = False
+    statement_timeout = 0.0
+    lock_pool_size = 2
     xcap_table = 'xcap'
 
 
+class CacheConfig(ConfigSection):
+    __cfgfile__ = 'config.ini'
+    __section__ = 'Cache'
+
+    document_cache_size = 10000
+    document_cache_ttl = 60
+    parsed_document_cache_size = 1000
+    parsed_document_cache_ttl = 60
+    node_selector_cache_size = 1000
+    credential_cache_size = 10000
+    credential_cache_ttl = 60
+    unknown_user_cache_ttl = 10
+    profile_cache_size = 0
+    profile_cache_ttl = 10
+
+
 class OpensipsConfig(ConfigSection):
     __cfgfile__ = 'config.ini'
     __section__ = 'OpenSIPS'
@@ -77,4 +120,8 @@ class ThorNodeConfig(ConfigSection):
     certificate = ConfigSetting(type=Certificate, value=None)
     private_key = ConfigSetting(type=PrivateKey, value=None)
     ca = ConfigSetting(type=Certificate, value=None)
+    json_updates = False
+    request_timeout = 5
+    notification_delay = 0.5
+    lookup_cache_size = 10000
 
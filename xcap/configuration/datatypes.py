@@ -1,9 +1,12 @@
 
 """Configuration data types"""
+import ipaddress
 import os
 import re
+import socket
 import urllib.parse
 import sys
+from bisect import bisect_right
 from application import log
 
 
@@ -70,21 +73,76 @@ class XCAPRootURI(str):
 class DatabaseURI(str):
     """A database URI that automatically sets some default parameters if missing, based on scheme"""
 
+    drivers = {'mysql': 'mysql+aiomysql', 'sqlite': 'sqlite+aiosqlite'}
+
     def __new__(cls, value):
         if isinstance(value, str):
-            urllib.parse.uses_netloc.extend(['mysql', 'postgres', 'sqlite', 'sqlite+aiosqlite'])
-            urllib.parse.uses_relative.extend(['sqlite', 'sqlite+aiosqlite', 'postgres'])
-            dburi = urllib.parse.urlparse(value)
-            # set appropriate defaults for mysql's charset and sqlite's timeout if not specified
-            if dburi.scheme == 'mysql':
-                dburi = dburi._replace(scheme='mysql+aiomysql')
-            elif dburi.scheme == 'sqlite':
-                dburi = dburi._replace(scheme='sqlite+aiosqlite')
-            return super(DatabaseURI, cls).__new__(cls, urllib.parse.urlunparse(dburi))
+            # only replace the scheme, as parsing and unparsing the URI would
+            # drop the empty authority of sqlite URIs with an absolute path
+            scheme, separator, rest = value.partition(':')
+            if separator and scheme in cls.drivers:
+                value = cls.drivers[scheme] + separator + rest
+            return super(DatabaseURI, cls).__new__(cls, value)
         else:
             raise TypeError('value should be a string')
 
 
+class NetworkIndex(object):
+    """A comma separated list of IPv4 and IPv6 networks, hosts and addresses.
+
+    The networks are merged into sorted, non-overlapping address intervals
+    when the configuration is read, so that checking if an address belongs
+    to any of them is a binary search. IPv4-mapped IPv6 addresses are looked
+    up as IPv4 addresses.
+    """
+
+    def __init__(self, value):
+        networks = []
+        for item in re.split(r'\s*,\s*', value.strip()) if value else []:
+            if item.lower() in ('', 'none'):
+                continue
+            elif item.lower() == 'any':
+                networks.extend([ipaddress.ip_network('0.0.0.0/0'), ipaddress.ip_network('::/0')])
+                continue
+            try:
+                networks.append(ipaddress.ip_network(item, strict=False))
+            except ValueError:
+                try:
+                    addresses = {info[4][0] for info in socket.getaddrinfo(item, None, proto=socket.IPPROTO_TCP)}
+                except socket.error as e:
+                    raise ValueError('invalid network or unknown host: %r (%s)' % (item, e))
+                networks.extend(ipaddress.ip_network(address.split('%')[0]) for address in addresses)
+        self._networks = tuple(networks)
+        self._starts = {4: [], 6: []}
+        self._ends = {4: [], 6: []}
+        for network in sorted(networks, key=lambda network: (network.version, int(network.network_address))):
+            start, end = int(network.network_address), int(network.broadcast_address)
+            starts, ends = self._starts[network.version], self._ends[network.version]
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+
+    def __contains__(self, address):
+        if not isinstance(address, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
+            try:
+                address = ipaddress.ip_address(address)
+            except ValueError:
+                return False
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        value = int(address)
+        index = bisect_right(self._starts[address.version], value) - 1
+        return index >= 0 and value <= self._ends[address.version][index]
+
+    def __bool__(self):
+        return bool(self._networks)
+
+    def __repr__(self):
+        return '{0.__class__.__name__}({1!r})'.format(self, ', '.join(str(network) for network in self._networks) or 'none')
+
+
 class Backend(object):
     """Configuration datatype, used to select a backend module from the configuration file."""
     def __new__(typ, value):
@@ -99,6 +157,18 @@ class Backend(object):
             sys.exit(1)
 
 
+class ElementEngine(object):
+    """Configuration datatype, used to select the module implementing the element operations."""
+    engines = {'sax': 'xcap.element', 'lxml': 'xcap.lxmlelement'}
+
+    def __new__(typ, value):
+        try:
+            module = typ.engines[value.lower()]
+        except KeyError:
+            raise ValueError('invalid element engine: %r (must be one of %s)' % (value, ', '.join(typ.engines)))
+        return __import__(module, globals(), locals(), [''])
+
+
 class Path(str):
     def __new__(cls, path):
         path = path.strip('"\'')
@@ -140,6 +210,9 @@ class ResponseCodeList(object):
     def __contains__(self, item):
         return item in self._codes
 
+    def __bool__(self):
+        return bool(self._codes)
+
     def __repr__(self):
         if isinstance(self._codes, MatchAnyCode):
             value = 'all'
@@ -1,88 +1,236 @@
+"""Per-user locks held while the documents of a user are read and modified
+
+The requests of a worker process wait for each other on an asyncio lock per
+user, so only one request per user and process goes on to take the lock
+shared with the other processes:
+
+MySQL: a GET_LOCK() named lock, held by a connection of a small pool of its
+own, so the requests holding the locks do not use the connections of the
+storage.
+
+SQLite: used by the processes of a single host, an flock() on one of 65536
+lock files in the runtime directory, picked by hashing the lock name. The
+lock is polled without blocking while another process holds it. With a
+single worker process the asyncio lock is enough.
+"""
+
 import asyncio
+import fcntl
+import hashlib
+import math
 import os
 import time
+import zlib
 from contextlib import asynccontextmanager
-from typing import AsyncGenerator
+from typing import Any, AsyncGenerator, Dict, Optional
 
+from application import log
+from application.process import process
 from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
 
-from xcap.db.manager import connection_manager, get_db_session
+from xcap.db.manager import connection_manager
+from xcap.sharedstate import multiprocess
 
+__all__ = ['LockTimeout', 'LockManager', 'lock_manager', 'lock_document']
 
-@asynccontextmanager
-async def lock_document(
-    user: str,
-    timeout: int = 3
-) -> AsyncGenerator[None, None]:
-    """
-    Acquire a named lock per user using database-level locking.
-    All documents for a user are protected by a single lock.
 
-    MySQL: Uses GET_LOCK() / RELEASE_LOCK()
-    SQLite: Uses a locks table with atomic updates
-    """
-    lock_name = f"xcap_{user}"
+class LockTimeout(TimeoutError):
+    """The lock could not be acquired in time"""
 
-    async with get_db_session() as session:
-        db_uri = connection_manager.dburi or str(connection_manager._engine.url)
 
-        if 'mysql' in db_uri:
-            # MySQL: Use GET_LOCK for named locks
-            result = await session.execute(
-                text("SELECT GET_LOCK(:lock_name, :timeout)"),
-                {"lock_name": lock_name, "timeout": timeout}
-            )
+class MySQLLocks(object):
+    """Named locks of the MySQL server"""
+
+    max_name_length = 64
+
+    def name(self, name: str) -> str:
+        if len(name) > self.max_name_length:
+            return 'xcap_' + hashlib.sha1(name.encode()).hexdigest()
+        return name
+
+    async def acquire(self, name: str, timeout: float) -> AsyncConnection:
+        engine = connection_manager._lock_engine
+        connection = await engine.connect()
+        try:
+            result = await connection.execute(text("SELECT GET_LOCK(:lock_name, :timeout)"),
+                                              {"lock_name": self.name(name), "timeout": max(math.ceil(timeout), 0)})
             locked = result.scalar()
+        except BaseException:
+            # the lock may have been taken, it is released with the session
+            await connection.invalidate()
+            raise
+        if not locked:
+            await connection.close()
+            raise LockTimeout(f"Failed to acquire lock on {name}")
+        return connection
 
-            if not locked:
-                raise TimeoutError(f"Failed to acquire lock on {lock_name}")
+    async def release(self, name: str, connection: AsyncConnection) -> None:
+        try:
+            await connection.execute(text("SELECT RELEASE_LOCK(:lock_name)"), {"lock_name": self.name(name)})
+            await connection.commit()
+        except BaseException:
+            await connection.invalidate()
+            raise
+        finally:
+            await connection.close()
 
-            try:
-                yield
-            finally:
-                await session.execute(
-                    text("SELECT RELEASE_LOCK(:lock_name)"),
-                    {"lock_name": lock_name}
-                )
-                await session.commit()
-
-        elif 'sqlite' in db_uri:
-            # SQLite: Use a locks table
-            await session.execute(text("""
-                CREATE TABLE IF NOT EXISTS document_locks (
-                    lock_name TEXT PRIMARY KEY,
-                    acquired_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    pid INTEGER
-                )
-            """))
-            await session.commit()
-
-            start_time = time.time()
+
+class FileLocks(object):
+    """Locks on the lock files in the runtime directory, shared by the worker
+    processes on this host. The locks are taken without blocking, and when
+    they are held by another process taking them is tried again after a delay
+    which grows up to max_delay, so that waiting does not use a thread."""
+
+    slots = 65536
+    directory_name = 'locks'
+    min_delay = 0.001
+    max_delay = 0.05
+
+    def __init__(self):
+        self.directory = None
+        self.retries = 0
+
+    def _open(self, name: str) -> int:
+        if self.directory is None:
+            process.runtime.create_directory()
+            self.directory = process.runtime.file(self.directory_name)
+        slot = '%04x' % (zlib.crc32(name.encode()) % self.slots)
+        directory = os.path.join(self.directory, slot[:2])
+        os.makedirs(directory, exist_ok=True)
+        return os.open(os.path.join(directory, slot[2:]), os.O_RDWR | os.O_CREAT, 0o600)
+
+    async def acquire(self, name: str, timeout: float) -> int:
+        fd = self._open(name)
+        try:
+            deadline = time.monotonic() + timeout
+            delay = self.min_delay
             while True:
                 try:
-                    await session.execute(
-                        text("""
-                            INSERT INTO document_locks (lock_name, pid)
-                            VALUES (:lock_name, :pid)
-                        """),
-                        {"lock_name": lock_name, "pid": os.getpid()}
-                    )
-                    await session.commit()
-                    break
-                except Exception:
-                    if time.time() - start_time > timeout:
-                        raise TimeoutError(f"Failed to acquire lock on {lock_name}")
-                    await session.rollback()
-                    await asyncio.sleep(0.01)
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    pass
+                else:
+                    return fd
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise LockTimeout(f"Failed to acquire lock on {name}")
+                self.retries += 1
+                await asyncio.sleep(min(delay, remaining))
+                delay = min(delay * 2, self.max_delay)
+        except BaseException:
+            os.close(fd)
+            raise
+
+    async def release(self, name: str, fd: int) -> None:
+        os.close(fd)
+
 
+class UserLock(object):
+    """The lock of the requests of a user in this process"""
+
+    __slots__ = ('lock', 'users')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class LockManager(object):
+    """The locks on the documents of the users"""
+
+    def __init__(self):
+        self._locks: Dict[str, UserLock] = {}
+        self._mysql_locks = MySQLLocks()
+        self._file_locks: Optional[FileLocks] = None
+        self.acquisitions = 0
+        self.contended = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.shared_wait_time = 0.0
+
+    def _shared_locks(self):
+        """Return the locks shared with the other processes, None if there are no other processes"""
+        engine = connection_manager._engine
+        if engine is None:
+            return None
+        dialect = engine.dialect.name
+        if dialect == 'mysql':
+            return self._mysql_locks
+        elif dialect == 'sqlite':
+            if not multiprocess():
+                return None
+            if self._file_locks is None:
+                self._file_locks = FileLocks()
+            return self._file_locks
+        raise ValueError(f"Unsupported database: {engine.url}")
+
+    @asynccontextmanager
+    async def lock(self, name: str, timeout: float = 3) -> AsyncGenerator[None, None]:
+        start = time.perf_counter()
+        user_lock = self._locks.get(name)
+        if user_lock is None:
+            user_lock = self._locks[name] = UserLock()
+        user_lock.users += 1
+        try:
+            contended = user_lock.lock.locked()
+            try:
+                await asyncio.wait_for(user_lock.lock.acquire(), timeout)
+            except asyncio.TimeoutError:
+                self._record(start, contended, timed_out=True)
+                raise LockTimeout(f"Failed to acquire lock on {name}")
             try:
-                yield
+                shared_locks = self._shared_locks()
+                if shared_locks is not None:
+                    shared_start = time.perf_counter()
+                    try:
+                        shared_lock = await shared_locks.acquire(name, timeout - (shared_start - start))
+                    except LockTimeout:
+                        self._record(start, contended, timed_out=True)
+                        raise
+                    self.shared_wait_time += time.perf_counter() - shared_start
+                self._record(start, contended)
+                try:
+                    yield
+                finally:
+                    if shared_locks is not None:
+                        await shared_locks.release(name, shared_lock)
             finally:
-                await session.execute(
-                    text("DELETE FROM document_locks WHERE lock_name = :lock_name"),
-                    {"lock_name": lock_name}
-                )
-                await session.commit()
-
-        else:
-            raise ValueError(f"Unsupported database: {db_uri}")
+                user_lock.lock.release()
+        finally:
+            user_lock.users -= 1
+            if not user_lock.users:
+                del self._locks[name]
+
+    def _record(self, start: float, contended: bool, timed_out: bool = False) -> None:
+        elapsed = time.perf_counter() - start
+        self.acquisitions += 1
+        self.contended += contended
+        self.timeouts += timed_out
+        self.wait_time += elapsed
+        self.max_wait_time = max(self.max_wait_time, elapsed)
+        if timed_out:
+            log.warning(f'Timed out after {elapsed:.2f} s waiting for a document lock, {len(self._locks)} users locked')
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        locked = sum(1 for user_lock in self._locks.values() if user_lock.lock.locked())
+        return {'locked': locked,
+                'waiting': sum(user_lock.users for user_lock in self._locks.values()) - locked,
+                'acquisitions': self.acquisitions,
+                'contended': self.contended,
+                'timeouts': self.timeouts,
+                'wait_time': self.wait_time,
+                'shared_wait_time': self.shared_wait_time,
+                'shared_retries': self._file_locks.retries if self._file_locks is not None else 0,
+                'max_wait_time': self.max_wait_time,
+                'average_wait_time': self.wait_time / self.acquisitions if self.acquisitions else 0.0}
+
+
+lock_manager = LockManager()
+
+
+def lock_document(user: Any, timeout: float = 3):
+    """Lock all the documents of a user, waiting at most timeout seconds"""
+    return lock_manager.lock(f"xcap_{user}", timeout)
@@ -1,15 +1,18 @@
 import asyncio
 import sys
 from contextlib import asynccontextmanager
-from typing import AsyncIterator, Callable, Optional
+from time import perf_counter
+from typing import Any, AsyncIterator, Callable, Dict, Optional
 
 from application import log
 from application.notification import (IObserver, Notification,
                                       NotificationCenter)
-from sqlalchemy import event
+from sqlalchemy import event, exc
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import (AsyncEngine, AsyncSession,
                                     create_async_engine)
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlmodel import SQLModel
 from zope.interface import implementer
 
@@ -18,6 +21,61 @@ from xcap.configuration.datatypes import DatabaseURI
 from xcap.errors import DBError, NoDatabase
 
 
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """A connection pool which keeps track of the time spent waiting for a
+    connection, of the connections opened beyond the size of the pool and of
+    the checkouts which timed out because the pool was exhausted."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.overflows = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def recreate(self) -> 'InstrumentedPool':
+        # the pool is recreated when the engine is disposed, keep the counters
+        pool = super().recreate()
+        for name in ('checkouts', 'timeouts', 'overflows', 'wait_time', 'max_wait_time'):
+            setattr(pool, name, getattr(self, name))
+        return pool
+
+    def connect(self):
+        start = perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            log.warning(f'Timed out waiting for a database connection: {self.status()}')
+            raise
+        finally:
+            elapsed = perf_counter() - start
+            self.checkouts += 1
+            self.wait_time += elapsed
+            self.max_wait_time = max(self.max_wait_time, elapsed)
+
+    def _inc_overflow(self) -> bool:
+        if not super()._inc_overflow():
+            return False
+        if self.overflow() > 0:
+            self.overflows += 1
+        return True
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {'size': self.size(),
+                'checked_in': self.checkedin(),
+                'checked_out': self.checkedout(),
+                'overflow': max(self.overflow(), 0),
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'overflows': self.overflows,
+                'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time,
+                'average_wait_time': self.wait_time / self.checkouts if self.checkouts else 0.0}
+
+
 @implementer(IObserver)
 class DatabaseConnectionManager:
     AsyncSessionLocal: Optional[Callable] = None
@@ -26,6 +84,7 @@ class DatabaseConnectionManager:
 
     _engine = None
     _auth_engine = None
+    _lock_engine = None
 
     def __init__(self):
         NotificationCenter().add_observer(self)
@@ -34,26 +93,60 @@ class DatabaseConnectionManager:
         if notification.name == 'db_uri':
             self.configure_db_connection(notification.data)
 
-    def create_engine(self, uri: DatabaseURI) -> AsyncEngine:
+    def create_engine(self, uri: DatabaseURI, pool_size: Optional[int] = None) -> AsyncEngine:
+        pool_args = dict(poolclass=InstrumentedPool,
+                         pool_size=pool_size or DatabaseConfig.pool_size,
+                         max_overflow=DatabaseConfig.max_overflow,
+                         pool_timeout=DatabaseConfig.pool_timeout,
+                         pool_recycle=DatabaseConfig.pool_recycle,
+                         pool_pre_ping=DatabaseConfig.pool_pre_ping)
         if uri.startswith('sqlite'):
-            engine = create_async_engine(uri, connect_args={"check_same_thread": False}, echo=False)
+            if make_url(uri).database in (None, '', ':memory:'):
+                pool_args = {}  # an in-memory database uses a single connection
+            engine = create_async_engine(uri, connect_args={"check_same_thread": False}, echo=False, **pool_args)
         elif uri.startswith('mysql'):
-            engine = create_async_engine(uri, echo=False)
+            engine = create_async_engine(uri, echo=False, **pool_args)
+            if DatabaseConfig.statement_timeout:
+                self._set_statement_timeout(engine, DatabaseConfig.statement_timeout)
         else:
             raise ValueError("Unsupported database URI scheme")
 
         @event.listens_for(engine.sync_engine, "handle_error")
-        def handle_error(exc):
-            original_exception = exc.original_exception
+        def handle_error(context):
+            if isinstance(context.sqlalchemy_exception, exc.IntegrityError):
+                return  # constraint violations are handled by the storage
+            original_exception = context.original_exception
             exception_type = type(original_exception).__name__
-            error_code = getattr(original_exception, 'args', [None, None])[0]
-            error_message = getattr(original_exception, 'args', [None, None])[1]
+            args = tuple(getattr(original_exception, 'args', ())) + (None, None)
+            error_code, error_message = args[0], args[1]
 
             log.error(f"{exception_type}: {error_code}, \"{error_message}\"")
             raise DBError()
 
         return engine
 
+    @staticmethod
+    def _set_statement_timeout(engine: AsyncEngine, timeout: float) -> None:
+        @event.listens_for(engine.sync_engine, "connect")
+        def set_statement_timeout(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            try:
+                cursor.execute(f"SET SESSION max_execution_time = {int(timeout * 1000)}")
+            except Exception:
+                # MariaDB has a different variable, in seconds
+                cursor.execute(f"SET SESSION max_statement_time = {timeout}")
+            finally:
+                cursor.close()
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """The statistics of the connection pools of the storage and authentication databases"""
+        stats = {}
+        for name, engine in (('storage', self._engine), ('authentication', self._auth_engine), ('locks', self._lock_engine)):
+            if engine is not None and isinstance(engine.pool, InstrumentedPool):
+                stats[name] = engine.pool.stats
+        return stats
+
     def close_engine(self, engine):
         if engine is None:
             return
@@ -72,6 +165,7 @@ class DatabaseConnectionManager:
 
         self.close_engine(self._engine)
         self.close_engine(self._auth_engine)
+        self.close_engine(self._lock_engine)
 
         if uri and ServerConfig.backend == 'SIPThor':
             storage_db_uri = authentication_db_uri = uri
@@ -81,6 +175,10 @@ class DatabaseConnectionManager:
 
         self._engine = self.create_engine(storage_db_uri)
         self._auth_engine = self.create_engine(authentication_db_uri)
+        # the named locks of MySQL are held by a connection for as long as the
+        # documents of a user are modified, they have their own pool so that
+        # they do not take the connections of the storage
+        self._lock_engine = self.create_engine(storage_db_uri, DatabaseConfig.lock_pool_size) if storage_db_uri.startswith('mysql') else None
 
         self.dburi = uri
         self.AsyncSessionLocal = sessionmaker(bind=self._engine, class_=AsyncSession, expire_on_commit=False)
@@ -122,4 +220,6 @@ def shutdown_db():
         connection_manager.close_engine(connection_manager._engine)
     if getattr(connection_manager, "_auth_engine", None):
         connection_manager.close_engine(connection_manager._auth_engine)
+    if getattr(connection_manager, "_lock_engine", None):
+        connection_manager.close_engine(connection_manager._lock_engine)
 
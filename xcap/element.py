@@ -17,12 +17,17 @@ the content of a new element. For RFC compliant behavior, fix such requests
 by replacing '*' with the root tag of the new element.
 """
 
+import re
 from io import StringIO
 from xml import sax
 
 from xcap import uri
 
 
+# this engine works on the document text and does not use its parsed tree
+tree_based = False
+
+
 def make_parser():
     parser = sax.make_parser(['xcap.sax.expatreader'])
     parser.setFeature(sax.handler.feature_namespaces, 1)
@@ -82,6 +87,12 @@ class Step(object):
         return '%s[pos=%s]' % (self.name, self.position)
 
 
+def end_tag(name):
+    """Return the pattern of the end tag of the element with the given local
+    name, which has a prefix if the element is in a prefixed namespace"""
+    return re.compile(rb'</(?:[^\s/>:]+:)?%s\s*>' % re.escape(name.encode()))
+
+
 class ContentHandlerBase(sax.ContentHandler):
 
     def __init__(self, selector):
@@ -106,12 +117,10 @@ class ContentHandlerBase(sax.ContentHandler):
         self.end_pos_2 = end_pos_2
 
     def fix_end_pos(self, document):
-        document = document.decode()
-        if self.end_tag is not None and self.end_tag in document[self.end_pos:self.end_pos_2]:
-            if self.end_pos_2 is None:
-                self.end_pos = 1 + document.index('>', self.end_pos)
-            else:
-                self.end_pos = 1 + document.index('>', self.end_pos, self.end_pos_2)
+        # the positions are byte offsets in the document
+        end_pos_2 = len(document) if self.end_pos_2 is None else self.end_pos_2
+        if self.end_tag is not None and self.end_tag.search(document, self.end_pos, end_pos_2):
+            self.end_pos = 1 + document.index(b'>', self.end_pos, end_pos_2)
 
     def __repr__(self):
         return '<%s selector=%r state=%r>' % (self.__class__.__name__, self.selector, self.state)
@@ -205,7 +214,7 @@ class ElementLocator(ContentHandlerBase):
             qname = self.path[-1].name[1]
             if not qname:
                 qname=''
-            self.set_end_pos(self.pos(), '</' + qname + '>')
+            self.set_end_pos(self.pos(), end_tag(qname))
             # where does pos() point to? two cases:
             # 1. <name>....*HERE*</name>
             # 2. <name/>*HERE*...
@@ -237,12 +246,18 @@ class InsertPointLocator(ContentHandlerBase):
         self.curstep = 0
         self.skiplevel = 0
         self.set_end_pos(None, None, None)
+        # true between the start of an element and its end if it has no content
+        self.empty = False
+        # true if the insertion point is at the end of a parent which has no
+        # content, which may be an empty element tag with no room for it
+        self.empty_parent = False
 
     def startElementNS(self, name, qname, attrs):
         if not qname:
             qname = name
         #print '<' * (1+len(self.path) + self.skiplevel), name, '/' + '/'.join(map(str, self.path)),
         #print self.curstep, self.skiplevel
+        self.empty = True
 
         if self.state=='DONE' and self.end_pos_2 is None:
             self.end_pos_2 = self.pos()
@@ -287,9 +302,13 @@ class InsertPointLocator(ContentHandlerBase):
         self.curstep += 1
         self.path.append(Step(qname))
 
+    def characters(self, content):
+        self.empty = False
+
     def endElementNS(self, name, qname):
         #print '>' * (1+len(self.path)+self.skiplevel-1), name, '/' + '/'.join(map(str, self.path)),
         #print self.curstep, self.skiplevel
+        empty, self.empty = self.empty, False
 
         if self.state=='DONE' and self.end_pos_2 is None:
             self.end_pos_2 = self.pos()
@@ -311,13 +330,13 @@ class InsertPointLocator(ContentHandlerBase):
                     self.set_state('MANY')
                 else:
                     self.set_state('CLOSED')
-                self.set_end_pos(self.pos(), '</' + qname + '>')
+                self.set_end_pos(self.pos(), end_tag(qname))
             elif curstep.position-1 == parent.position:
                 if self.state=='DONE':
                     self.set_state('MANY')
                 else:
                     self.set_state('DONE')
-                self.set_end_pos(self.pos(), '</' + qname + '>')
+                self.set_end_pos(self.pos(), end_tag(qname))
         elif len(self.path)+1==len(self.selector):
             if self.state == 'CLOSED':
                 self.set_state('DONE')
@@ -326,6 +345,7 @@ class InsertPointLocator(ContentHandlerBase):
             elif self.state == 'LOOKING':
                 self.set_state('DONE')
                 self.set_end_pos(self.pos(), end_pos_2 = self.pos())
+                self.empty_parent = empty
 
         element = self.path.pop()
         self.curstep -= 1
@@ -342,7 +362,7 @@ class LocatorError(ValueError):
         if locator.state == 'LOOKING':
             return None
         elif locator.state == 'MANY':
-            raise SelectorError(element_selector._original_string, locator)
+            raise SelectorError(element_selector._original_selector, locator)
         else:
             raise LocatorError('Internal error in %s' % locator.__class__.__name__, locator)
 
@@ -355,11 +375,12 @@ class SelectorError(LocatorError):
         LocatorError.__init__(self, msg, handler)
 
 
-def find(document, element_selector):
+def find(document, element_selector, xml_doc=None):
     """Return an element as (first index, last index+1)
 
     If it couldn't be found, return None.
     If there're several matches, raise SelectorError.
+    xml_doc is accepted for compatibility with the tree based engines and is ignored.
     """
     parser = make_parser()
     el = ElementLocator(element_selector)
@@ -371,7 +392,7 @@ def find(document, element_selector):
     else:
         return LocatorError.generate_error(el, element_selector)
 
-def get(document, element_selector):
+def get(document, element_selector, xml_doc=None):
     """Return an element as a string.
 
     If it couldn't be found, return None.
@@ -382,7 +403,7 @@ def get(document, element_selector):
         start, end = location
         return document[start:end]
 
-def delete(document, element_selector):
+def delete(document, element_selector, xml_doc=None):
     """Return document with element deleted.
 
     If it couldn't be found, return None.
@@ -393,7 +414,7 @@ def delete(document, element_selector):
         start, end = location
         return document[:start] + document[end:]
 
-def put(document, element_selector, element_str):
+def put(document, element_selector, element_str, xml_doc=None):
     """Return a 2-items tuple: (new_document, created).
     new_document is a copy of document with element_str inside.
     created is True if insertion was performed as opposed to replacement.
@@ -414,6 +435,9 @@ def put(document, element_selector, element_str):
         parser.parse(StringIO(document.decode()))
         if ipl.state == 'DONE':
             ipl.fix_end_pos(document)
+            if ipl.empty_parent and document[:ipl.end_pos].endswith(b'/>'):
+                # the parent is an empty element tag
+                return None
             start, end = ipl.end_pos, ipl.end_pos
             created = True
         else:
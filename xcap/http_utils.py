@@ -1,18 +1,35 @@
 import datetime
+import ipaddress
 from typing import List, Optional
 
 from fastapi import Request
 
+from xcap.configuration import ServerConfig
+
 
 def get_client_ip(request: Request) -> Optional[str]:
+    """Return the address of the client that made the request.
+
+    X-Forwarded-For is only used when the request comes from one of the
+    trusted proxies, in which case the addresses it lists are followed from
+    the last one for as long as they are trusted proxies as well.
+    """
+    if request.client is None:
+        return None
+
+    client_ip = request.client.host
     forwarded_for = request.headers.get('X-Forwarded-For')
 
-    if forwarded_for:
-        client_ip = forwarded_for.split(',')[0].strip()
-    elif request.client:
-        client_ip = request.client.host
-    else:
-        client_ip = None
+    if forwarded_for and ServerConfig.trusted_proxies:
+        for address in reversed(forwarded_for.split(',')):
+            if client_ip not in ServerConfig.trusted_proxies:
+                break
+            address = address.strip()
+            try:
+                ipaddress.ip_address(address)
+            except ValueError:
+                break
+            client_ip = address
 
     return client_ip
 
@@ -1,11 +1,11 @@
 import os
-from collections.abc import MutableMapping
+from collections.abc import Mapping, MutableMapping
 from logging import FileHandler
-from typing import Any, Dict, Optional, Union
+from typing import Any, Dict, List, Optional, Union
 
 from application import log
 from application.system import makedirs
-from fastapi import Request, Response
+from fastapi import Request
 
 from xcap.configuration import LoggingConfig
 from xcap.http_utils import get_client_ip
@@ -13,13 +13,15 @@ from xcap.http_utils import get_client_ip
 
 class AccessLog(object):
     access_type: Optional[str] = None
+    body_limit = 500
 
-    def __init__(self, headers: Dict[str, str], body: Union[bytes, str, None] = None, code: int = 0):
+    def __init__(self, headers: Dict[str, str], body: Union[bytes, str, None] = None, code: int = 0, size: Optional[int] = None):
         self.logger = access_file_logger
 
         self.headers = headers
         self.body = body
         self.code = code
+        self.size = len(body) if size is None and body is not None else size
 
     def _log(self) -> None:
         self.logger.info(f'\n{"-" * 2} {self.access_type} {"-" * 38}')
@@ -28,7 +30,8 @@ class AccessLog(object):
 
         if self.body:
             content = self.body.decode('utf-8', errors='replace') if isinstance(self.body, bytes) else self.body
-            self.logger.info("\n" + (content[:500] + "\n..." if len(content) > 500 else content) + "\n")
+            truncated = len(content) > self.body_limit or (self.size or 0) > len(self.body)
+            self.logger.info("\n" + (content[:self.body_limit] + "\n..." if truncated else content) + "\n")
         elif isinstance(self, AccessLogResponse):
             self.logger.info("")
 
@@ -55,6 +58,29 @@ class AccessLogResponse(AccessLog):
             self.request = None
             self.headers = None
 
+class BodyTap(object):
+    """Count the bytes of a body streamed through the server, keeping only
+    the first bytes that are needed for the access log"""
+
+    def __init__(self, enabled: bool = True, limit: int = AccessLog.body_limit + 1):
+        self.enabled = enabled
+        self.limit = limit
+        self.size = 0
+        self._chunks: List[bytes] = []
+        self._kept = 0
+
+    def feed(self, chunk: bytes) -> None:
+        self.size += len(chunk)
+        if self.enabled and self._kept < self.limit:
+            chunk = chunk[:self.limit - self._kept]
+            self._chunks.append(chunk)
+            self._kept += len(chunk)
+
+    @property
+    def body(self) -> bytes:
+        return b''.join(self._chunks)
+
+
 access_logger = log.get_logger('access')
 file_formatter = log.Formatter()
 file_formatter.prefix_format = ''
@@ -84,12 +110,11 @@ def get_request_version(scope: MutableMapping[str, Any]) -> str:
     return f'{request_type.upper()}/{http_version_value.upper()}'
 
 
-def log_access(request: Request, response: Response, body: Union[bytes, str]) -> None:
+def log_access(request: Request, status_code: int, headers: Mapping[str, str], size: int) -> None:
     client_ip = get_client_ip(request)
     user_agent = request.headers.get("user-agent", "unknown")
-    etag = response.headers.get("etag", None)
+    etag = headers.get("etag", None)
     method = request.method
     http_version = get_request_version(request.scope)
     path = request.url.path
-    status_code = response.status_code
-    access_logger.info(f"{client_ip} - \"{method} {path} {http_version}\" {status_code} {len(body)} {user_agent} {etag if etag else ''}")
+    access_logger.info(f"{client_ip} - \"{method} {path} {http_version}\" {status_code} {size} {user_agent} {etag if etag else ''}")
@@ -0,0 +1,257 @@
+
+"""Element handling as described in RFC 4825, using lxml.
+
+This module is an alternative to xcap.element with the same interface and
+semantics. Instead of running a SAX handler over the whole document, the
+element selector is compiled to an XPath expression which is evaluated on the
+lxml tree of the document. The elements found in the tree are then mapped to
+byte offsets in the document, so that GET returns the element exactly as it
+appears in the document and PUT/DELETE only replace the bytes of the element,
+leaving the rest of the document untouched.
+
+An element is mapped to its offsets using its index in document order: the
+start tag with that index is located by a regular expression which skips
+comments, CDATA sections, processing instructions and end tags, and the end
+of the element is found from the start tag of its last descendant, after
+which only end tags can follow until the end of the element.
+"""
+
+import re
+from io import BytesIO
+from itertools import islice
+
+from lxml import etree
+
+from xcap import errors
+from xcap.cache import Cache
+from xcap.configuration import CacheConfig
+from xcap.element import LocatorError, SelectorError
+
+__all__ = ['find', 'get', 'delete', 'put', 'LocatorError', 'SelectorError']
+
+
+# this engine can use the parsed tree of the document if the caller has it
+tree_based = True
+
+_markup = rb'<!--.*?-->|<!\[CDATA\[.*?\]\]>|<\?.*?\?>|<!DOCTYPE[^\[>]*(?:\[.*?\])?\s*>'
+
+# matches the document text up to and including the '<' of the next start tag
+_next_start_tag = re.compile(rb'[^<]*(?:(?:%s|</[^>]*>)[^<]*)*<(?=[^/!?])' % _markup, re.S)
+
+# matches a start tag, the group is '/' for an empty element tag
+_start_tag = re.compile(rb'<[^\s/>]+(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*(/?)>')
+
+# matches the document text up to and including the next end tag, provided
+# there is no start tag in between. The group is the end tag
+_next_end_tag = re.compile(rb'[^<]*(?:(?:%s)[^<]*)*(</[^>]*>)' % _markup, re.S)
+
+_element_index = etree.XPath('count(preceding::*) + count(ancestor::*)')
+_descendant_count = etree.XPath('count(descendant::*)')
+_last_descendant = etree.XPath('descendant::*[last()]')
+
+# maps the steps of an element selector to the compiled XPath expression
+_expressions = Cache(CacheConfig.node_selector_cache_size)
+
+
+def _literal(value):
+    """Return an XPath string literal for value"""
+    if '"' not in value:
+        return '"%s"' % value
+    elif "'" not in value:
+        return "'%s'" % value
+    return 'concat(%s)' % ', \'"\', '.join('"%s"' % part for part in value.split('"'))
+
+
+def _tag(name):
+    namespace, name = name
+    return '{%s}%s' % (namespace, name) if namespace else name
+
+
+def _compile(steps):
+    """Return the compiled XPath expression matching the elements selected by steps"""
+    key = tuple((step.name, step.position, step.att_name, step.att_value) for step in steps)
+    expression = _expressions.get(key)
+    if expression is None:
+        prefixes = {}
+        path = []
+        for step in steps:
+            if step.name == '*':
+                test = '*'
+            else:
+                namespace, name = step.name
+                if namespace:
+                    prefix = prefixes.setdefault(namespace, 'ns%d' % len(prefixes))
+                    test = '%s:%s' % (prefix, name)
+                else:
+                    test = name
+            if step.position is not None:
+                test += '[%d]' % step.position
+            if step.att_name is not None:
+                namespace, name = step.att_name
+                if namespace:
+                    prefix = prefixes.setdefault(namespace, 'ns%d' % len(prefixes))
+                    name = '%s:%s' % (prefix, name)
+                test += '[@%s=%s]' % (name, _literal(step.att_value))
+            path.append(test)
+        expression = etree.XPath('/' + '/'.join(path), namespaces=dict((prefix, namespace) for namespace, prefix in prefixes.items()))
+        _expressions.set(key, expression)
+    return expression
+
+
+def _parse(document):
+    try:
+        return etree.parse(BytesIO(document))
+    except etree.XMLSyntaxError as e:
+        raise errors.NotWellFormedError(comment=str(e))
+
+
+def _select(xml_doc, steps, element_selector):
+    """Return the element selected by steps, None if there is no such element"""
+    elements = _compile(steps)(xml_doc)
+    if len(elements) > 1:
+        raise SelectorError(element_selector._original_selector)
+    return elements[0] if elements else None
+
+
+def _start_offset(document, element):
+    index = int(_element_index(element))
+    return next(islice(_next_start_tag.finditer(document), index, None)).end() - 1
+
+
+def _element_span(document, element):
+    """Return the offsets of the start of element, of the start of its end tag
+       (None for an empty element tag) and of its end"""
+    start = _start_offset(document, element)
+    descendants = int(_descendant_count(element))
+    if descendants:
+        leaf = _last_descendant(element)[0]
+        leaf_start = next(islice(_next_start_tag.finditer(document, start + 1), descendants - 1, None)).end() - 1
+        # only the end tags of the leaf and of its ancestors up to element can follow the start of the leaf
+        levels = 0
+        parent = leaf.getparent()
+        while parent is not element:
+            levels += 1
+            parent = parent.getparent()
+        levels += 1
+    else:
+        leaf_start = start
+        levels = 0
+    match = _start_tag.match(document, leaf_start)
+    end = match.end()
+    end_tag = None
+    if not match.group(1):
+        levels += 1
+    for i in range(levels):
+        match = _next_end_tag.match(document, end)
+        end_tag, end = match.start(1), match.end()
+    return start, end_tag, end
+
+
+def find(document, element_selector, xml_doc=None):
+    """Return an element as (first index, last index+1)
+
+    If it couldn't be found, return None.
+    If there're several matches, raise SelectorError.
+    """
+    if xml_doc is None:
+        xml_doc = _parse(document)
+    element = _select(xml_doc, element_selector, element_selector)
+    if element is None:
+        return None
+    start, end_tag, end = _element_span(document, element)
+    return start, end
+
+
+def get(document, element_selector, xml_doc=None):
+    """Return an element as a string.
+
+    If it couldn't be found, return None.
+    If there're several matches, raise SelectorError.
+    """
+    location = find(document, element_selector, xml_doc)
+    if location is not None:
+        start, end = location
+        return document[start:end]
+
+
+def delete(document, element_selector, xml_doc=None):
+    """Return document with element deleted.
+
+    If it couldn't be found, return None.
+    If there're several matches, raise SelectorError.
+    """
+    location = find(document, element_selector, xml_doc)
+    if location is not None:
+        start, end = location
+        return document[:start] + document[end:]
+
+
+def _insert_point(document, xml_doc, element_selector):
+    """Return the offset where a new element matching element_selector is to
+       be inserted, following the same rules as xcap.element.InsertPointLocator.
+       Return None if there is no place to insert it."""
+    if len(element_selector) < 2:
+        return None
+    step = element_selector[-1]
+    tag = etree.Element if step.name == '*' else _tag(step.name)
+    offset = None
+    found = False
+    for parent in _compile(element_selector[:-1])(xml_doc):
+        if step.position is None:
+            # after the last sibling with the same name, or at the end of the parent for '*'
+            sibling = next(parent.iterchildren(tag, reversed=True), None)
+            if sibling is not None:
+                if found:
+                    raise SelectorError(element_selector._original_selector)
+                offset = _element_span(document, sibling if step.name != '*' else parent)[1 if step.name == '*' else 2]
+                found = True
+                continue
+        elif step.position == 1:
+            # before the first sibling with the same name
+            sibling = next(parent.iterchildren(tag), None)
+            if sibling is not None:
+                offset = _start_offset(document, sibling)
+                found = True
+                continue
+        elif step.position > 1:
+            # after the sibling with the same name preceding the requested position
+            sibling = next(islice(parent.iterchildren(tag), step.position - 2, None), None)
+            if sibling is not None:
+                if found:
+                    raise SelectorError(element_selector._original_selector)
+                offset = _element_span(document, sibling)[2]
+                found = True
+                continue
+        if not found:
+            # at the end of the parent, unless it is an empty element tag
+            offset = _element_span(document, parent)[1]
+            found = True
+    return offset
+
+
+def put(document, element_selector, element_str, xml_doc=None):
+    """Return a 2-items tuple: (new_document, created).
+    new_document is a copy of document with element_str inside.
+    created is True if insertion was performed as opposed to replacement.
+
+    If element_selector matches an existing element, it is replaced with element_str.
+    If not, it is inserted at appropriate place.
+
+    If it's impossible to insert at this location, return None.
+    If element_selector matches more than one element or more than one possible
+    place to insert and there're no rule to resolve the ambiguity then SelectorError
+    is raised.
+    """
+    if xml_doc is None:
+        xml_doc = _parse(document)
+    location = find(document, element_selector, xml_doc)
+    if location is None:
+        offset = _insert_point(document, xml_doc, element_selector)
+        if offset is None:
+            return None
+        start, end = offset, offset
+        created = True
+    else:
+        start, end = location
+        created = False
+    return (document[:start] + element_str + document[end:], created)
@@ -1,4 +1,4 @@
-from typing import AsyncGenerator, List
+from typing import AsyncGenerator, List, Optional
 
 from fastapi import APIRouter, Depends, HTTPException, Request, Response
 from sipsimple.account.xcap import (Addressbook, Document, IterateItems,
@@ -7,6 +7,7 @@ from sipsimple.payloads import addressbook, prescontent, resourcelists
 
 from xcap.appusage import getApplicationForId
 from xcap.authentication import AuthenticationManager
+from xcap.backend import stored_reads
 from xcap.db.locks import lock_document
 from xcap.schemas.addressbook import (AddressbookModel, BaseContactModel,
                                       BaseGroupModel, BasePolicyModel,
@@ -27,6 +28,7 @@ from xcap.uri import XCAPUri
 # Monkey patch document class
 def Document_init(self):
     self.content = None
+    self.etag = None
 
 
 def Document_parse(self, content):
@@ -113,24 +115,72 @@ def normalize(document: Document) -> Document:
     return document
 
 
-async def get_lock(user: UserModel) -> AsyncGenerator[None, None]:
+async def get_lock(request: Request, user: UserModel) -> AsyncGenerator[None, None]:
+    """Serialize the changes to the documents of a user. The changes are
+    stored only if the document still has the ETag it was read with, so a
+    request with an If-Match header can skip the lock, failing with 412 if the
+    document was modified by another request instead of waiting for it."""
+    if_match = request.headers.get('if-match')
+    if if_match and '*' not in if_match:
+        yield
+        return
     async with lock_document(user):
         yield
 
 
+def set_etag(request: Request, etag: Optional[str]) -> None:
+    response_headers = getattr(request.state, 'response_headers', {})
+    if etag:
+        response_headers['ETag'] = etag
+    else:
+        response_headers.pop('ETag', None)
+    request.state.response_headers = response_headers
+
+
+def conditional_request(request: Request, etag: Optional[str]) -> Request:
+    """Return the request that changes the document only if it still has the
+    given ETag, or only creates it if there was no document"""
+    request.scope.setdefault('state', {})  # shared with the new request
+    headers = [(name, value) for name, value in request.scope['headers'] if name not in (b'if-match', b'if-none-match')]
+    headers.append((b'if-match', etag.encode()) if etag else (b'if-none-match', b'*'))
+    return Request(dict(request.scope, headers=headers), request.receive)
+
+
 async def load_data(document: Document, url: XCAPUri, request: Request, propagate: bool = True) -> Document:
     xcap_data = get_xcap_resource(url, getApplicationForId(document.application))
     try:
-        data = await xcap_data.handle_get(request)
+        if request.method in ('GET', 'HEAD'):
+            data = await xcap_data.handle_get(request)
+        else:
+            # the document is changed only if it still has the ETag it is read
+            # with, which must not be the one of an out of date cached copy
+            with stored_reads():
+                data = await xcap_data.handle_get(request)
     except Exception as e:
         if propagate:
             raise e
         return xcap_data
     document.dirty = False
+    document.etag = data.headers.get('etag')
     document.parse(data.body)
+    set_etag(request, document.etag)
     return xcap_data
 
 
+async def store_data(document: Document, xcap_data, request: Request) -> Response:
+    response = await xcap_data.handle_update(conditional_request(request, document.etag))
+    document.etag = response.headers.get('etag', document.etag)
+    set_etag(request, document.etag)
+    return response
+
+
+async def delete_data(document: Document, xcap_data, request: Request) -> Response:
+    response = await xcap_data.handle_delete(conditional_request(request, document.etag))
+    document.etag = None
+    set_etag(request, None)
+    return response
+
+
 def coerce_attribute_values(attributes):
     """XCAP stores contact/uri/group/policy attribute values as XML text
     nodes, which lxml requires to be strings. A JSON client can legitimately
@@ -160,8 +210,7 @@ async def get_icon(
     user: UserModel,
     request: Request,
     document: Document = Depends(get_status_icon_document),
-    xcap_uri: XCAPUri = make_auth_wrapper(get_status_icon_document),
-    _lock: None = Depends(get_lock)
+    xcap_uri: XCAPUri = make_auth_wrapper(get_status_icon_document)
 ) -> UserIconModel:
     await load_data(document, xcap_uri, request)
 
@@ -191,7 +240,7 @@ async def add_icon(
 
     document.content = content
     request.state.body = document.content.toxml()
-    await xcap_data.handle_update(request)
+    await store_data(document, xcap_data, request)
     return icon
 
 
@@ -205,10 +254,10 @@ async def delete_icon(
 ) -> Response:
     xcap_data = await load_data(document, xcap_uri, request)
     request.state.body = document.content.toxml()
-    response = await xcap_data.handle_update(request)
+    response = await store_data(document, xcap_data, request)
     if response.status_code == 200:
         response.status_code = 204
-    return await xcap_data.handle_delete(request)
+    return await delete_data(document, xcap_data, request)
 
 
 @router.get("/users/{user:path}/addressbook", tags=["Addressbook"], responses=COMMON_ERRORS)
@@ -216,8 +265,7 @@ async def read_addressbook(
     user: UserModel,
     request: Request,
     document: Document = Depends(get_rls_document),
-    xcap_uri: XCAPUri = make_auth_wrapper(get_rls_document),
-    _lock: None = Depends(get_lock)
+    xcap_uri: XCAPUri = make_auth_wrapper(get_rls_document)
 ) -> AddressbookModel:
     await load_data(document, xcap_uri, request)
     ab = Addressbook.from_payload(document.content['sipsimple_addressbook'])
@@ -229,8 +277,7 @@ async def get_contacts(
     user: UserModel,
     request: Request,
     document: Document = Depends(get_rls_document),
-    xcap_uri: XCAPUri = make_auth_wrapper(get_rls_document),
-    _lock: None = Depends(get_lock)
+    xcap_uri: XCAPUri = make_auth_wrapper(get_rls_document)
 ) -> List[ContactModel]:
     await load_data(document, xcap_uri, request)
     ab = Addressbook.from_payload(document.content['sipsimple_addressbook'])
@@ -243,8 +290,7 @@ async def get_contact(
     contact_id: str,
     request: Request,
     document: Document = Depends(get_rls_document),
-    xcap_uri: XCAPUri = make_auth_wrapper(get_rls_document),
-    _lock: None = Depends(get_lock)
+    xcap_uri: XCAPUri = make_auth_wrapper(get_rls_document)
 ) -> ContactModel:
     await load_data(document, xcap_uri, request)
 
@@ -298,7 +344,7 @@ async def add_contact(
     sipsimple_addressbook.add(xml_contact)
 
     request.state.body = document.content.toxml()
-    await xcap_data.handle_update(request)
+    await store_data(document, xcap_data, request)
     ab = payload_to_contact(xml_contact)
     return ContactModel(**convert_to_dict(ab))
 
@@ -351,7 +397,7 @@ async def update_contact(
     ab_contact.attributes.update(coerce_attribute_values(contact.attributes))
 
     request.state.body = document.content.toxml()
-    await xcap_data.handle_update(request)
+    await store_data(document, xcap_data, request)
     return ContactModel(**payload_to_contact(ab_contact))
 
 
@@ -380,7 +426,7 @@ async def delete_contact(
         raise HTTPException(404, detail="Contact not found")
 
     request.state.body = document.content.toxml()
-    response = await xcap_data.handle_update(request)
+    response = await store_data(document, xcap_data, request)
     if response.status_code == 200:
         response.status_code = 204
     return response
@@ -392,8 +438,7 @@ async def get_policies(
     user: UserModel,
     request: Request,
     document: Document = Depends(get_rls_document),
-    xcap_uri: XCAPUri = make_auth_wrapper(get_rls_document),
-    _lock: None = Depends(get_lock)
+    xcap_uri: XCAPUri = make_auth_wrapper(get_rls_document)
 ) -> List[PolicyModel]:
     await load_data(document, xcap_uri, request)
 
@@ -407,8 +452,7 @@ async def get_policy(
     policy_id: str,
     request: Request,
     document: Document = Depends(get_rls_document),
-    xcap_uri: XCAPUri = make_auth_wrapper(get_rls_document),
-    _lock: None = Depends(get_lock)
+    xcap_uri: XCAPUri = make_auth_wrapper(get_rls_document)
 ) -> PolicyModel:
     await load_data(document, xcap_uri, request)
 
@@ -444,7 +488,7 @@ async def add_policy(
     sipsimple_addressbook.add(xml_policy)
 
     request.state.body = document.content.toxml()
-    await xcap_data.handle_update(request)
+    await store_data(document, xcap_data, request)
 
     return PolicyModel(**payload_to_policy(xml_policy))
 
@@ -479,7 +523,7 @@ async def update_policy(
     xml_policy.attributes.update(policy.attributes)
 
     request.state.body = document.content.toxml()
-    await xcap_data.handle_update(request)
+    await store_data(document, xcap_data, request)
     return PolicyModel(**payload_to_policy(xml_policy))
 
 
@@ -505,7 +549,7 @@ async def delete_policy(
         raise HTTPException(404, detail="Policy not found")
 
     request.state.body = document.content.toxml()
-    response = await xcap_data.handle_update(request)
+    response = await store_data(document, xcap_data, request)
     if response.status_code == 200:
         response.status_code = 204
     return response
@@ -517,8 +561,7 @@ async def get_groups(
     user: UserModel,
     request: Request,
     document: Document = Depends(get_rls_document),
-    xcap_uri: XCAPUri = make_auth_wrapper(get_rls_document),
-    _lock: None = Depends(get_lock)
+    xcap_uri: XCAPUri = make_auth_wrapper(get_rls_document)
 ) -> List[GroupModel]:
     await load_data(document, xcap_uri, request)
     ab = Addressbook.from_payload(document.content['sipsimple_addressbook'])
@@ -531,8 +574,7 @@ async def get_group(
     group_id: str,
     request: Request,
     document: Document = Depends(get_rls_document),
-    xcap_uri: XCAPUri = make_auth_wrapper(get_rls_document),
-    _lock: None = Depends(get_lock)
+    xcap_uri: XCAPUri = make_auth_wrapper(get_rls_document)
 ) -> GroupModel:
     await load_data(document, xcap_uri, request)
 
@@ -581,7 +623,7 @@ async def add_group(
     ab = Addressbook.from_payload(document.content['sipsimple_addressbook'])
 
     request.state.body = document.content.toxml()
-    await xcap_data.handle_update(request)
+    await store_data(document, xcap_data, request)
     return GroupModel(
         id=group.id,
         name=group.name,
@@ -632,7 +674,7 @@ async def update_group(
     ab = Addressbook.from_payload(document.content['sipsimple_addressbook'])
 
     request.state.body = document.content.toxml()
-    await xcap_data.handle_update(request)
+    await store_data(document, xcap_data, request)
     return GroupModel(
         id=group_id,
         name=group.name,
@@ -664,7 +706,7 @@ async def delete_group(
         raise HTTPException(404, detail="Group not found")
 
     request.state.body = document.content.toxml()
-    response = await xcap_data.handle_update(request)
+    response = await store_data(document, xcap_data, request)
     if response.status_code == 200:
         response.status_code = 204
     return response
@@ -703,7 +745,7 @@ async def add_group_member(
     group.contacts.add(contact.id)
 
     request.state.body = document.content.toxml()
-    await xcap_data.handle_update(request)
+    await store_data(document, xcap_data, request)
     ab = Addressbook.from_payload(document.content['sipsimple_addressbook'])
 
     return GroupModel(
@@ -743,7 +785,7 @@ async def delete_group_member(
         raise HTTPException(404, detail="Contact not found")
 
     request.state.body = document.content.toxml()
-    response = await xcap_data.handle_update(request)
+    response = await store_data(document, xcap_data, request)
     if response.status_code == 200:
         response.status_code = 204
     return response
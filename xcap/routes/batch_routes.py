@@ -0,0 +1,95 @@
+from typing import List, Optional
+
+from application import log
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Request
+from starlette.background import BackgroundTask
+
+from xcap.appusage import getApplicationForId, storage
+from xcap.authentication import AuthenticationManager
+from xcap.authentication.auth import checkApplication, parseApiURI
+from xcap.configuration import AuthenticationConfig
+from xcap.db.locks import lock_document
+from xcap.errors import HTTPError, XCAPError
+from xcap.schemas.api_errors import COMMON_ERRORS
+from xcap.schemas.batch import (BatchModel, BatchOperationModel,
+                                BatchResponseModel, BatchResultModel)
+from xcap.schemas.user import UserModel
+from xcap.services.xcap_service import get_xcap_resource
+
+router = APIRouter(prefix="/api/v1")
+
+auth_manager = AuthenticationManager()
+
+
+def operation_request(operation: BatchOperationModel, content_type: str) -> Request:
+    """Return the request the XCAP resources see for an operation of a batch"""
+    headers = [(b'content-type', (operation.content_type or content_type).encode())]
+    if operation.if_match:
+        headers.append((b'if-match', operation.if_match.encode()))
+    if operation.if_none_match:
+        headers.append((b'if-none-match', operation.if_none_match.encode()))
+    body = operation.content.encode('utf-8') if operation.content is not None else b''
+    return Request({'type': 'http', 'method': operation.method, 'headers': headers, 'state': {'body': body}})
+
+
+async def run_operation(operation: BatchOperationModel, user: str, authenticated_user: Optional[str], tasks: List[BackgroundTask]) -> BatchResultModel:
+    resource_selector = f'/{operation.application}/users/{user}/{operation.document}'
+    if operation.node:
+        resource_selector += f'/~~/{operation.node}'
+
+    try:
+        application = getApplicationForId(operation.application)
+        if application is None:
+            raise HTTPException(status_code=404, detail="Application not found")
+        xcap_uri = parseApiURI('', AuthenticationConfig.default_realm, resource_selector)
+        if authenticated_user is not None:
+            checkApplication(application, authenticated_user, xcap_uri)
+        resource = get_xcap_resource(xcap_uri, application)
+        request = operation_request(operation, resource.content_type)
+        if operation.method == 'GET':
+            response = await resource.handle_get(request)
+        elif operation.method == 'PUT':
+            response = await resource.handle_update(request)
+        else:
+            response = await resource.handle_delete(request)
+    except (HTTPError, XCAPError) as e:
+        response = e.response
+    except HTTPException as e:
+        return BatchResultModel(status=e.status_code, error=str(e.detail) or None)
+    except Exception:
+        # reported like the other failures, without stopping the batch
+        log.exception(f'Batch operation {operation.method} {resource_selector} failed')
+        return BatchResultModel(status=500, error='Internal server error')
+
+    if response.status_code >= 300:
+        return BatchResultModel(status=response.status_code, error=response.body.decode('utf-8', 'replace') or None)
+
+    if response.background is not None:
+        tasks.append(response.background)
+    etag = response.headers.get('etag')
+    content = response.body.decode('utf-8') if operation.method == 'GET' else None
+    return BatchResultModel(status=response.status_code, etag=etag.strip('"') if etag else None, content=content)
+
+
+@router.post("/users/{user}/batch", tags=["Batch"], responses=COMMON_ERRORS)
+async def run_batch(
+    user: UserModel,
+    batch: BatchModel,
+    request: Request,
+    background: BackgroundTasks
+) -> BatchResponseModel:
+    """Run several operations on the documents of a user, in order, with a
+    single authentication. The operations see the changes made by the ones
+    before them and the changes are stored together when all of them ran.
+    An operation that fails does not stop the following ones."""
+    authenticated_user = await auth_manager.authenticate_user_request(request, user)
+
+    tasks: List[BackgroundTask] = []
+    async with lock_document(user):
+        async with storage.batch() as stored_tasks:
+            results = [await run_operation(operation, user, authenticated_user, tasks) for operation in batch.operations]
+
+    # the notifications are only sent for the changes that were stored
+    for task in tasks + stored_tasks:
+        background.add_task(task)
+    return BatchResponseModel(results=results)
@@ -0,0 +1,61 @@
+import ipaddress
+import os
+
+from fastapi import APIRouter, HTTPException, Request
+
+from xcap.appusage import (applications, parsed_documents, storage,
+                           validation_executor, xml_schemas)
+from xcap.authentication import AuthenticationManager
+from xcap.authentication.auth import credential_cache
+from xcap.db.locks import lock_manager
+from xcap.db.manager import connection_manager
+from xcap.http_utils import get_client_ip
+from xcap.uri import node_selectors
+
+router = APIRouter()
+
+auth_manager = AuthenticationManager()
+
+
+def is_local(request: Request) -> bool:
+    if request.client is None or request.headers.get('X-Forwarded-For'):
+        return False
+    try:
+        return ipaddress.ip_address(request.client.host).is_loopback
+    except ValueError:
+        return False
+
+
+@router.get("/stats")
+async def read_stats(request: Request):
+    """Statistics of the worker process serving the request, available to
+    trusted peers and to local clients"""
+    if not is_local(request) and not auth_manager.is_ip_trusted(get_client_ip(request)):
+        raise HTTPException(status_code=403, detail="Statistics are only available to trusted peers")
+
+    caches = {'parsed_documents': parsed_documents.stats,
+              'node_selectors': node_selectors.stats,
+              'credentials': credential_cache.stats}
+    document_cache = getattr(storage, 'document_cache', None)
+    if document_cache is not None:
+        caches['documents'] = document_cache.stats
+    profile_cache = getattr(storage, 'profile_cache', None)
+    if profile_cache is not None:
+        caches['profiles'] = profile_cache.stats
+
+    # the capabilities document is generated by the server and never validated
+    validation = dict((application_id, application.validation_stats.stats) for application_id, application in applications.items()
+                      if hasattr(application, 'validation_stats'))
+
+    stats = {'pid': os.getpid(),
+             'startup': getattr(request.app, 'startup_times', None),
+             'database': connection_manager.stats,
+             'locks': lock_manager.stats,
+             'caches': caches,
+             'validation': validation,
+             'validation_threads': validation_executor.stats,
+             'schemas': xml_schemas.stats}
+    thor_stats = getattr(storage, 'thor_stats', None)
+    if thor_stats is not None:
+        stats['thor'] = thor_stats
+    return stats
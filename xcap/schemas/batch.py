@@ -0,0 +1,32 @@
+from typing import List, Literal, Optional
+
+from pydantic import BaseModel, Field
+
+# the maximum number of operations in a batch
+MAX_OPERATIONS = 100
+
+
+class BatchOperationModel(BaseModel):
+    method: Literal['GET', 'PUT', 'DELETE']
+    application: str
+    document: str = 'index'
+    node: Optional[str] = None
+    content: Optional[str] = None
+    content_type: Optional[str] = None
+    if_match: Optional[str] = None
+    if_none_match: Optional[str] = None
+
+
+class BatchModel(BaseModel):
+    operations: List[BatchOperationModel] = Field(min_length=1, max_length=MAX_OPERATIONS)
+
+
+class BatchResultModel(BaseModel):
+    status: int
+    etag: Optional[str] = None
+    content: Optional[str] = None
+    error: Optional[str] = None
+
+
+class BatchResponseModel(BaseModel):
+    results: List[BatchResultModel]
@@ -1,73 +1,105 @@
+import asyncio
+import json
+import os
+import sys
 import threading
+import time
 from datetime import datetime
 
+_import_start = time.perf_counter()
+
 import uvicorn
 from application import log
+from application.process import process
 from fastapi import FastAPI, Request, Response
 from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
-from starlette.background import BackgroundTask, BackgroundTasks
-from starlette.middleware.base import BaseHTTPMiddleware
-from twisted.internet import asyncioreactor, reactor
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 from xcap import (__author__, __description__, __fullname__, __url__,
                   __version__)
-from xcap.configuration import ServerConfig, TLSConfig
-from xcap.db.initialize import init_db
+from xcap.configuration import (PROCESS_ENVIRONMENT, LoggingConfig,
+                                ServerConfig, TLSConfig)
 from xcap.errors import HTTPError, ResourceNotFound, XCAPError
-from xcap.log import AccessLogRequest, AccessLogResponse, log_access
-
-
-class LogRequestMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        body = await request.body()
-
-        async def receive():
-            return {"type": "http.request", "body": body, "more_body": False}
-        request._receive = receive
-        request.state.body = body
-
-        response = await call_next(request)
-
-        chunks = []
-
-        async for chunk in response.body_iterator:
-            chunks.append(chunk)
-
-        full_body = b"".join(chunks)
-
-        async def replay_body():
-            yield full_body
-
-        response.body_iterator = replay_body()
-        response.headers['Date'] = datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')
-
-        request_log = AccessLogRequest(dict(request.headers), body, response.status_code)
-        response_log = AccessLogResponse(dict(response.headers), full_body, response.status_code)  # body will be set in background
-
-        if response.background is None:
-            response.background = BackgroundTasks()
-
-        def background_log():
-            log_access(request, response, full_body)
-            request_log.log()
-            response_log.log()
-
-        response.background.add_task(background_log)
-
-        return response
+from xcap.log import (AccessLogRequest, AccessLogResponse, BodyTap,
+                      log_access)
+from xcap.sharedstate import SQLiteState
+
+# the time taken to import the modules of the server, reported at startup
+import_time = time.perf_counter() - _import_start
+
+
+class LogRequestMiddleware(object):
+    """Pure ASGI access log middleware.
+
+    Request and response bodies stream through untouched. Only their size is
+    counted and, when logging is configured for the response code, the first
+    bytes needed by the access log are kept.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        request_body = BodyTap(enabled=bool(LoggingConfig.log_request))
+        response_body = BodyTap(enabled=False)
+        response_start: Message = {}
+
+        async def receive_wrapper() -> Message:
+            message = await receive()
+            if message['type'] == 'http.request':
+                request_body.feed(message.get('body', b''))
+            return message
+
+        async def send_wrapper(message: Message) -> None:
+            if message['type'] == 'http.response.start':
+                headers = MutableHeaders(scope=message)
+                headers['Date'] = datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')
+                # headers set by the request handlers regardless of the response, e.g. Authentication-Info,
+                # except the ETag of the document, which does not describe the error responses
+                status = message['status']
+                for name, value in scope.get('state', {}).get('response_headers', {}).items():
+                    if name == 'ETag' and not (200 <= status < 300 or status == 304):
+                        continue
+                    headers[name] = value
+                response_body.enabled = status in LoggingConfig.log_response
+                response_start.update(message)
+            elif message['type'] == 'http.response.body':
+                response_body.feed(message.get('body', b''))
+            await send(message)
+
+        await self.app(scope, receive_wrapper, send_wrapper)
+
+        if not response_start:
+            return
+
+        status_code = response_start['status']
+        request = Request(scope)
+        response_headers = Headers(raw=response_start['headers'])
+
+        log_access(request, status_code, response_headers, response_body.size)
+        AccessLogRequest(dict(request.headers), request_body.body, status_code, request_body.size).log()
+        AccessLogResponse(dict(response_headers), response_body.body, status_code, response_body.size).log()
 
 
 class XCAPApp(FastAPI):
     backend: str = ''
 
     def __init__(self):
+        start = time.perf_counter()
         super().__init__(
             title=__fullname__,
             description=f"{__description__} [{__url__}]({__url__})",
             version=__version__
         )
         self.add_middleware(LogRequestMiddleware)
-        from xcap.routes import xcap_routes
+        from xcap.routes import batch_routes, stats_routes, xcap_routes
         self.include_router(xcap_routes.router)
+        self.include_router(batch_routes.router)
+        self.include_router(stats_routes.router)
         try:
             from xcap.routes import api_routes
         except ImportError as e:
@@ -83,6 +115,8 @@ class XCAPApp(FastAPI):
         self.add_exception_handler(HTTPError, self.http_error_handler)
         self.add_exception_handler(XCAPError, self.http_error_handler)
         self.add_api_route("/", self.read_root, methods=["GET"])
+        self.startup_times = {'imports': import_time, 'application': time.perf_counter() - start}
+        self._schema_warm_up = None
 
     async def http_error_handler(self, request: Request, exc: HTTPError) -> Response:
         return exc.response
@@ -117,7 +151,10 @@ class XCAPApp(FastAPI):
         log.Formatter.prefix_format = '{record.levelname:<8s} '
         log.get_logger('aiosqlite').setLevel(log.level.INFO)
 
-        init_db()
+        start = time.perf_counter()
+        if PROCESS_ENVIRONMENT not in os.environ:
+            from xcap.db.initialize import init_db
+            init_db()
 
         if ServerConfig.backend in ['SIPThor', 'OpenSIPS']:
             twisted_thread = threading.Thread(target=self._start_reactor, daemon=True)
@@ -125,24 +162,31 @@ class XCAPApp(FastAPI):
             twisted_thread.start()
 
         self.backend = ServerConfig.backend
+        self.startup_times['initialization'] = time.perf_counter() - start
+
+        # the schemas not used by the first requests are compiled in the background
+        from xcap.appusage import applications, xml_schemas
+        self._schema_warm_up = asyncio.ensure_future(xml_schemas.warm_up(application.schema_file for application in applications.values() if application.schema_file))
 
-        log.info("OpenXCAP app is running...")
+        log.info('OpenXCAP app is running, started in %.2f s (%s)' % (sum(self.startup_times.values()), ', '.join('%s %.2f s' % item for item in self.startup_times.items())))
 
     async def shutdown_reactor(self):
+        if self.backend not in ['SIPThor', 'OpenSIPS']:
+            return
+        from twisted.internet import reactor
         if reactor.running:
             if self.backend == 'SIPThor':
                 from xcap.appusage import ServerConfig
-                ServerConfig.backend.XCAPProvisioning().stop()
+                reactor.callFromThread(ServerConfig.backend.XCAPProvisioning().stop)
             else:
                 reactor.callFromThread(reactor.stop)
 
     def _start_reactor(self):
+        from twisted.internet import reactor
         from xcap.appusage import ServerConfig
         reactor.run(installSignalHandlers=ServerConfig.backend.installSignalHandlers)
 
     async def shutdown_backend(self):
-        import asyncio
-        import sys
         storage = getattr(sys.modules.get('xcap.appusage', None), 'storage', None)
         if storage:
             try:
@@ -160,19 +204,34 @@ class XCAPServer():
     def __init__(self):
         self.config = ServerConfig
 
+    def _prepare_workers(self, workers: int) -> None:
+        directories = {'system': process.configuration.system_directory,
+                       'user': process.configuration.user_directory,
+                       'local': process.configuration.local_directory,
+                       'runtime': process.runtime.directory}
+        os.environ[PROCESS_ENVIRONMENT] = json.dumps(directories)
+        SQLiteState.reset()
+        from xcap.db.initialize import init_db
+        init_db()  # once, before the workers start
+        log.info(f'Starting {workers} worker processes')
+
     def run(self, debug=False):
         log_config = uvicorn.config.LOGGING_CONFIG
         log_config["loggers"]["uvicorn"] = {"handlers": []}
         log_config["loggers"]["uvicorn.error"] = {"handlers": []}
         log_config["loggers"]["uvicorn.access"] = {"handlers": []}
 
+        workers = max(self.config.workers, 1)
+        if workers > 1:
+            self._prepare_workers(workers)
+
         config = {
             'factory': True,
             'host': self.config.address,
             'port': self.config.port,
-            'reload': debug,
+            'reload': debug and workers == 1,
             'log_level': 'debug' if debug else 'info',
-            'workers': 1,
+            'workers': workers,
             'access_log': False,
             'log_config': log_config,
             'headers': [('server', f'{__fullname__}/{__version__}')]
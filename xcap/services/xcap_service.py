@@ -162,6 +162,15 @@ class XCAPResource:
                     # non-GET methods. But Precondition Failed makes sense to me.
                     raise HTTPError(StatusResponse(HTTPStatus.PRECONDITION_FAILED.value, "Requested resource has not changed."))
 
+    async def get_body(self, request: Request) -> bytes:
+        """
+        Return the request body, either set by the REST API or sent by the client
+        """
+        body = getattr(request.state, 'body', None)
+        if body is None:
+            body = await request.body()
+        return body
+
     def check_etag(self, request: Request, etag: str, exists: bool = True) -> None:
         """
         Check ETag header and validate conditions
@@ -255,7 +264,7 @@ class XCAPDocument(XCAPResource):
         return document_data
 
     async def update_data(self, request: Request) -> str:
-        document = request.state.body
+        document = await self.get_body(request)
         document_data = await self.application.put_document(self.xcap_uri, document, lambda e, exists=True: self.check_etag(request, e, exists))
         if not document_data:
             raise HTTPException(status_code=404, detail="Document not found")
@@ -282,7 +291,7 @@ class XCAPElement(XCAPResource):
         content_type = request.headers.get('content-type')
         if not content_type or content_type != self.content_type:
             raise HTTPException(status_code=415, detail="")
-        element = request.state.body
+        element = await self.get_body(request)
         element_data = await self.application.put_element(self.xcap_uri, element, lambda e: self.check_etag(request, e))
         return element_data
 
@@ -305,7 +314,7 @@ class XCAPAttribute(XCAPResource):
         content_type = request.headers.get('content-type')
         if not content_type or content_type != self.content_type:
             raise HTTPException(status_code=415, detail="")
-        attribute = request.state.body
+        attribute = await self.get_body(request)
         attribute_data = await self.application.put_attribute(self.xcap_uri, attribute, lambda e: self.check_etag(request, e))
         return attribute_data
 
@@ -0,0 +1,346 @@
+"""State shared between the worker processes of the server
+
+When the server runs a single worker process, shared tables are plain
+in-process TTL caches. With multiple worker processes they are stored in a
+SQLite database in the runtime directory, which all the workers on the host
+open, so that e.g. a Digest nonce issued by one worker can be validated by
+another one.
+
+The caches of the worker processes are kept coherent with a log of the
+versions published by each worker after it changed the data, stored in the
+same database and read by a thread of every worker.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+from application import log
+from application.process import process
+from application.python.types import Singleton
+from cachetools import TTLCache
+
+from xcap.configuration import ServerConfig
+
+__all__ = ['SharedTable', 'LocalTable', 'SQLiteTable', 'SQLiteState', 'ChangeLog', 'shared_table', 'multiprocess']
+
+
+class SharedTable(object):
+    """A mapping with bounded size and a time to live for its entries. When
+    given, on_evict is called with the key of every entry removed to make
+    room for new ones before it expired."""
+
+    def __init__(self, name: str, size: int, ttl: float, on_evict: Optional[Callable[[Hashable], None]] = None):
+        self.name = name
+        self.size = size
+        self.ttl = ttl
+        self.on_evict = on_evict
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        raise NotImplementedError
+
+    def set(self, key: Hashable, value: Any) -> None:
+        raise NotImplementedError
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        raise NotImplementedError
+
+    def update(self, key: Hashable, function: Callable[[Any], Any]) -> Any:
+        """Atomically replace the value of key, or None if it is missing, with
+        the result of function, which is returned. The entry is removed if the
+        result is None."""
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key) is not None
+
+    def __getitem__(self, key: Hashable) -> Any:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        self.set(key, value)
+
+    def __delitem__(self, key: Hashable) -> None:
+        if self.pop(key) is None:
+            raise KeyError(key)
+
+
+class EvictingTTLCache(TTLCache):
+    """A TTL cache which reports the entries evicted to make room for new ones"""
+
+    def __init__(self, maxsize: int, ttl: float, on_evict: Optional[Callable[[Hashable], None]]):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.on_evict = on_evict
+
+    def popitem(self):
+        key, value = super().popitem()
+        if self.on_evict is not None:
+            self.on_evict(key)
+        return key, value
+
+
+class LocalTable(SharedTable):
+    """A table only visible to the current process"""
+
+    def __init__(self, name: str, size: int, ttl: float, on_evict: Optional[Callable[[Hashable], None]] = None):
+        super().__init__(name, size, ttl, on_evict)
+        self._cache: TTLCache = EvictingTTLCache(size, ttl, on_evict)
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            return self._cache.get(key, default)
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._cache[key] = value
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            return self._cache.pop(key, default)
+
+    def update(self, key: Hashable, function: Callable[[Any], Any]) -> Any:
+        with self._lock:
+            value = function(self._cache.get(key))
+            if value is None:
+                self._cache.pop(key, None)
+            else:
+                self._cache[key] = value
+            return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+
+class SQLiteState(object, metaclass=Singleton):
+    """The SQLite database holding the shared tables of all worker processes"""
+
+    filename = 'openxcap-state.sqlite'
+    purge_interval = 1000  # writes between purges of the expired entries
+
+    def __init__(self):
+        process.runtime.create_directory()
+        self.path = process.runtime.file(self.filename)
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=OFF')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS state (name TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires REAL NOT NULL, PRIMARY KEY (name, key))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS state_expires_idx ON state (name, expires)')
+
+    @classmethod
+    def reset(cls) -> None:
+        """Remove the state left behind by a previous run of the server"""
+        path = process.runtime.file(cls.filename)
+        if path is None:
+            return
+        for name in (path, path + '-wal', path + '-shm'):
+            try:
+                os.unlink(name)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                log.warning('Cannot remove shared state file %s: %s' % (name, e))
+
+    def purge(self, table: SharedTable) -> List[str]:
+        """Remove expired entries and trim the table to its maximum size,
+        returning the keys of the entries removed by trimming. Must be called
+        with the lock held."""
+        self.connection.execute('DELETE FROM state WHERE name = ? AND expires <= ?', (table.name, time.time()))
+        count = self.connection.execute('SELECT COUNT(*) FROM state WHERE name = ?', (table.name,)).fetchone()[0]
+        if count <= table.size:
+            return []
+        rows = self.connection.execute('SELECT rowid, key FROM state WHERE name = ? ORDER BY expires LIMIT ?', (table.name, count - table.size)).fetchall()
+        self.connection.executemany('DELETE FROM state WHERE rowid = ?', [(rowid,) for rowid, key in rows])
+        return [key for rowid, key in rows]
+
+
+class SQLiteTable(SharedTable):
+    """A table visible to all the worker processes on this host. Keys are
+    stored as their string representation and values must be JSON serializable."""
+
+    def __init__(self, name: str, size: int, ttl: float, on_evict: Optional[Callable[[Hashable], None]] = None):
+        super().__init__(name, size, ttl, on_evict)
+        self._state = SQLiteState()
+
+    def _evicted(self, keys: List[str]) -> None:
+        # called without the lock held, on_evict may use other tables
+        if self.on_evict is not None:
+            for key in keys:
+                self.on_evict(key)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        state = self._state
+        with state.lock:
+            row = state.connection.execute('SELECT value FROM state WHERE name = ? AND key = ? AND expires > ?', (self.name, str(key), time.time())).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def set(self, key: Hashable, value: Any) -> None:
+        state = self._state
+        evicted: List[str] = []
+        with state.lock:
+            state.connection.execute('INSERT OR REPLACE INTO state (name, key, value, expires) VALUES (?, ?, ?, ?)', (self.name, str(key), json.dumps(value), time.time() + self.ttl))
+            state.writes += 1
+            if state.writes % state.purge_interval == 0:
+                evicted = state.purge(self)
+        self._evicted(evicted)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        state = self._state
+        with state.lock:
+            connection = state.connection
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = connection.execute('SELECT value, expires FROM state WHERE name = ? AND key = ?', (self.name, str(key))).fetchone()
+                if row is not None:
+                    connection.execute('DELETE FROM state WHERE name = ? AND key = ?', (self.name, str(key)))
+            finally:
+                connection.execute('COMMIT')
+        if row is None or row[1] <= time.time():
+            return default
+        return json.loads(row[0])
+
+    def update(self, key: Hashable, function: Callable[[Any], Any]) -> Any:
+        state = self._state
+        with state.lock:
+            connection = state.connection
+            purge = False
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = connection.execute('SELECT value FROM state WHERE name = ? AND key = ? AND expires > ?', (self.name, str(key), time.time())).fetchone()
+                value = function(json.loads(row[0]) if row is not None else None)
+                if value is None:
+                    connection.execute('DELETE FROM state WHERE name = ? AND key = ?', (self.name, str(key)))
+                else:
+                    connection.execute('INSERT OR REPLACE INTO state (name, key, value, expires) VALUES (?, ?, ?, ?)', (self.name, str(key), json.dumps(value), time.time() + self.ttl))
+                    state.writes += 1
+                    purge = state.writes % state.purge_interval == 0
+            finally:
+                connection.execute('COMMIT')
+            evicted = state.purge(self) if purge else []
+        self._evicted(evicted)
+        return value
+
+    def clear(self) -> None:
+        state = self._state
+        with state.lock:
+            state.connection.execute('DELETE FROM state WHERE name = ?', (self.name,))
+
+
+def encode_key(key: Hashable) -> str:
+    return json.dumps(key)
+
+
+def decode_key(text: str) -> Hashable:
+    key = json.loads(text)
+    return tuple(key) if isinstance(key, list) else key
+
+
+class ChangeLog(object, metaclass=Singleton):
+    """The versions of the entries of the caches kept by the worker processes
+    and the log of their changes, stored in the shared state database.
+
+    A version is only replaced if the one published is the one the change was
+    made to, or if none is, otherwise a tombstone is published, which makes
+    all the workers read the entry again. The changes made by the other
+    processes are read by a thread, which passes them to the function
+    subscribed to the cache they belong to."""
+
+    poll_interval = 0.1  # seconds between two reads of the log
+    lifetime = 60        # seconds the versions and the changes are kept
+
+    def __init__(self):
+        state = SQLiteState()
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(state.path, timeout=5, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=OFF')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS versions (name TEXT NOT NULL, key TEXT NOT NULL, version TEXT NOT NULL, time REAL NOT NULL, PRIMARY KEY (name, key))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS changes (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, key TEXT NOT NULL, version TEXT NOT NULL, pid INTEGER NOT NULL, time REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS changes_time_idx ON changes (time)')
+        self.last_change = self.connection.execute('SELECT COALESCE(MAX(id), 0) FROM changes').fetchone()[0]
+        self.subscribers: Dict[str, Callable[[Hashable, Any], None]] = {}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='change-log-writer')
+        self._thread: Optional[threading.Thread] = None
+
+    def subscribe(self, name: str, function: Callable[[Hashable, Any], None]) -> None:
+        """Call function from the log thread with the key and the new version,
+        None for a tombstone, of the entries of name changed by other processes"""
+        self.subscribers[name] = function
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='change-log-reader', daemon=True)
+            self._thread.start()
+
+    def publish(self, name: str, key: Hashable, previous: Any, version: Any) -> bool:
+        """Publish version as the one of key if previous is the published one,
+        publish a tombstone otherwise. Return True if version was published."""
+        key = encode_key(key)
+        now = time.time()
+        with self.lock:
+            connection = self.connection
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = connection.execute('SELECT version FROM versions WHERE name = ? AND key = ? AND time > ?', (name, key, now - self.lifetime)).fetchone()
+                published = row is None or json.loads(row[0]) == previous
+                value = json.dumps(version if published else None)
+                connection.execute('INSERT OR REPLACE INTO versions (name, key, version, time) VALUES (?, ?, ?, ?)', (name, key, value, now))
+                connection.execute('INSERT INTO changes (name, key, version, pid, time) VALUES (?, ?, ?, ?, ?)', (name, key, value, self.pid, now))
+            finally:
+                connection.execute('COMMIT')
+        return published
+
+    def remove(self, name: str, key: Hashable) -> None:
+        """Publish a tombstone for key"""
+        self.publish(name, key, None, None)
+
+    def _run(self) -> None:
+        purge_interval = max(1, int(self.lifetime / self.poll_interval))
+        polls = 0
+        while True:
+            time.sleep(self.poll_interval)
+            polls += 1
+            try:
+                with self.lock:
+                    rows = self.connection.execute('SELECT id, name, key, version, pid FROM changes WHERE id > ? ORDER BY id', (self.last_change,)).fetchall()
+                    if polls % purge_interval == 0:
+                        expired = time.time() - self.lifetime
+                        self.connection.execute('DELETE FROM changes WHERE time <= ? AND id <= ?', (expired, self.last_change))
+                        self.connection.execute('DELETE FROM versions WHERE time <= ?', (expired,))
+            except sqlite3.Error as e:
+                log.warning('Cannot read the cache change log: %s' % e)
+                continue
+            for change_id, name, key, version, pid in rows:
+                self.last_change = change_id
+                function = self.subscribers.get(name)
+                if function is not None and pid != self.pid:
+                    function(decode_key(key), json.loads(version))
+
+
+_tables: Dict[str, SharedTable] = {}
+
+
+def multiprocess() -> bool:
+    """Return True if the server runs more than one worker process"""
+    return ServerConfig.workers > 1
+
+
+def shared_table(name: str, size: int, ttl: float, on_evict: Optional[Callable[[Hashable], None]] = None) -> SharedTable:
+    """Return the table with the given name, shared between the worker processes if there is more than one"""
+    try:
+        return _tables[name]
+    except KeyError:
+        table_class = SQLiteTable if multiprocess() else LocalTable
+        return _tables.setdefault(name, table_class(name, size, ttl, on_evict))
@@ -34,10 +34,18 @@ Meanwhile, the safe approach is to use &quot;
 from typing import Any, Dict, Optional, Union
 from urllib.parse import unquote
 
+from xcap.cache import Cache
+from xcap.configuration import CacheConfig
 from xcap.configuration.datatypes import XCAPRootURI
 from xcap.xpath import DocumentSelector, NodeSelector
 
 
+# maps (application id, node selector, default namespace) to the parsed node
+# selector. Node selectors are shared by all the URIs using them and must not
+# be modified
+node_selectors = Cache(CacheConfig.node_selector_cache_size)
+
+
 class XCAPUser(object):
 
     def __init__(self, username: Optional[str] = None, domain: Optional[str] = None):
@@ -102,12 +110,21 @@ class XCAPUri(object):
         self.application_id = self.doc_selector.application_id
         self.node_selector: Union[NodeSelector, None] = None
         if len(_split) == 2:
-            self.node_selector = NodeSelector(_split[1], namespaces.get(self.application_id))
+            self.node_selector = self._parse_node_selector(_split[1], self.application_id, namespaces.get(self.application_id))
         if self.doc_selector.user_id:
             self.user = XCAPUser.parse(self.doc_selector.user_id, realm)
         else:
             self.user = XCAPUser(None, realm)
 
+    @staticmethod
+    def _parse_node_selector(selector: str, application_id: str, namespace: Optional[str]) -> NodeSelector:
+        key = (application_id, selector, namespace)
+        node_selector = node_selectors.get(key)
+        if node_selector is None:
+            node_selector = NodeSelector(selector, namespace)
+            node_selectors.set(key, node_selector)
+        return node_selector
+
     def __str__(self) -> str:
         return self.xcap_root + self.resource_selector
 
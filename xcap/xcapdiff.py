@@ -18,11 +18,13 @@ a given user uri.
 
 """
 import asyncio
+from collections.abc import MutableMapping
 from functools import wraps
 from time import time
 from typing import Any, Dict, List, Optional, Union
 
 from xcap.configuration.datatypes import XCAPRootURI
+from xcap.sharedstate import SharedTable, multiprocess, shared_table
 from xcap.types import PublishFunction, PublishWrapper
 from xcap.uri import XCAPUri
 
@@ -50,9 +52,9 @@ def xml_document(sel: str, old_etag: str, new_etag: Union[str, None]) -> str:
 class UserChanges(object):
     MIN_WAIT = 30
 
-    def __init__(self, publish_xcapdiff: PublishFunction):
+    def __init__(self, publish_xcapdiff: PublishFunction, publish_times: Optional[MutableMapping] = None, user: Optional[str] = None):
         self.changes: Dict[str, List[Any]] = {}
-        self.rate_limit = RateLimit(self.MIN_WAIT)
+        self.rate_limit = RateLimit(self.MIN_WAIT, publish_times, user)
         self.publish_xcapdiff = publish_xcapdiff
 
     async def add_change(self, uri: XCAPUri, old_etag: str, etag: Union[str, None], xcap_root: XCAPRootURI) -> None:
@@ -83,9 +85,18 @@ class Notifier(object):
         # maps user_uri to UserChanges
         self.users_changes: Dict[str, UserChanges] = {}
 
+        # when running multiple worker processes, the time of the last publish
+        # for a user is shared, so that the rate limit applies to all of them
+        self.publish_times: Optional[SharedTable] = None
+        if multiprocess():
+            self.publish_times = shared_table('xcap-diff', 100000, UserChanges.MIN_WAIT)
+
     async def on_change(self, uri: XCAPUri, old_etag: str, new_etag: Optional[str]) -> None:
         key = str(uri.user)
-        changes = self.users_changes.setdefault(key, UserChanges(self.publish_xcapdiff))
+        try:
+            changes = self.users_changes[key]
+        except KeyError:
+            changes = self.users_changes[key] = UserChanges(self.publish_xcapdiff, self.publish_times, key)
         await changes.add_change(uri, old_etag, new_etag, self.xcap_root)
 
         def try_cleanup(_task=None):
@@ -103,11 +114,20 @@ class Notifier(object):
 
 
 class RateLimit:
-    def __init__(self, min_wait: int):
+    def __init__(self, min_wait: int, call_times: Optional[MutableMapping] = None, key: Optional[str] = None):
         self.min_wait = min_wait
-        self.last_call = 0.0
+        self.call_times = call_times if call_times is not None else {}
+        self.key = key
         self.delayed_call: Optional[asyncio.Task] = None
 
+    @property
+    def last_call(self) -> float:
+        return self.call_times.get(self.key, 0.0)
+
+    @last_call.setter
+    def last_call(self, value: float) -> None:
+        self.call_times[self.key] = value
+
     async def callAtLimitedRate(self, f: PublishWrapper, *args, **kwargs) -> None:
         current = time()
         delta = current - self.last_call
@@ -95,6 +95,14 @@ class XPathTokenizer(object):
 
 # XPath parsing
 
+def qualified_name(tag, namespace):
+    """Return the (namespace, name) tuple for a tag, which the tokenizer
+    returns as {namespace}name if it has a prefix bound with xmlns()"""
+    if tag.startswith('{'):
+        namespace, _, tag = tag[1:].partition('}')
+    return namespace, tag
+
+
 def read_element_tag(lst, index, namespace, namespaces):
     if index == len(lst):
         raise NodeParsingError
@@ -111,7 +119,7 @@ def read_element_tag(lst, index, namespace, namespaces):
             raise NodeParsingError
         return (namespaces[lst[index]], lst[index + 2]), index + 3
     else:
-        return (namespace, lst[index]), index + 1
+        return qualified_name(lst[index], namespace), index + 1
 
 
 def read_position(lst, index):
@@ -123,7 +131,7 @@ def read_position(lst, index):
 # XML attributes don't belong to the same namespace as containing tag
 def read_att_test(lst, index, _namespace, namespaces):
     if lst.get(index) == '[' and lst.get(index + 1) == '@' and lst.get(index + 3) == '=' and lst.get(index + 5) == ']':
-        return (None, lst[index + 2]), lst[index + 4], index + 6
+        return qualified_name(lst[index + 2], None), lst[index + 4], index + 6
     elif lst.get(index) == '[' and lst.get(index + 1) == '@' and lst.get(index + 3) == ':' and lst.get(index + 5) == '=' and lst.get(index + 7) == ']':
         return (namespaces[lst[index + 2]], lst[index + 4]), lst[index + 6], index + 8
     return None, None, index
@@ -338,6 +346,7 @@ class ElementSelector(list):
             if m:
                 (name, ) = m.groups()
                 result = copy(self)
+                result[-1] = copy(self[-1])
                 result[-1].name = self._parse_qname(name)
                 return result
         return self